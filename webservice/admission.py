@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY, Counter, Histogram, current_trace, traced
+
+ADMITTED = REGISTRY.register(Counter(
+    "kdt_admission_admitted_total", "Calls accepted into a bounded pool.", ("pool",)))
+REJECTED = REGISTRY.register(Counter(
+    "kdt_admission_rejected_total", "Calls shed with 503 (queue_full, queue_timeout).", ("pool", "reason")))
+QUEUE_SECONDS = REGISTRY.register(Histogram(
+    "kdt_admission_queue_seconds", "Time admitted calls waited for a pool thread.", ("pool",)))
+
+
+class Overloaded(Exception):
+    """A bounded pool refused or shed a call; answered with 503 + Retry-After (see register)."""
+
+    def __init__(self, pool, reason, retry_after):
+        super().__init__(f"{pool} is overloaded ({reason})")
+        self.pool = pool
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Bulkhead:
+    """
+    Bounded executor for one expensive endpoint.
+
+    At most `workers` calls run at once on the pool's own threads and at most
+    `queue` more wait for one; anything beyond that is refused at once with
+    Overloaded, so a burst ties up at most workers + queue request threads
+    and the cheap routes keep the rest. A call that waited longer than
+    `max_wait` seconds for a thread is shed instead of run (its client has
+    most likely given up). Stages timed inside the call are attributed to the
+    request that submitted it.
+    """
+
+    def __init__(self, name, workers=2, queue=8, max_wait=5.0, retry_after=1):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue = max(0, queue)
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._pending = 0      # Admitted calls not finished yet (queued + running)
+        self._executor = None
+        self._pid = None       # Process the pool belongs to (a forked worker makes its own)
+
+    def _pool(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    self._pending = 0  # Forked: the parent's calls are not ours to wait for
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix=f"bulkhead-{self.name}")
+                self._pid = os.getpid()
+            return self._executor
+
+    def _reject(self, reason):
+        REJECTED.inc(pool=self.name, reason=reason)
+        logging.warning(f"Shedding a call to {self.name}: {reason}")
+        return Overloaded(self.name, reason, self.retry_after)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs); returns a Future, or raises Overloaded when the pool is full."""
+        executor = self._pool()
+        with self._lock:
+            if self._pending >= self.workers + self.queue:
+                raise self._reject("queue_full")
+            self._pending += 1
+        ADMITTED.inc(pool=self.name)
+        trace = current_trace()
+        queued = time.perf_counter()
+
+        def run():
+            try:
+                waited = time.perf_counter() - queued
+                QUEUE_SECONDS.observe(waited, pool=self.name)
+                if trace is not None:
+                    trace.stages.append(("queue", waited))
+                if self.max_wait is not None and waited > self.max_wait:
+                    raise self._reject("queue_timeout")
+                with traced(trace):
+                    return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+        try:
+            return executor.submit(run)
+        except RuntimeError:  # Interpreter shutting down
+            with self._lock:
+                self._pending -= 1
+            raise
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn on the pool and wait for it; raises Overloaded if it was refused or shed."""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def status(self):
+        with self._lock:
+            return {"workers": self.workers, "queue": self.queue, "pending": self._pending}
+
+
+def register(app, bulkheads=()):
+    """
+    Answer Overloaded with 503 + Retry-After, and add GET /admission with the
+    occupancy of `bulkheads`.
+    """
+    from flask import jsonify
+
+    @app.errorhandler(Overloaded)
+    def overloaded(e):
+        response = jsonify(error="Service busy, retry later", pool=e.pool, reason=e.reason)
+        response.status_code = 503
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+
+    @app.route("/admission", methods=["GET"])
+    def admission_status():
+        return jsonify({b.name: b.status() for b in bulkheads})
+
+    return app
@@ -1,8 +1,16 @@
 import os
 import csv
 from flask import Flask, render_template, request, jsonify
-import threading
 import logging
+from typing_index import TypingIndex, CursorError, StaleCursor
+from predict_payload import PACKED_MIMETYPE, PayloadError, parse_packed, parse_columnar
+from csv_appender import CsvAppender
+from compaction import CompactionJob
+from shard_store import ShardStore, ShardedAppender, ShardedTypingIndex
+from conditional_get import ResponseMemo, conditional_get
+from history_stream import HistoryQuery, history_response
+from metrics import instrument, stage, DIGRAPHS_REJECTED
+from warmup import Warmup
 
 # --- Logging setup ---
 logging.basicConfig(level=logging.DEBUG,
@@ -19,33 +27,65 @@ app = Flask(
     template_folder=TEMPLATE_DIR,
     static_folder=STATIC_DIR
 )
-_csv_lock = threading.Lock()
+instrument(app)  # Per-stage timings on GET /metrics, slowest requests on GET /metrics/slow
+
+# Typing index and feature store are loaded by a warm-up thread so the process
+# answers (/, /metrics, GET /ready) right away; routes needing them wait
+warmup = Warmup()
+warmup.register(app)
 
 # --- Paths ---
 # It's often better to use environment variables or config files for paths
 BASE_CSV = os.path.join(DATA_DIR, "free-text.csv")
 EXT_CSV = os.path.join(DATA_DIR, "database.csv")
 
+# --- CSV write-behind ---
+# Rows are appended in batches (one write + fsync each) under a file lock, so
+# several worker processes can share EXT_CSV. CSV_DURABLE=1 makes every
+# /predict wait until its rows are on disk; clients can also ask per request.
+CSV_FLUSH_ROWS = int(os.environ.get("CSV_FLUSH_ROWS", "256"))
+CSV_FLUSH_MS = float(os.environ.get("CSV_FLUSH_MS", "50"))
+CSV_DURABLE = os.environ.get("CSV_DURABLE", "0") == "1"
+
+# --- Compaction ---
+# Once EXT_CSV grows past COMPACT_EXT_BYTES a background job merges it into
+# BASE_CSV: deduplicated, sorted by participant/session, with a byte-offset
+# index (see compaction.py). COMPACT_INTERVAL_S=0 disables the job.
+COMPACT_EXT_BYTES = int(os.environ.get("COMPACT_EXT_BYTES", str(32 << 20)))
+COMPACT_INTERVAL_S = float(os.environ.get("COMPACT_INTERVAL_S", "300"))
+
+# --- Sharded typing data ---
+# With a manifest in TYPING_SHARDS_DIR (python shard_store.py migrate ...) each
+# participant's rows live in their own CSV under their own lock, written by
+# SHARD_WRITERS group-commit threads; /sessions and /history read only that
+# participant's file. EXT_CSV and its compaction are then no longer used.
+TYPING_SHARDS_DIR = os.environ.get("TYPING_SHARDS_DIR", os.path.join(DATA_DIR, "shards"))
+SHARD_WRITERS = int(os.environ.get("SHARD_WRITERS", "4"))
+TYPING_SHARD_CACHE = int(os.environ.get("TYPING_SHARD_CACHE", "256"))
+
+typing_shards = ShardStore(TYPING_SHARDS_DIR).open() if ShardStore.exists(TYPING_SHARDS_DIR) else None
+
 # --- Load DNN once ---
 
     # Depending on the error, you might still set _dnn_model_loaded = False
 
 # --- Ensure Database Directory and Bootstrap new CSV ---
+# Header of BASE_CSV; the appender also writes it into EXT_CSV if the file is removed later on
+CSV_HEADER = None
 try:
     os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.isfile(EXT_CSV) and os.path.isfile(BASE_CSV):
-        with open(BASE_CSV, newline="", encoding="utf-8") as fin, \
-             open(EXT_CSV, "w", newline="", encoding="utf-8") as fout:
-            reader = csv.reader(fin)
-            writer = csv.writer(fout)
+    if os.path.isfile(BASE_CSV):
+        with open(BASE_CSV, newline="", encoding="utf-8") as fin:
             try:
-                header = next(reader)
-                writer.writerow(header)
-                logging.info(f"Created new extended CSV file: {EXT_CSV} with header from {BASE_CSV}")
+                CSV_HEADER = next(csv.reader(fin))
             except StopIteration:
                 logging.warning(f"Base CSV {BASE_CSV} is empty, cannot copy header.")
             except Exception as e:
                  logging.error(f"Error reading header from {BASE_CSV}: {e}")
+    if not os.path.isfile(EXT_CSV) and CSV_HEADER:
+        with open(EXT_CSV, "w", newline="", encoding="utf-8") as fout:
+            csv.writer(fout).writerow(CSV_HEADER)
+            logging.info(f"Created new extended CSV file: {EXT_CSV} with header from {BASE_CSV}")
 
     elif not os.path.isfile(EXT_CSV):
          # If base also doesn't exist, create EXT_CSV with a default header maybe?
@@ -62,66 +102,44 @@ except Exception as e:
     logging.error(f"Error during directory/CSV setup: {e}")
     # This might prevent saving new data.
 
-def read_all_rows():
-    """
-    Read both original and appended CSVs, clean headers/rows, return list of dicts.
-    Handles potential FileNotFoundError and other reading errors gracefully.
-    """
-    rows = []
-    required_keys = {"participant", "session"} # Minimum keys for a row to be useful
-
-    for path in (BASE_CSV, EXT_CSV):
-        if not os.path.isfile(path):
-            logging.debug(f"CSV file not found, skipping: {path}")
-            continue
-        try:
-            with open(path, newline="", encoding="utf-8") as f:
-                # Use DictReader for easier access, handle potential empty file
-                try:
-                    # Need to check if file is empty before creating DictReader
-                    first_char = f.read(1)
-                    if not first_char:
-                        logging.warning(f"CSV file is empty: {path}")
-                        continue
-                    f.seek(0) # Reset file pointer
-                    reader = csv.DictReader(f, skipinitialspace=True)
-                    header = reader.fieldnames
-                    if not header:
-                         logging.warning(f"CSV file has no header: {path}")
-                         continue
-
-                    for r in reader:
-                        # Clean keys (strip whitespace) and drop keys that become empty
-                        clean_row = {k.strip(): v for k, v in r.items() if k and k.strip()}
-                        # Drop rows that don't have the essential keys or have None/empty values for them
-                        if required_keys.issubset(clean_row.keys()) and \
-                           all(clean_row[key] for key in required_keys):
-                            rows.append(clean_row)
-                        else:
-                            logging.debug(f"Skipping incomplete row in {path}: {r}")
-                except Exception as read_err:
-                     logging.error(f"Error reading or processing CSV file {path}: {read_err}")
-
-        except FileNotFoundError:
-            # This check is redundant due to os.path.isfile above, but kept for clarity
-            logging.warning(f"CSV file not found during read attempt: {path}")
-        except Exception as e:
-            logging.error(f"Unexpected error opening or reading CSV file {path}: {e}")
-
-    # Deduplicate based on participant, session, and maybe other key features if necessary
-    # This simple deduplication assumes row order matters (keeps first encountered)
-    # For more complex scenarios, adjust the key for uniqueness.
-    # Example: unique_key = lambda r: (r['participant'], r['session'], r['key1'], r['key2'], tuple(r.get(f) for f in feature_keys))
-    # seen = set()
-    # unique_rows = []
-    # for row in rows:
-    #    key = (row['participant'], row['session']) # Simple example
-    #    if key not in seen:
-    #        unique_rows.append(row)
-    #        seen.add(key)
-    # return unique_rows
-    # For now, returning all rows as before:
-    return rows
+# --- Resident typing-data index ---
+# Built once at startup; /predict (and the GET routes, for appends made by other
+# processes) tail only the bytes appended to EXT_CSV since the last refresh.
+# Sharded, each participant's segment is indexed the first time it is read.
+if typing_shards is not None:
+    typing_index = ShardedTypingIndex(typing_shards, cache=TYPING_SHARD_CACHE)
+else:
+    typing_index = TypingIndex(BASE_CSV, EXT_CSV)
+warmup.step("typing_index")(typing_index.load)
+# GET responses memoized per (endpoint, args, index generation); ETags answer repeat polls with 304
+response_memo = ResponseMemo()
+
+if typing_shards is not None:
+    csv_appender = ShardedAppender(
+        typing_shards,
+        writers=SHARD_WRITERS,
+        max_rows=CSV_FLUSH_ROWS,
+        max_delay=CSV_FLUSH_MS / 1000.0,
+        durable=CSV_DURABLE,
+    ).start()
+    compaction_job = None  # Segments are per participant already
+else:
+    csv_appender = CsvAppender(
+        EXT_CSV,
+        max_rows=CSV_FLUSH_ROWS,
+        max_delay=CSV_FLUSH_MS / 1000.0,
+        durable=CSV_DURABLE,
+        header=CSV_HEADER,
+    ).start()
+    compaction_job = CompactionJob(
+        BASE_CSV,
+        EXT_CSV,
+        min_bytes=COMPACT_EXT_BYTES,
+        interval=COMPACT_INTERVAL_S,
+        on_done=lambda stats: typing_index.refresh(),
+    ).start()
+
+warmup.start()
 
 
 # --- Routes ---
@@ -132,18 +150,19 @@ def home():
     return render_template("biometric_test.html")
 
 @app.route("/participants", methods=["GET"])
+@warmup.required
 def list_participants():
     """Returns a sorted list of unique participant IDs."""
     try:
-        all_rows = read_all_rows()
-        # Use a set for uniqueness, filter out potential None or empty strings
-        participants = sorted({r["participant"] for r in all_rows if r.get("participant")})
-        return jsonify(data={"participants": participants})
+        typing_index.refresh()
+        return conditional_get(typing_index, response_memo,
+                               lambda: jsonify(data={"participants": typing_index.participants()}))
     except Exception as e:
         logging.error(f"Error listing participants: {e}", exc_info=True)
         return jsonify(error="Failed to retrieve participant list"), 500
 
 @app.route("/sessions", methods=["GET"])
+@warmup.required
 def list_sessions():
     """Returns a sorted list of unique session IDs for a given participant."""
     participant_id = request.args.get("participant", "").strip()
@@ -151,23 +170,26 @@ def list_sessions():
         return jsonify(error="Participant ID is required"), 400
 
     try:
-        all_rows = read_all_rows()
-        # Filter, convert to int for sorting (handle potential errors), ensure uniqueness
-        sessions = set()
-        for r in all_rows:
-            if r.get("participant") == participant_id and r.get("session"):
+        typing_index.refresh(participant_id)
+
+        def build():
+            # Convert to int for sorting (handle potential errors), ensure uniqueness
+            sessions = set()
+            for session in typing_index.sessions(participant_id):
                 try:
-                    sessions.add(int(r["session"]))
+                    sessions.add(int(session))
                 except (ValueError, TypeError):
-                    logging.warning(f"Invalid session format '{r['session']}' for participant '{participant_id}'")
+                    logging.warning(f"Invalid session format '{session}' for participant '{participant_id}'")
 
-        sorted_sessions = sorted(list(sessions))
-        return jsonify(data={"sessions": sorted_sessions})
+            sorted_sessions = sorted(list(sessions))
+            return jsonify(data={"sessions": sorted_sessions})
+        return conditional_get(typing_index.scope(participant_id), response_memo, build)
     except Exception as e:
         logging.error(f"Error listing sessions for participant '{participant_id}': {e}", exc_info=True)
         return jsonify(error="Failed to retrieve session list"), 500
 
 @app.route("/history", methods=["GET"])
+@warmup.required
 def view_history():
     """Returns typing history data for a specific participant and session."""
     participant_id = request.args.get("participant", "").strip()
@@ -183,43 +205,61 @@ def view_history():
     except ValueError:
         return jsonify(error="Session ID must be an integer"), 400
 
+    # Cursor paging (?after=&limit=), ?format=json|ndjson|columnar, ?fields=timings
     try:
-        all_rows = read_all_rows()
-        history_data = [
-            r for r in all_rows
-            if r.get("participant") == participant_id and r.get("session") == session_str # Compare as string as stored in CSV
-        ]
-        # Ensure feature keys exist before sending, maybe rename for consistency?
-        # Assuming the JS expects specific keys like "DU.key1.key1" etc.
-        # If CSV headers are just feat1, feat2... map them here or adjust JS.
-        # Let's assume CSV has columns: participant, session, key1, key2, DU.key1.key1, DD.key1.key2, DU.key1.key2, UD.key1.key2, UU.key1.key2
-        # (Adjust if your CSV headers are different)
-
-        return jsonify(data={"history": history_data})
+        query = HistoryQuery(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    try:
+        typing_index.refresh(participant_id)
+
+        def build():
+            history_rows, cursor = typing_index.history_page(participant_id, session_str, query.after, query.limit) # Compare as string as stored in CSV
+            # Assuming the JS expects specific keys like "DU.key1.key1" etc.
+            # Let's assume CSV has columns: participant, session, key1, key2, DU.key1.key1, DD.key1.key2, DU.key1.key2, UD.key1.key2, UU.key1.key2
+            # (Adjust if your CSV headers are different)
+
+            # Streamed (and gzipped when accepted) as the rows are serialised
+            return history_response(history_rows, query, cursor, request.headers.get("Accept-Encoding", ""), envelope="data")
+        return conditional_get(typing_index.scope(participant_id), response_memo, build)
+    except StaleCursor as e:
+        return jsonify(error=str(e)), 410
+    except CursorError as e:
+        return jsonify(error=str(e)), 400
     except Exception as e:
         logging.error(f"Error retrieving history for participant '{participant_id}', session '{session_str}': {e}", exc_info=True)
         return jsonify(error="Failed to retrieve history data"), 500
 
 @app.route("/predict", methods=["POST"])
+@warmup.required
 def predict():
     """Receives typing data, predicts user, saves data, returns result."""
     
+    # Packed binary bodies carry only the digraphs; participant/session come in the query string
+    packed = request.mimetype == PACKED_MIMETYPE
+    if packed:
+        data = request.args
+    else:
+        try:
+            with stage("parse"):
+                data = request.get_json(force=True) # force=True can mask invalid JSON, consider removing
+            if not data:
+                 return jsonify(error="Invalid JSON payload"), 400
+        except Exception as e:
+            logging.error(f"Failed to parse JSON payload: {e}")
+            return jsonify(error="Invalid JSON payload"), 400
 
-    try:
-        data = request.get_json(force=True) # force=True can mask invalid JSON, consider removing
-        if not data:
-             return jsonify(error="Invalid JSON payload"), 400
-    except Exception as e:
-        logging.error(f"Failed to parse JSON payload: {e}")
-        return jsonify(error="Invalid JSON payload"), 400
-
-    app.logger.debug("RAW PREDICT PAYLOAD: %r", data)
+        app.logger.debug("RAW PREDICT PAYLOAD: %r", data)
 
     # --- Input Validation ---
     participant_id = data.get("participant", "").strip()
     if not participant_id:
         return jsonify(error="Participant must be a non-empty string"), 400
 
+    # Wait for the rows to reach disk instead of returning once they are queued
+    durable = CSV_DURABLE or str(data.get("durable", "")).lower() in ("1", "true")
+
     try:
         session_id = int(data.get("session"))
         if session_id <= 0:
@@ -227,39 +267,61 @@ def predict():
     except (TypeError, ValueError, KeyError):
         return jsonify(error="Session must be provided as a positive integer"), 400
 
-    raw_digraphs = data.get("digraphs", [])
-    if not isinstance(raw_digraphs, list) or not raw_digraphs:
-        return jsonify(error="Must send a non-empty list of digraphs"), 400
-
-    valid_digraphs = []
-    flat_features = []
     expected_feature_count = 5 # Should match DNN input expectation per digraph
 
-    for i, d in enumerate(raw_digraphs):
-        if not isinstance(d, dict):
-             logging.warning(f"Invalid digraph format (not a dict) at index {i}: {d}")
-             continue
-        k1 = d.get("key1")
-        k2 = d.get("key2")
-        features = d.get("features")
-
-        # More specific validation
-        if (
-            isinstance(k1, str) and len(k1) == 1 and # Single character keys
-            isinstance(k2, str) and len(k2) == 1 and
-            isinstance(features, list) and len(features) == expected_feature_count and
-            all(isinstance(f, (int, float)) for f in features) and # Check feature types
-            all(f is not None for f in features) # Ensure no None values
-        ):
-            valid_digraphs.append(d)
-            flat_features.extend(features)
-        else:
-            logging.warning(f"Invalid digraph data at index {i}: {d}. Skipping.")
-
-    if not valid_digraphs:
+    if packed or data.get("format") == "columnar":
+        # Compact payloads: validated and converted to model input with vectorised NumPy ops
+        try:
+            with stage("validate"):
+                parsed = parse_packed(request.get_data()) if packed else parse_columnar(data)
+        except PayloadError as e:
+            return jsonify(error=str(e)), 400
+        num_received = parsed.received
+        valid_keys = parsed.keys
+        feature_rows = parsed.features.tolist()
+        flat_features = parsed.features.ravel().tolist()
+        if len(valid_keys) < num_received:
+            logging.warning(f"Skipped {num_received - len(valid_keys)} invalid digraphs in compact payload")
+    else:
+        raw_digraphs = data.get("digraphs", [])
+        if not isinstance(raw_digraphs, list) or not raw_digraphs:
+            return jsonify(error="Must send a non-empty list of digraphs"), 400
+
+        with stage("validate"):
+            valid_digraphs = []
+            flat_features = []
+
+            for i, d in enumerate(raw_digraphs):
+                if not isinstance(d, dict):
+                     logging.warning(f"Invalid digraph format (not a dict) at index {i}: {d}")
+                     continue
+                k1 = d.get("key1")
+                k2 = d.get("key2")
+                features = d.get("features")
+
+                # More specific validation
+                if (
+                    isinstance(k1, str) and len(k1) == 1 and # Single character keys
+                    isinstance(k2, str) and len(k2) == 1 and
+                    isinstance(features, list) and len(features) == expected_feature_count and
+                    all(isinstance(f, (int, float)) for f in features) and # Check feature types
+                    all(f is not None for f in features) # Ensure no None values
+                ):
+                    valid_digraphs.append(d)
+                    flat_features.extend(features)
+                else:
+                    logging.warning(f"Invalid digraph data at index {i}: {d}. Skipping.")
+
+        num_received = len(raw_digraphs)
+        valid_keys = [(d["key1"], d["key2"]) for d in valid_digraphs]
+        feature_rows = [d["features"] for d in valid_digraphs]
+
+    if len(valid_keys) < num_received:
+        DIGRAPHS_REJECTED.inc(num_received - len(valid_keys), endpoint="/predict")
+    if not valid_keys:
         return jsonify(error="No valid digraphs found in the provided data"), 400
 
-    num_digraphs = len(valid_digraphs)
+    num_digraphs = len(valid_keys)
     num_features_per_digraph = expected_feature_count
 
     # --- Prediction ---
@@ -289,22 +351,24 @@ def predict():
     # Assuming CSV header: participant, session, key1, key2, feat1, feat2, feat3, feat4, feat5
     # Adjust column order if your CSV is different
     rows_to_write = [
-        [participant_id, session_id, d["key1"], d["key2"], *d["features"]]
-        for d in valid_digraphs
+        [participant_id, session_id, k1, k2, *features]
+        for (k1, k2), features in zip(valid_keys, feature_rows)
     ]
     saved_successfully = False
     save_error = None
     try:
-        # Ensure the target CSV has a header before appending
-        if not os.path.isfile(EXT_CSV) or os.path.getsize(EXT_CSV) == 0:
+        # The appender creates a missing EXT_CSV with the header; without one there is nothing to start it with
+        if typing_shards is None and CSV_HEADER is None and (not os.path.isfile(EXT_CSV) or os.path.getsize(EXT_CSV) == 0):
              raise FileNotFoundError(f"Cannot append: Target CSV {EXT_CSV} is missing or empty.")
 
-        with _csv_lock: # Acquire lock for thread safety
-            with open(EXT_CSV, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerows(rows_to_write)
-            saved_successfully = True
-            logging.info(f"Successfully appended {len(rows_to_write)} rows to {EXT_CSV} for participant '{participant_id}', session '{session_id}'")
+        # Queued for the next group commit; durable requests wait for the fsync
+        with stage("csv_append"):
+            future = csv_appender.append(rows_to_write, durable=durable)
+        saved_successfully = True
+        logging.info(f"{'Appended' if durable else 'Queued'} {len(rows_to_write)} rows to "
+                     f"{TYPING_SHARDS_DIR if typing_shards is not None else EXT_CSV} for participant '{participant_id}', session '{session_id}'")
+        # Indexed once on disk: right away for durable rows, from the writer thread for queued ones
+        future.add_done_callback(lambda f: _typing_data_written(f, participant_id, session_id, len(rows_to_write)))
     except FileNotFoundError as e:
         logging.error(f"File not found error while writing to CSV: {e}")
         save_error = f"Could not save typing data: Target file {EXT_CSV} not found or inaccessible."
@@ -315,14 +379,14 @@ def predict():
         logging.exception(f"Unexpected error during CSV append for '{participant_id}' session '{session_id}'") # Log full traceback
         save_error = f"Could not save typing data due to an unexpected error."
 
-
     # --- Response ---
     response_data = {
         "predicted_index": predicted_index,
         # "predicted_user": participant_id, # Echoing input user seems less useful than index
-        "saved": saved_successfully,
-        "digraphs_processed": len(valid_digraphs),
-        "digraphs_received": len(raw_digraphs),
+        # Write-behind rows are only "queued": a later write error is logged, not reported here
+        "saved": ("queued" if not durable else True) if saved_successfully else False,
+        "digraphs_processed": len(valid_keys),
+        "digraphs_received": num_received,
     }
     if prediction_error:
         response_data["prediction_error"] = prediction_error
@@ -343,6 +407,34 @@ def predict():
     return jsonify(data=response_data), status_code if 'status_code' in locals() else 200
 
 
+def _typing_data_written(future, participant_id, session_id, count):
+    """Appender callback: index the rows once they are on disk, or log that they were lost."""
+    error = future.exception()
+    if error is not None:
+        logging.error(f"Lost {count} queued rows for '{participant_id}' session '{session_id}': {error}")
+        return
+    try:
+        with stage("index_refresh"):
+            typing_index.refresh(participant_id)
+    except Exception as e:
+        logging.error(f"Error refreshing the typing index for '{participant_id}': {e}")
+
+
+# --- Pre-fork serving (serve.py) ---
+
+def shutdown():
+    """Flush queued CSV rows and stop the background threads (parent before forking, worker at exit)."""
+    if compaction_job is not None:
+        compaction_job.stop()
+    csv_appender.close()
+
+def post_fork():
+    """Start the background threads again in a worker forked from the preloaded parent."""
+    csv_appender.start()
+    if compaction_job is not None:
+        compaction_job.start()
+
+
 if __name__ == "__main__":
     # Use debug=False in production
     # Consider using a proper WSGI server like Gunicorn or Waitress
@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+import logging
+
+from metrics import REGISTRY, Counter, stage
+
+try:
+    import fcntl
+except ImportError:  # Windows: batches are only serialised within this process
+    fcntl = None
+
+AUDIT_RECORDS = REGISTRY.register(Counter(
+    "kdt_audit_records_total", "Audit records by outcome (written, dropped).", ("result",)))
+
+_FLUSH = object()
+_STOP = object()
+_dumps = json.JSONEncoder(separators=(",", ":"), default=str).encode
+
+
+class AuditLog:
+    """
+    Background JSON Lines audit log.
+
+    log() only puts a record (a dict) on a bounded queue and returns; a writer
+    thread gathers up to `max_batch` records or `max_delay` seconds worth and
+    appends them with a single write() under an exclusive flock(), so several
+    worker processes can share the file. When the file would grow past
+    `max_bytes` it is rotated to path.1 .. path.<backups> first. If the queue
+    is full the record is dropped and counted rather than blocking the request.
+    """
+
+    def __init__(self, path, max_bytes=10 << 20, backups=5, max_queue=10000, max_batch=512, max_delay=0.2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self._queue = queue.Queue(max_queue)
+        self._thread = None
+        self._pid = None  # Process the writer runs in (a forked worker starts its own)
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        with self._start_lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    self._queue = queue.Queue(self._queue.maxsize)  # Forked: the parent's writer did not come along
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        return self
+
+    def log(self, event, **fields):
+        """Queue one record; `ts` (epoch seconds) is added unless given. Never blocks."""
+        record = {"event": event, "ts": fields.pop("ts", None) or time.time()}
+        record.update(fields)
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            AUDIT_RECORDS.inc(result="dropped")
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """Block until every record queued so far has been written."""
+        done = threading.Event()
+        if self._pid != os.getpid():
+            self.start()
+        self._queue.put((_FLUSH, done))
+        done.wait(timeout)
+
+    def close(self, timeout=None):
+        thread = self._thread
+        if thread is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        self._queue.put((_STOP, None))
+        thread.join(timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while isinstance(batch[-1], dict) and len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            records = [item for item in batch if isinstance(item, dict)]
+            if records:
+                try:
+                    with stage("audit_write"):
+                        self._write("".join(_dumps(r) + "\n" for r in records).encode("utf-8"))
+                    self.written += len(records)
+                    AUDIT_RECORDS.inc(len(records), result="written")
+                except Exception as e:
+                    logging.error(f"Error writing {len(records)} audit records to {self.path}: {e}")
+                    self.dropped += len(records)
+                    AUDIT_RECORDS.inc(len(records), result="dropped")
+            stop = False
+            for item in batch:
+                if isinstance(item, tuple):
+                    if item[0] is _STOP:
+                        stop = True
+                    elif item[1] is not None:
+                        item[1].set()
+            if stop:
+                return
+
+    def _open_locked(self):
+        """Open the current file under flock; reopen if another process rotated it meanwhile."""
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            if fcntl is None:
+                return fd
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.truncate(self.path, 0)
+
+    def _write(self, data):
+        fd = self._open_locked()
+        try:
+            size = os.fstat(fd).st_size
+            if size and self.max_bytes and size + len(data) > self.max_bytes:
+                self._rotate()
+                os.close(fd)
+                fd = self._open_locked()
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)  # Also releases the flock
+
+
+# --- Reading ---
+
+def log_files(path):
+    """The log and its rotated backups, oldest first."""
+    backups = []
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        backups.append(f"{path}.{i}")
+        i += 1
+    return backups[::-1] + ([path] if os.path.exists(path) else [])
+
+
+def read_records(path, event=None, rotated=True):
+    """Yield the records of the log (and its backups). Lines of other events are skipped before parsing."""
+    needle = f'"event":{json.dumps(event)}' if event else None
+    for name in (log_files(path) if rotated else [path]):
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                if needle is not None and needle not in line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # Torn last line of a crashed writer
+
+
+def error_rates(records):
+    """
+    FAR/FRR of auth2 records. An attempt is genuine unless its record says
+    "genuine": false (impostor tests); FRR is the share of genuine attempts
+    rejected and FAR the share of impostor attempts accepted. Per-user
+    rates are keyed by the claimed user.
+    """
+    totals = {"genuine": 0, "false_rejects": 0, "impostor": 0, "false_accepts": 0}
+    users = {}
+    for r in records:
+        per_user = users.setdefault(str(r.get("user_id")), dict.fromkeys(totals, 0))
+        accepted = r.get("match") in (True, "True", "true")
+        for t in (totals, per_user):
+            if r.get("genuine", True) in (False, "False", "false"):
+                t["impostor"] += 1
+                t["false_accepts"] += accepted
+            else:
+                t["genuine"] += 1
+                t["false_rejects"] += not accepted
+
+    def rates(t):
+        return dict(t,
+                    frr=t["false_rejects"] / t["genuine"] if t["genuine"] else None,
+                    far=t["false_accepts"] / t["impostor"] if t["impostor"] else None)
+
+    return {"overall": rates(totals), "users": {u: rates(t) for u, t in sorted(users.items())}}
+
+
+if __name__ == "__main__":
+    # python audit_log.py resultados.jsonl
+    path = sys.argv[1] if len(sys.argv) > 1 else "resultados.jsonl"
+    print(json.dumps(error_rates(read_records(path, event="auth2")), indent=2))
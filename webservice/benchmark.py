@@ -0,0 +1,643 @@
+"""
+Load/latency benchmark for the Flask endpoints with synthetic typists.
+
+Synthetic typists are fitted on the real data: per participant, the key
+hold times and the down-down latency of free-text style digraphs (so the five
+DU/DD/UD/UU timings stay mutually consistent), and per user the mean/spread of
+each biometria.csv column. For every requested data size a scratch copy of
+the webservice is populated with that many rows and benchmarked in its own
+process through the Flask test client:
+
+    python benchmark.py --sizes 100,10000,1000000 --concurrency 8 --out bench.json
+    python benchmark.py --sizes 100 --compare bench.json
+
+or, against servers that are already running (their data is left as is, but
+/predict appends to it):
+
+    python benchmark.py --url http://127.0.0.1:3000 --auth-url http://127.0.0.1:5000
+
+--startup measures cold start instead: each app is started in a fresh
+interpreter under `-X importtime` and timed to its first response (GET /)
+and to readiness (GET /ready); the report lists the slowest imports and
+fails (exit 1) if a plotting/ML package is imported before the app can
+answer, or, with --compare, if a median regresses by more than
+--max-regression percent:
+
+    python benchmark.py --startup --sizes 1000 --runs 5 --out startup.json
+    python benchmark.py --startup --sizes 1000 --compare startup.json
+"""
+import os
+import io
+import sys
+import csv
+import json
+import math
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import socket
+import subprocess
+import multiprocessing
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TIMING_KEYS = ["DU.key1.key1", "DD.key1.key2", "DU.key1.key2", "UD.key1.key2", "UU.key1.key2"]
+DIGRAPH_HEADER = ["participant", "session", "key1", "key2"] + TIMING_KEYS
+
+# Apps timed by --startup, and packages that must not be imported before they answer
+STARTUP_APPS = ("server", "app", "regi")
+OFF_SERVING_PATH = ("pandas", "sklearn", "scipy", "matplotlib", "seaborn", "mlxtend")
+
+# endpoint -> module serving it
+ENDPOINTS = {
+    "/predict": "server",
+    "/history": "server",
+    "/sessions": "server",
+    "/login/auth2": "regi",
+    "/best_params/result": "regi",
+}
+
+
+# --- Synthetic typists ---
+
+def _digraph_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            row = {k.strip(): v for k, v in row.items() if k}
+            try:
+                yield row["participant"].strip(), row["key1"], row["key2"], [float(row[k]) for k in TIMING_KEYS]
+            except (KeyError, AttributeError, TypeError, ValueError):
+                continue
+
+
+class SyntheticTypists:
+    """
+    Digraph and biometria-vector generators seeded from the real CSVs.
+
+    A digraph is drawn as log-normal (hold key1, down-down latency, hold key2)
+    from a typist's profile, and expanded into the five timings exactly like
+    the typing page does. Typist profiles are real participants' profiles with
+    their means shifted by a random per-typist factor.
+    """
+
+    def __init__(self, digraph_csvs, vector_csv, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.pairs = []
+        logs = {}
+        for path in digraph_csvs:
+            if not os.path.isfile(path):
+                continue
+            for participant, key1, key2, f in _digraph_rows(path):
+                h1, dd, h2 = f[0], f[1], f[3] - f[1]
+                if h1 > 0 and dd > 0 and h2 > 0:
+                    logs.setdefault(participant, []).append(np.log([h1, dd, h2]))
+                    if len(key1) == 1 and len(key2) == 1:
+                        self.pairs.append((key1, key2))
+        self.digraph_profiles = [
+            (np.mean(v, axis=0), np.cov(np.array(v).T) + np.eye(3) * 1e-4)
+            for v in logs.values() if len(v) >= 10
+        ]
+        if not self.digraph_profiles:
+            raise ValueError(f"No usable digraph data in {digraph_csvs}")
+        self.pairs = self.pairs or [("a", "b")]
+
+        with open(vector_csv, newline="") as f:
+            reader = csv.reader(f)
+            self.vector_header = next(reader)
+            by_user = {}
+            for line in reader:
+                if len(line) == len(self.vector_header):
+                    try:
+                        by_user.setdefault(line[-1], []).append([float(v) for v in line[:-1]])
+                    except ValueError:
+                        continue
+        self.vector_profiles = [
+            (np.mean(v, axis=0), np.std(v, axis=0) if len(v) > 1 else np.abs(np.mean(v, axis=0)) * 0.1)
+            for v in by_user.values()
+        ]
+
+    def typist(self):
+        mean, cov = self.digraph_profiles[self.rng.integers(len(self.digraph_profiles))]
+        return mean + self.rng.normal(0, 0.15, 3), cov
+
+    def digraphs(self, typist, n):
+        """(keys, features[n, 5]) for one typist."""
+        mean, cov = typist
+        h1, dd, h2 = np.exp(self.rng.multivariate_normal(mean, cov, n)).T
+        features = np.column_stack([h1, dd, dd - h1, dd + h2, dd + h2 - h1])
+        keys = [self.pairs[i] for i in self.rng.integers(len(self.pairs), size=n)]
+        return keys, np.round(features)
+
+    def vector_user(self):
+        mean, std = self.vector_profiles[self.rng.integers(len(self.vector_profiles))]
+        return mean * self.rng.lognormal(0, 0.1, len(mean)), std
+
+    def vectors(self, user, n):
+        mean, std = user
+        return np.round(mean + self.rng.normal(0, 1, (n, len(mean))) * std, 3)
+
+
+# --- Scratch dataset ---
+
+def _copy_webservice(workdir):
+    web = os.path.join(workdir, "webservice")
+    # Code and templates only: the data files are generated
+    shutil.copytree(BASE_DIR, web, ignore=shutil.ignore_patterns(
+        "__pycache__", "*.csv", "*.db", "*.db-*", "*.log", "features", "tuning_cache", "static"))
+    model = os.path.join(os.path.dirname(BASE_DIR), "typing.dnn")
+    for path in (model, os.path.splitext(model)[0] + ".labels.json"):
+        if os.path.isfile(path):
+            shutil.copy(path, workdir)
+    return web
+
+
+def build_dataset(workdir, size, typists, session_rows=100, sessions=10, vectors_per_user=5):
+    """Populate a scratch webservice with `size` digraph rows and `size` biometria rows."""
+    web = _copy_webservice(workdir)
+    data = os.path.join(web, "database")
+
+    per_typist = session_rows * sessions
+    with open(os.path.join(data, "free-text.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(DIGRAPH_HEADER)
+        written, t = 0, 0
+        while written < size:
+            typist = typists.typist()
+            n = min(per_typist, size - written)
+            keys, features = typists.digraphs(typist, n)
+            for i, ((k1, k2), row) in enumerate(zip(keys, features.astype(int).tolist())):
+                writer.writerow([f"s{t:05d}", i // session_rows + 1, k1, k2, *row])
+            written += n
+            t += 1
+    for name in ("free-text-new.csv", "database.csv"):
+        with open(os.path.join(data, name), "w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerow(DIGRAPH_HEADER)
+
+    users = max(1, math.ceil(size / vectors_per_user))
+    with open(os.path.join(data, "biometria.csv"), "w", newline="") as f:
+        f.write(",".join(typists.vector_header) + "\n")
+        for user_id in range(1, users + 1):
+            n = min(vectors_per_user, size - (user_id - 1) * vectors_per_user) or 1
+            block = io.StringIO()
+            values = typists.vectors(typists.vector_user(), n)
+            np.savetxt(block, np.column_stack([values, np.full(n, user_id)]), fmt=["%g"] * values.shape[1] + ["%d"],
+                       delimiter=",")
+            f.write(block.getvalue())
+
+    con = sqlite3.connect(os.path.join(web, "database.db"))
+    with con:
+        con.execute("CREATE TABLE tb_usuario (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "username TEXT UNIQUE NOT NULL, password TEXT NOT NULL)")
+        con.executemany("INSERT INTO tb_usuario (id, username, password) VALUES (?, ?, ?)",
+                        ((i, f"user{i}", "bench") for i in range(1, users + 1)))
+    con.close()
+    return web, {"typists": t, "sessions": sessions, "users": users}
+
+
+# --- Request plans ---
+
+def make_requests(endpoint, typists, n, meta, digraphs=3):
+    """Pre-built (method, path, json body) tuples so generation is not timed."""
+    rng = np.random.default_rng(1)
+    plans = []
+    for i in range(n):
+        if endpoint == "/predict":
+            keys, features = typists.digraphs(typists.typist(), digraphs)
+            plans.append(("POST", "/predict", {
+                "participant": f"bench{i % 50:03d}",
+                "session": 1 + i // 50,
+                "digraphs": [{"key1": k1, "key2": k2, "features": f}
+                             for (k1, k2), f in zip(keys, features.tolist())],
+            }))
+        elif endpoint == "/history":
+            t = rng.integers(max(1, meta.get("typists", 1)))
+            s = rng.integers(meta.get("sessions", 1)) + 1
+            plans.append(("GET", f"/history?participant=s{t:05d}&session={s}", None))
+        elif endpoint == "/sessions":
+            t = rng.integers(max(1, meta.get("typists", 1)))
+            plans.append(("GET", f"/sessions?participant=s{t:05d}", None))
+        elif endpoint == "/login/auth2":
+            user_id = int(rng.integers(max(1, meta.get("users", 1)))) + 1
+            sample = typists.vectors(typists.vector_user(), 1)[0].tolist()
+            plans.append(("POST", "/login/auth2", {"user_id": user_id, "typing_data": sample}))
+        elif endpoint == "/best_params/result":
+            plans.append(("GET", "/best_params/result", None))
+        else:
+            raise ValueError(f"Unknown endpoint {endpoint}")
+    return plans
+
+
+# --- Drivers ---
+
+class _FlaskDriver:
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def __call__(self, method, path, body):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+
+
+class _HttpDriver:
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def __call__(self, method, path, body):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={"Content-Type": "application/json"} if data else {})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else None
+
+
+def run_endpoint(driver, plans, concurrency, warmup):
+    """Replay `plans` with `concurrency` threads; latency stats in milliseconds."""
+    for method, path, body in plans[:warmup]:
+        driver(method, path, body)
+    plans = plans[warmup:]
+    latencies = [None] * len(plans)
+    statuses = [None] * len(plans)
+
+    def one(i):
+        method, path, body = plans[i]
+        start = time.perf_counter()
+        try:
+            statuses[i] = driver(method, path, body)
+        except Exception:
+            statuses[i] = 0
+        latencies[i] = (time.perf_counter() - start) * 1000.0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(len(plans))))
+    wall = time.perf_counter() - start
+    ok = [l for l, s in zip(latencies, statuses) if 200 <= s < 300]
+    return {
+        "requests": len(plans),
+        "errors": len(plans) - len(ok),
+        "status_counts": {str(s): statuses.count(s) for s in sorted(set(statuses))},
+        "throughput_rps": len(plans) / wall if wall > 0 else None,
+        "p50_ms": _percentile(latencies, 50),
+        "p95_ms": _percentile(latencies, 95),
+        "p99_ms": _percentile(latencies, 99),
+        "mean_ms": float(np.mean(latencies)) if latencies else None,
+        "max_ms": float(np.max(latencies)) if latencies else None,
+    }
+
+
+# --- One data size, in a child process ---
+
+def _child(args):
+    web = args.child
+    meta = json.loads(args.meta)
+    os.chdir(web)
+    sys.path.insert(0, web)
+    typists = SyntheticTypists(_seed_digraph_csvs(), _seed_vector_csv(), seed=args.seed)
+
+    results = []
+    modules = {}
+    for endpoint in args.endpoints:
+        name = ENDPOINTS[endpoint]
+        if name not in modules:
+            start = time.perf_counter()
+            try:
+                module = __import__(name)
+                warmup = getattr(module, "warmup", None)
+                if warmup is not None:
+                    warmup.wait()  # Time the whole start-up, not just the import
+                modules[name] = (module, time.perf_counter() - start, None)
+            except BaseException as e:  # regi.py may not import cleanly; report it, keep going
+                modules[name] = (None, None, f"{type(e).__name__}: {e}")
+        module, load_seconds, error = modules[name]
+        entry = {"endpoint": endpoint, "module": name, "load_seconds": load_seconds}
+        if error:
+            entry["error"] = error
+        else:
+            plans = make_requests(endpoint, typists, args.requests + args.warmup, meta, args.digraphs)
+            entry.update(run_endpoint(_FlaskDriver(module.app), plans, args.concurrency, args.warmup))
+        results.append(entry)
+
+    with open(args.result, "w", encoding="utf-8") as f:
+        json.dump(results, f)
+    # Background pools (CV score, tuning) would otherwise keep the child alive until they finish
+    for worker in multiprocessing.active_children():
+        worker.terminate()
+    os._exit(0)
+
+
+def _seed_digraph_csvs():
+    real = os.path.join(BASE_DIR, "database")
+    return [os.path.join(real, "free-text.csv"), os.path.join(real, "database.csv")]
+
+
+def _seed_vector_csv():
+    return os.path.join(BASE_DIR, "database", "biometria.csv")
+
+
+def run_size(size, args):
+    typists = SyntheticTypists(_seed_digraph_csvs(), _seed_vector_csv(), seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix=f"bench-{size}-")
+    try:
+        start = time.perf_counter()
+        web, meta = build_dataset(workdir, size, typists, args.session_rows, args.sessions)
+        build_seconds = time.perf_counter() - start
+        result_path = os.path.join(workdir, "results.json")
+        command = [sys.executable, os.path.abspath(__file__), "--child", web, "--meta", json.dumps(meta),
+                   "--result", result_path,
+                   "--endpoints", *args.endpoints, "--requests", str(args.requests),
+                   "--warmup", str(args.warmup), "--concurrency", str(args.concurrency),
+                   "--digraphs", str(args.digraphs), "--seed", str(args.seed)]
+        with open(os.path.join(workdir, "child.log"), "w") as log:
+            proc = subprocess.run(command, stdout=log, stderr=log)
+        if proc.returncode != 0 or not os.path.isfile(result_path):
+            with open(os.path.join(workdir, "child.log")) as log:
+                tail = log.read()[-2000:]
+            raise RuntimeError(f"Benchmark child for size {size} failed:\n{tail}")
+        with open(result_path, encoding="utf-8") as f:
+            results = json.load(f)
+        for entry in results:
+            entry.update(size=size, build_seconds=build_seconds, **meta)
+        return results
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_live(args):
+    typists = SyntheticTypists(_seed_digraph_csvs(), _seed_vector_csv(), seed=args.seed)
+    meta = {"typists": 1, "sessions": 1, "users": 1}
+    results = []
+    for endpoint in args.endpoints:
+        url = args.auth_url if ENDPOINTS[endpoint] == "regi" else args.url
+        if not url:
+            continue
+        plans = make_requests(endpoint, typists, args.requests + args.warmup, meta, args.digraphs)
+        entry = {"endpoint": endpoint, "module": ENDPOINTS[endpoint], "size": "live", "url": url}
+        entry.update(run_endpoint(_HttpDriver(url), plans, args.concurrency, args.warmup))
+        results.append(entry)
+    return results
+
+
+# --- Cold start ---
+
+# Run in the child interpreter: import the app, mark the end of the import in
+# the -X importtime stream, then serve it
+_STARTUP_CHILD = """
+import os, sys, time
+os.chdir(sys.argv[1]); sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+module = __import__(sys.argv[2])
+print(f"--- imported in {time.perf_counter() - start:.6f}s ---", file=sys.stderr, flush=True)
+module.app.run(host="127.0.0.1", port=int(sys.argv[3]), threaded=True, use_reloader=False)
+"""
+
+
+def parse_importtime(text):
+    """(name, cumulative ms, depth) per module in `-X importtime` output; depth 0 is a top-level import."""
+    modules = []
+    for line in text.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2  # Two more spaces per nesting level
+        modules.append((name.strip(), int(cumulative_us) / 1000.0, depth))
+    return modules
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _poll(url, deadline, proc):
+    """Seconds (perf_counter) at which `url` first answers 200, or None if the process dies/times out."""
+    while time.perf_counter() < deadline and proc.poll() is None:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.005)
+    return None
+
+
+def measure_startup(web, app, timeout=120):
+    """One cold start of `app` served from `web`; times in seconds from process spawn."""
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    errors = tempfile.TemporaryFile(mode="w+")
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", _STARTUP_CHILD, web, app, str(port)],
+                            stdout=subprocess.DEVNULL, stderr=errors)
+    try:
+        deadline = start + timeout
+        first = _poll(base + "/", deadline, proc)
+        ready = _poll(base + "/ready", deadline, proc) if first is not None else None
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    errors.seek(0)
+    text = errors.read()
+    errors.close()
+    serving, _, rest = text.partition("--- imported in ")
+    import_seconds, _, warmup = rest.partition("s ---")
+    if first is None:
+        raise RuntimeError(f"{app} did not answer GET / within {timeout}s:\n{text[-2000:]}")
+    serving = parse_importtime(serving)
+    # Children are listed before their parent, one level deeper: the app's own imports
+    # are the lines right above it. (The warm-up thread may shift depths while it imports.)
+    direct, pending = [], []
+    for name, ms, depth in serving:
+        if name == app:
+            direct = [(n, m) for n, m, d in pending if d == depth + 1]
+        pending = [] if depth == 0 else pending + [(name, ms, depth)]
+    return {
+        "first_response_seconds": first - start,
+        "ready_seconds": ready - start if ready is not None else None,
+        "import_ms": float(import_seconds) * 1000.0 if import_seconds else None,
+        "top_imports": sorted(direct, key=lambda item: -item[1])[:10],
+        "serving_path_modules": len(serving),
+        "warmup_modules": len(parse_importtime(warmup)),
+        "off_path_imports": sorted({name.split(".")[0] for name, _, _ in serving} & set(OFF_SERVING_PATH)),
+    }
+
+
+def run_startup(args):
+    typists = SyntheticTypists(_seed_digraph_csvs(), _seed_vector_csv(), seed=args.seed)
+    results = []
+    for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+        print(f"Cold-starting apps with {size} rows...", file=sys.stderr)
+        workdir = tempfile.mkdtemp(prefix=f"startup-{size}-")
+        try:
+            web, meta = build_dataset(workdir, size, typists, args.session_rows, args.sessions)
+            for app in args.apps:
+                runs = [measure_startup(web, app) for _ in range(args.runs)]
+                ready = [r["ready_seconds"] for r in runs if r["ready_seconds"] is not None]
+                results.append({
+                    "startup": app, "size": size, "runs": args.runs,
+                    "first_response_ms": float(np.median([r["first_response_seconds"] for r in runs])) * 1000.0,
+                    "ready_ms": float(np.median(ready)) * 1000.0 if ready else None,
+                    "import_ms": float(np.median([r["import_ms"] for r in runs])),
+                    "serving_path_modules": runs[-1]["serving_path_modules"],
+                    "warmup_modules": runs[-1]["warmup_modules"],
+                    "off_path_imports": runs[-1]["off_path_imports"],
+                    "top_imports": runs[-1]["top_imports"],
+                    **meta,
+                })
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_startup_table(results, baseline=None, max_regression=None):
+    """Print the cold-start results; returns the list of problems (regressions, off-path imports)."""
+    previous = {(str(e.get("size")), e["startup"]): e for e in (baseline or {}).get("results", []) if "startup" in e}
+    problems = []
+    print(f"{'size':>9} {'app':<8} {'import ms':>10} {'first ms':>10} {'ready ms':>10} {'modules':>8}")
+    for entry in results:
+        ready = f"{entry['ready_ms']:>10.1f}" if entry["ready_ms"] is not None else f"{'never':>10}"
+        line = (f"{entry['size']:>9} {entry['startup']:<8} {entry['import_ms']:>10.1f} "
+                f"{entry['first_response_ms']:>10.1f} {ready} {entry['serving_path_modules']:>8}")
+        old = previous.get((str(entry["size"]), entry["startup"]))
+        if old:
+            for key in ("first_response_ms", "ready_ms"):
+                if old.get(key) and entry.get(key):
+                    change = 100.0 * (entry[key] / old[key] - 1)
+                    line += f"   {key.split('_')[0]} {change:+.1f}%"
+                    if max_regression is not None and change > max_regression:
+                        problems.append(f"{entry['startup']} ({entry['size']} rows): {key} {change:+.1f}%")
+        print(line)
+        if entry["off_path_imports"]:
+            problems.append(f"{entry['startup']} imports {', '.join(entry['off_path_imports'])} before serving")
+        print("          slowest imports: " + ", ".join(f"{name} {ms:.1f}" for name, ms in entry["top_imports"][:5]))
+    for problem in problems:
+        print(f"REGRESSION: {problem}")
+    return problems
+
+
+# --- Reporting ---
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def print_table(results, baseline=None):
+    previous = {}
+    for entry in (baseline or {}).get("results", []):
+        previous[(str(entry.get("size")), entry["endpoint"])] = entry
+    print(f"{'size':>9} {'endpoint':<20} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for entry in results:
+        if "error" in entry:
+            print(f"{entry['size']:>9} {entry['endpoint']:<20} skipped: {entry['error']}")
+            continue
+        line = (f"{entry['size']:>9} {entry['endpoint']:<20} {entry['throughput_rps']:>9.1f} "
+                f"{entry['p50_ms']:>9.2f} {entry['p95_ms']:>9.2f} {entry['p99_ms']:>9.2f} {entry['errors']:>7}")
+        old = previous.get((str(entry["size"]), entry["endpoint"]))
+        if old and old.get("p95_ms") and old.get("throughput_rps"):
+            line += (f"   p95 {100.0 * (entry['p95_ms'] / old['p95_ms'] - 1):+.1f}%"
+                     f"  req/s {100.0 * (entry['throughput_rps'] / old['throughput_rps'] - 1):+.1f}%")
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Flask endpoints with synthetic typists")
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="Comma-separated row counts for the synthetic datasets (e.g. up to 1000000)")
+    parser.add_argument("--endpoints", nargs="+", default=list(ENDPOINTS), choices=list(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=200, help="Timed requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=20, help="Untimed requests sent first")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--digraphs", type=int, default=3, help="Digraphs per /predict call (typing.dnn takes 3)")
+    parser.add_argument("--session-rows", type=int, default=100, help="Digraphs per synthetic session")
+    parser.add_argument("--sessions", type=int, default=10, help="Sessions per synthetic typist")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="Benchmark a running server.py at this URL instead")
+    parser.add_argument("--auth-url", help="Benchmark a running regi.py at this URL instead")
+    parser.add_argument("--out", help="Write the JSON report here")
+    parser.add_argument("--compare", help="Previous JSON report to show deltas against")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch datasets")
+    parser.add_argument("--startup", action="store_true", help="Measure cold start of the apps instead")
+    parser.add_argument("--apps", nargs="+", default=list(STARTUP_APPS), choices=STARTUP_APPS,
+                        help="Apps to cold-start (--startup)")
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts per app; medians are reported (--startup)")
+    parser.add_argument("--max-regression", type=float, default=25.0,
+                        help="With --startup --compare: fail if a median gets slower by more than this percent")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--meta", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return _child(args)
+
+    if args.startup:
+        results = run_startup(args)
+    elif args.url or args.auth_url:
+        results = run_live(args)
+    else:
+        results = []
+        for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+            print(f"Benchmarking {size} rows...", file=sys.stderr)
+            results.extend(run_size(size, args))
+
+    report = {
+        "revision": _git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("child", "meta", "result")},
+        "results": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    problems = []
+    if args.startup:
+        problems = print_startup_table(results, baseline, args.max_regression if baseline else None)
+    else:
+        print_table(results, baseline)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.out}", file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
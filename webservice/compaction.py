@@ -0,0 +1,410 @@
+"""
+Compaction of the typing CSVs: free-text.csv (base) + the extended append file.
+
+    python compaction.py database/free-text.csv database/free-text-new.csv
+    python compaction.py database/free-text.csv --participant p101 [--session 2]
+
+The base and the extended rows are merged, exact duplicates dropped (same
+participant, session, keys and timings), and a new base is written sorted by
+participant and session (file order is kept inside a session) together with
+a sidecar offset index (<base>.idx): participant -> byte range, and per
+session byte ranges inside it. Both are swapped in with os.replace() and the
+extended file is cut back to its header plus whatever was appended while the
+new base was being built, so reading one participant afterwards is a single
+seek and one contiguous read.
+
+Appenders (CsvAppender) keep working throughout: the rows are read without a
+lock and the extended file is only locked for the final swap, where it is
+replaced by a new file (appenders that were waiting for the lock notice the
+new inode and reopen). A crash between the two swaps leaves rows in both
+files; the next compaction removes those duplicates.
+"""
+import os
+import io
+import csv
+import sys
+import json
+import time
+import argparse
+import threading
+import logging
+
+from metrics import REGISTRY, Counter, stage
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, compaction is refused
+    fcntl = None
+
+COMPACTIONS = REGISTRY.register(Counter(
+    "kdt_compactions_total", "Compaction runs by outcome (done, skipped, failed).", ("result",)))
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+
+def index_path(base_csv):
+    return base_csv + INDEX_SUFFIX
+
+
+def _session_key(session):
+    session = session.strip()
+    return (0, int(session), "") if session.isdigit() else (1, 0, session)
+
+
+def _read_csv(data, header=None):
+    """(header, rows) of CSV bytes; the first record is the header unless one is given."""
+    # No skipinitialspace: a typed space (" ") is a valid key
+    reader = csv.reader(io.StringIO(data.decode("utf-8"), newline=""))
+    if header is None:
+        for first in reader:
+            if first:
+                header = [h.strip() for h in first]
+                break
+    return header, [row for row in reader if row]
+
+
+def _whole_lines(data):
+    end = data.rfind(b"\n")
+    return data[:end + 1] if end >= 0 else b""
+
+
+def _header_length(data):
+    """Bytes taken by the header line (including its line break)."""
+    end = data.find(b"\n")
+    return end + 1 if end >= 0 else len(data)
+
+
+class Compactor:
+    """Merges the extended CSV into a sorted, deduplicated, indexed base CSV."""
+
+    def __init__(self, base_csv, ext_csv):
+        self.base_csv = base_csv
+        self.ext_csv = ext_csv
+        self.index_path = index_path(base_csv)
+        self.lock_path = base_csv + ".compact.lock"
+
+    def compact(self):
+        """Run one compaction; returns a stats dict, or None if another process is compacting."""
+        if fcntl is None:
+            raise OSError("Compaction needs fcntl.flock to coordinate with the CSV appenders")
+        lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            with stage("compaction"):
+                return self._compact()
+        finally:
+            os.close(lock_fd)  # Also releases the flock
+
+    def _compact(self):
+        started = time.perf_counter()
+        base_stat = os.stat(self.base_csv)
+        with open(self.base_csv, "rb") as f:
+            base_data = f.read()
+        header, base_rows = _read_csv(base_data)
+        if not header:
+            raise ValueError(f"{self.base_csv} has no header")
+
+        # 1. Everything appended so far, read without blocking the appenders
+        ext_stat = os.stat(self.ext_csv) if os.path.isfile(self.ext_csv) else None
+        ext_data = b""
+        if ext_stat is not None:
+            with open(self.ext_csv, "rb") as f:
+                ext_data = _whole_lines(f.read())
+        ext_header, ext_rows = _read_csv(ext_data) if ext_data else (None, [])
+        ext_header_len = _header_length(ext_data) if ext_data else 0
+        merged_header, rows, dropped = self._merge(header, base_rows, ext_header, ext_rows)
+
+        # 2. The new base and its index, next to the old ones
+        tmp_base = self.base_csv + ".compact.tmp"
+        tmp_index = self.index_path + ".tmp"
+        index = self._write_base(tmp_base, merged_header, rows)
+        st = os.stat(tmp_base)  # os.replace keeps inode, size and mtime
+        index["base"] = {"inode": st.st_ino, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        with open(tmp_index, "w", encoding="utf-8") as f:
+            json.dump(index, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+
+        # 3. Swap, holding the appenders' lock only for this part
+        tail = b""
+        tmp_ext = self.ext_csv + ".compact.tmp"
+        fd = os.open(self.ext_csv, os.O_RDONLY) if ext_stat is not None else None
+        try:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                st = os.fstat(fd)
+                if st.st_ino != ext_stat.st_ino or st.st_size < len(ext_data):
+                    raise RuntimeError(f"{self.ext_csv} was replaced or truncated during compaction")
+                tail = os.pread(fd, st.st_size - len(ext_data), len(ext_data))
+                with open(tmp_ext, "wb") as f:
+                    # The header and the rows appended since step 1
+                    f.write(ext_data[:ext_header_len] + tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+            cur = os.stat(self.base_csv)
+            if (cur.st_ino, cur.st_size, cur.st_mtime_ns) != (base_stat.st_ino, base_stat.st_size, base_stat.st_mtime_ns):
+                raise RuntimeError(f"{self.base_csv} changed during compaction")
+            os.replace(tmp_base, self.base_csv)
+            os.replace(tmp_index, self.index_path)
+            if fd is not None:
+                os.replace(tmp_ext, self.ext_csv)
+            _fsync_dir(os.path.dirname(os.path.abspath(self.base_csv)))
+        except BaseException:
+            for path in (tmp_base, tmp_index, tmp_ext):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            raise
+        finally:
+            if fd is not None:
+                os.close(fd)  # Also releases the flock
+
+        stats = {
+            "rows_in": len(base_rows) + len(ext_rows),
+            "rows_out": len(rows),
+            "duplicates": len(base_rows) + len(ext_rows) - len(rows) - dropped,
+            "dropped": dropped,
+            "participants": len(index["participants"]),
+            "tail_bytes": len(tail),
+            "seconds": time.perf_counter() - started,
+        }
+        logging.info(f"Compacted {self.ext_csv} into {self.base_csv}: {stats}")
+        return stats
+
+    @staticmethod
+    def _merge(header, base_rows, ext_header, ext_rows):
+        """Base + extended rows in the base column order, deduplicated and sorted; (header, rows, dropped)."""
+        merged = list(header)
+        for name in ext_header or ():
+            if name and name not in merged:
+                merged.append(name)
+        try:
+            p_col, s_col = merged.index("participant"), merged.index("session")
+        except ValueError:
+            raise ValueError("CSV header needs 'participant' and 'session' columns")
+
+        def aligned(source_header, rows):
+            if source_header == merged:
+                return rows
+            # Map by column name so a differently ordered header still lines up
+            positions = [source_header.index(name) if name in source_header else None for name in merged]
+            return [[row[i] if i is not None and i < len(row) else "" for i in positions] for row in rows]
+
+        seen = set()
+        kept = []
+        dropped = 0
+        for row in aligned(header, base_rows) + (aligned(ext_header, ext_rows) if ext_header else []):
+            row = row + [""] * (len(merged) - len(row))
+            if not row[p_col].strip() or not row[s_col].strip():
+                dropped += 1  # Incomplete: TypingIndex skips these too
+                continue
+            key = tuple(v.strip() or v for v in row)  # A space is a key, not padding
+            if key in seen:
+                continue
+            seen.add(key)
+            kept.append(row)
+        # sort() is stable: rows of one session keep their file order
+        kept.sort(key=lambda r: (r[p_col].strip(), _session_key(r[s_col])))
+        return merged, kept, dropped
+
+    @staticmethod
+    def _write_base(path, header, rows):
+        """Write the sorted rows; returns the offset index (without the base stat)."""
+        p_col, s_col = header.index("participant"), header.index("session")
+        participants = {}
+        with open(path, "wb") as f:
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(header)
+            offset = f.write(buf.getvalue().encode("utf-8"))
+            header_length = offset
+            i = 0
+            while i < len(rows):
+                participant = rows[i][p_col].strip()
+                entry = participants[participant] = {"offset": offset, "length": 0, "rows": 0, "sessions": {}}
+                while i < len(rows) and rows[i][p_col].strip() == participant:
+                    session = rows[i][s_col].strip()
+                    buf = io.StringIO()
+                    writer = csv.writer(buf)
+                    start = i
+                    while i < len(rows) and rows[i][p_col].strip() == participant and rows[i][s_col].strip() == session:
+                        writer.writerow(rows[i])
+                        i += 1
+                    data = buf.getvalue().encode("utf-8")
+                    f.write(data)
+                    entry["sessions"][session] = [offset, len(data), i - start]
+                    offset += len(data)
+                entry["length"] = offset - entry["offset"]
+                entry["rows"] = sum(s[2] for s in entry["sessions"].values())
+            f.flush()
+            os.fsync(f.fileno())
+        return {"version": INDEX_VERSION, "header": header, "header_length": header_length,
+                "participants": participants}
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # Not supported on every filesystem
+    finally:
+        os.close(fd)
+
+
+# --- Reading ---
+
+def load_index(base_csv):
+    """The offset index of `base_csv`, or None if there is none or it belongs to another version of the file."""
+    try:
+        with open(index_path(base_csv), encoding="utf-8") as f:
+            index = json.load(f)
+        st = os.stat(base_csv)
+    except (OSError, ValueError):
+        return None
+    base = index.get("base") or {}
+    if index.get("version") != INDEX_VERSION or \
+            (base.get("inode"), base.get("size"), base.get("mtime_ns")) != (st.st_ino, st.st_size, st.st_mtime_ns):
+        return None
+    return index
+
+
+def read_participant(base_csv, participant, session=None, index=None):
+    """
+    Rows (dicts) of one participant, or one of its sessions, from a compacted
+    base: one seek and one read of the byte range in the index. Without a
+    valid index the whole file is scanned instead.
+    """
+    index = index or load_index(base_csv)
+    if index is None:
+        with open(base_csv, "rb") as f:
+            header, rows = _read_csv(f.read())
+        p_col, s_col = header.index("participant"), header.index("session")
+        return [dict(zip(header, r)) for r in rows
+                if r[p_col].strip() == participant and (session is None or r[s_col].strip() == str(session))]
+    entry = index["participants"].get(participant)
+    if entry is None:
+        return []
+    if session is None:
+        offset, length = entry["offset"], entry["length"]
+    else:
+        span = entry["sessions"].get(str(session))
+        if span is None:
+            return []
+        offset, length = span[0], span[1]
+    with open(base_csv, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    header, rows = _read_csv(data, index["header"])
+    return [dict(zip(header, r)) for r in rows]
+
+
+# --- Background job ---
+
+class CompactionJob:
+    """
+    Compacts in a daemon thread whenever the extended CSV has grown past
+    `min_bytes` (checked every `interval` seconds). Several processes may run
+    one; the lock in Compactor.compact() lets only one of them work at a time.
+    """
+
+    def __init__(self, base_csv, ext_csv, min_bytes=32 << 20, interval=300.0, on_done=None):
+        self.compactor = Compactor(base_csv, ext_csv)
+        self.min_bytes = min_bytes
+        self.interval = interval
+        self.on_done = on_done
+        self.last = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start (or, in a forked worker, restart) the thread. interval <= 0 disables the job."""
+        if self.interval > 0 and self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._wakeup = threading.Event()
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stopped,),
+                                            name="csv-compaction", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the thread once a compaction in progress has finished; start() runs it again."""
+        thread = self._thread
+        if thread is None or self._pid != os.getpid():
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        thread.join(timeout)
+        self._pid = None
+
+    def trigger(self):
+        """Check now rather than at the next interval."""
+        self._wakeup.set()
+
+    def due(self):
+        try:
+            return os.path.getsize(self.compactor.ext_csv) >= self.min_bytes
+        except OSError:
+            return False
+
+    def _run(self, stopped):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if stopped.is_set():
+                return
+            if not self.due():
+                continue
+            try:
+                stats = self.compactor.compact()
+            except Exception as e:
+                logging.error(f"Compaction of {self.compactor.ext_csv} failed: {e}")
+                COMPACTIONS.inc(result="failed")
+                continue
+            if stats is None:
+                COMPACTIONS.inc(result="skipped")
+                continue
+            COMPACTIONS.inc(result="done")
+            self.last = stats
+            if self.on_done is not None:
+                self.on_done(stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compact the typing CSVs into a sorted, indexed base file")
+    parser.add_argument("base", help="Base CSV (free-text.csv)")
+    parser.add_argument("ext", nargs="?", help="Extended CSV to merge into it (free-text-new.csv / database.csv)")
+    parser.add_argument("--participant", help="Print this participant's rows (read through the index) instead")
+    parser.add_argument("--session", help="With --participant: only this session")
+    args = parser.parse_args(argv)
+
+    if args.participant:
+        writer = csv.writer(sys.stdout)
+        for row in read_participant(args.base, args.participant, args.session):
+            writer.writerow(row.values())
+        return 0
+    if not args.ext:
+        parser.error("the extended CSV is required to compact")
+    stats = Compactor(args.base, args.ext).compact()
+    if stats is None:
+        print("Another process is compacting these files", file=sys.stderr)
+        return 1
+    print(json.dumps(stats, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
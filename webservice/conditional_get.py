@@ -0,0 +1,134 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from metrics import REGISTRY, Counter
+
+# Memoized GET bodies: at most MEMO_MAX_ENTRIES of them, each up to MEMO_MAX_BYTES
+MEMO_MAX_ENTRIES = int(os.environ.get("MEMO_MAX_ENTRIES", "256"))
+MEMO_MAX_BYTES = int(os.environ.get("MEMO_MAX_BYTES", str(1 << 20)))
+
+HTTP_CACHE = REGISTRY.register(Counter(
+    "kdt_http_cache_total", "Conditional GET outcomes (not_modified, hit, miss).", ("endpoint", "result")))
+
+
+class ResponseMemo:
+    """
+    LRU of rendered GET responses keyed by (endpoint, args, generation).
+    Entries of older generations are never looked up again and age out.
+    """
+
+    def __init__(self, max_entries=MEMO_MAX_ENTRIES, max_bytes=MEMO_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _capture(chunks, max_bytes, store):
+    """Pass chunks through, then hand the whole body to `store` if it stayed small."""
+    parts, size = [], 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size <= max_bytes:
+                parts.append(chunk)
+            else:
+                parts = None
+        yield chunk
+    if parts is not None:
+        store(b"".join(parts))
+
+
+def conditional_get(index, memo, build):
+    """
+    Serve the current GET request from the typing index with validation:
+    the ETag is derived from the index version (so every worker agrees on
+    it) and the request's URL and encoding, `If-None-Match` (or, without it,
+    `If-Modified-Since`) is answered with 304 before anything is built, and
+    2xx bodies are memoized per (endpoint, args, version). `build()`
+    returns the normal response; streamed bodies are memoized as they go out.
+
+    HTTP dates have one-second granularity, so Last-Modified is only sent,
+    and If-Modified-Since only honoured, once the data has been unchanged
+    for a full second (RFC 7232 2.2.2): until then another append within
+    the same second would be hidden behind a 304, and only the ETag is used.
+    """
+    from flask import request, Response
+
+    generation, tag, last_modified = index.version()
+    gzip = "gzip" in request.headers.get("Accept-Encoding", "").lower()
+    args = tuple(sorted(request.args.items(multi=True)))
+    key = (request.path, args, gzip)
+    etag = hashlib.sha1(repr((key, tag)).encode("utf-8")).hexdigest()[:32]
+    endpoint = request.url_rule.rule if request.url_rule is not None else request.path
+    if last_modified is not None and time.time() - last_modified < 1:
+        last_modified = None  # Still within its second: not a usable validator yet
+
+    def validated(response):
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.headers["Cache-Control"] = "no-cache"  # Always revalidate, 304s are cheap
+        return response
+
+    if request.if_none_match:
+        not_modified = etag in request.if_none_match
+    else:
+        since = request.if_modified_since
+        not_modified = since is not None and last_modified is not None and int(last_modified) <= since.timestamp()
+    if not_modified:
+        HTTP_CACHE.inc(endpoint=endpoint, result="not_modified")
+        return validated(Response(status=304))
+
+    memo_key = key + (generation, tag)  # Tag too: a re-read shard restarts its generation
+    hit = memo.get(memo_key)
+    if hit is not None:
+        HTTP_CACHE.inc(endpoint=endpoint, result="hit")
+        body, status, headers = hit
+        return validated(Response(body, status=status, headers=headers))
+
+    HTTP_CACHE.inc(endpoint=endpoint, result="miss")
+    response = build()
+    if not isinstance(response, Response):
+        from flask import make_response
+        response = make_response(response)
+    if not 200 <= response.status_code < 300:
+        return response
+    headers = [(k, v) for k, v in response.headers.items() if k.lower() != "content-length"]
+
+    def store(body):
+        memo.put(memo_key, (body, response.status_code, headers))
+
+    if response.is_streamed:
+        response.response = _capture(response.iter_encoded(), memo.max_bytes, store)
+    else:
+        body = response.get_data()
+        if len(body) <= memo.max_bytes:
+            store(body)
+    return validated(response)
@@ -0,0 +1,204 @@
+import os
+import io
+import csv
+import time
+import queue
+import atexit
+import threading
+import logging
+from concurrent.futures import Future
+
+from metrics import stage, CSV_LOCK_WAIT_SECONDS
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialised within this process
+    fcntl = None
+
+_FLUSH = object()  # Queue marker: write out everything queued before it
+_STOP = object()
+
+
+class CsvAppender:
+    """
+    Write-behind, group-commit appender for a CSV file.
+
+    append() only queues rows; a single writer thread gathers them until
+    `max_rows` are waiting or `max_delay` seconds have passed since the first
+    one, then writes the whole batch with one write() and one fsync. The file
+    is held under an exclusive flock() while a batch is written, so several
+    worker processes (each with its own appender) can share one CSV without
+    interleaving or tearing each other's rows.
+
+    Callers that must know their rows are on disk pass durable=True (or
+    construct the appender with durable=True): append() then blocks until the
+    batch holding them has been fsynced, and a waiting durable row closes the
+    batch immediately instead of waiting out the delay.
+
+    append() may name another file than `path` (ShardedAppender uses one
+    appender for many shard files); a batch then gets one write and one fsync
+    per file, each under that file's own lock.
+
+    A missing file is created, as open(path, "a") would; with a `header` row
+    it is written first into any file that is still empty.
+    """
+
+    def __init__(self, path, max_rows=256, max_delay=0.05, durable=False, encoding="utf-8", lock_label=None,
+                 header=None):
+        self.path = path
+        self.header = list(header) if header else None
+        self.lock_label = lock_label or os.path.basename(path or "")
+        self.max_rows = max(1, max_rows)
+        self.max_delay = max_delay
+        self.durable = durable
+        self.encoding = encoding
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None   # Process the writer runs in (a forked worker starts its own)
+        self._start_lock = threading.Lock()
+        self.batches = 0   # Batches written (one fsync each)
+        self.rows = 0      # Rows written
+
+    def start(self):
+        with self._start_lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    self._queue = queue.Queue()  # Forked: the parent's writer did not come along
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="csv-appender", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        return self
+
+    def append(self, rows, durable=None, timeout=None, path=None):
+        """
+        Queue `rows` (lists of values) for appending to `path` (default: the
+        appender's file). Returns a Future that resolves to the number of rows
+        written once they are fsynced. With durable=True this waits for that
+        and re-raises any write error.
+        """
+        durable = self.durable if durable is None else durable
+        path = path or self.path
+        if path is None:
+            raise ValueError("append() needs a path: this appender has no default file")
+        if self._pid != os.getpid():
+            self.start()
+        future = Future()
+        self._queue.put((list(rows), durable, future, path))
+        if durable:
+            future.result(timeout)
+        return future
+
+    def flush(self, timeout=None):
+        """Block until every row queued so far is on disk."""
+        if self._pid != os.getpid():
+            self.start()
+        future = Future()
+        self._queue.put((_FLUSH, True, future, None))
+        future.result(timeout)
+
+    def close(self, timeout=None):
+        """Write out pending rows and stop the writer thread."""
+        thread = self._thread
+        if thread is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        self._queue.put((_STOP, True, None, None))
+        thread.join(timeout)
+
+    def _collect(self):
+        """Block for the first item, then gather more until a threshold closes the batch."""
+        batch = [self._queue.get()]
+        count = len(batch[0][0]) if isinstance(batch[0][0], list) else 0
+        deadline = time.monotonic() + self.max_delay
+        while not batch[-1][1] and count < self.max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            if isinstance(item[0], list):
+                count += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item in batch if item[0] is not _STOP]
+            pending = [item for item in items if item[2].set_running_or_notify_cancel()]
+            if pending:
+                self._commit(pending)
+            if len(items) != len(batch):
+                return
+
+    def _commit(self, items):
+        by_path = {}
+        for item in items:
+            by_path.setdefault(item[3], []).append(item)
+        for path, group in by_path.items():
+            if path is not None:
+                self._commit_file(path, group)
+        for rows, _, future, _ in by_path.get(None, ()):
+            future.set_result(0)  # Flush markers: everything queued before them is written now
+
+    def _commit_file(self, path, items):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        count = 0
+        for rows, _, _, _ in items:
+            writer.writerows(rows)
+            count += len(rows)
+        try:
+            if count:
+                self._write(path, buf.getvalue().encode(self.encoding))
+                self.batches += 1
+                self.rows += count
+        except Exception as e:
+            logging.error(f"Error appending {count} rows to {path}: {e}")
+            for _, _, future, _ in items:
+                future.set_exception(e)
+            return
+        for rows, _, future, _ in items:
+            future.set_result(len(rows))
+
+    def _open_locked(self, path):
+        """Open the CSV under flock; reopen if compaction replaced it while we waited."""
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            if fcntl is None:
+                return fd
+            with CSV_LOCK_WAIT_SECONDS.time(path=self.lock_label):
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _write(self, path, data):
+        fd = self._open_locked(path)
+        try:
+            try:
+                size = os.fstat(fd).st_size
+                if not size and self.header:
+                    # New (or emptied) file: the header goes first, under the same lock
+                    buf = io.StringIO()
+                    csv.writer(buf).writerow(self.header)
+                    data = buf.getvalue().encode(self.encoding) + data
+                elif size and hasattr(os, "pread") and os.pread(fd, 1, size - 1) != b"\n":
+                    # A writer died mid-row; end that row so ours stay parseable
+                    data = b"\r\n" + data
+                with stage("csv_write"):
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(fd, view):]
+                with stage("csv_fsync"):
+                    (getattr(os, "fdatasync", None) or os.fsync)(fd)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
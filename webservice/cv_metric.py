@@ -0,0 +1,92 @@
+import os
+import threading
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from knn_model import cross_val_accuracy
+from metrics import stage
+
+
+class BackgroundCVScore:
+    """
+    Cross-validated accuracy of a ResidentKNN, recomputed off the request path.
+
+    A daemon thread waits until it is notified, compares the model's data
+    generation with the one the cached score belongs to and, only if the data
+    changed, reruns the folds in parallel on a process pool. Readers get the
+    last finished value immediately (None until the first run completes).
+    """
+
+    def __init__(self, model, k=1, folds=5, workers=None):
+        self.model = model
+        self.k = k
+        self.folds = folds
+        self.workers = workers or min(folds, os.cpu_count() or 1)
+        self._value = None
+        self._generation = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._executor = None
+
+    @property
+    def value(self):
+        """Last computed accuracy (served as-is, never blocks)."""
+        return self._value
+
+    @property
+    def generation(self):
+        """Model data generation the cached value was computed for."""
+        return self._generation
+
+    def start(self):
+        """Start (or, in a forked worker, restart) the background thread."""
+        if self._pid != os.getpid():
+            if self._pid is not None:
+                # Forked: the parent's thread and process pool did not come along
+                self._wakeup = threading.Event()
+                self._executor = None
+            self._pid = os.getpid()
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stopped,), name="cv-score", daemon=True)
+            self._thread.start()
+        self.notify()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the thread (after a run in progress) and its process pool; start() resumes."""
+        thread = self._thread
+        if thread is None or self._pid != os.getpid():
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        thread.join(timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._pid = None
+
+    def notify(self):
+        """Signal that the dataset may have changed."""
+        self._wakeup.set()
+
+    def _run(self, stopped):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if stopped.is_set():
+                return
+            X, labels, generation = self.model.snapshot()
+            if generation == self._generation:
+                continue
+            try:
+                if self._executor is None and self.workers > 1:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                with stage("cross_validation"):
+                    score = cross_val_accuracy(X, labels, self.k, self.folds, executor=self._executor)
+            except Exception as e:
+                logging.error(f"Cross-validation failed for data generation {generation}: {e}")
+                continue
+            self._value, self._generation = score, generation
+            logging.info(f"Cross-validated accuracy {score} for data generation {generation} ({len(labels)} samples)")
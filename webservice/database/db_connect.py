@@ -0,0 +1,69 @@
+import logging
+import sqlite3 as sql
+
+from .db_pool import ConnectionPool, UserRepository
+
+DB_PATH = 'database.db'
+USER_CACHE_TTL = 60 # segundos que username <-> id ficam em cache
+
+# Pool limitado de conexoes persistentes (modo WAL), emprestadas a cada consulta e devolvidas
+pool = ConnectionPool(DB_PATH)
+users = UserRepository(pool, ttl=USER_CACHE_TTL)
+
+def create_db():
+    try:
+        users.create_table()
+        logging.info('DATABASE - Tabela criada corretamente')
+    except sql.Error:
+        logging.error('DATABASE - Conexão não pode ser sucedida')
+
+def drop_db():
+    try:
+        users.drop_table()
+        logging.info('DATABASE - Tabela deletada com sucesso!')
+    except sql.Error:
+        logging.error('DATABASE - Conexão negada ou banco não existe')
+
+def add_user_and_passw(username, password):
+    try:
+        id = users.add(username, password)
+        if id is None:
+            logging.warning('DATABASE - Username já existente!')
+            return 0, False
+        logging.info(f'DATABASE - Usuario criado, ID: {id}')
+        return id, True
+    except sql.Error:
+        logging.error('DATABASE - Erro no cadastro')
+
+def check_user_and_passw(username, password):
+    try:
+        row = users.credentials(username)
+        if row is None:
+            logging.error('DATABASE - check_user_and_pass: Usuario não existe no banco!')
+            return 3, False, 0
+        user_id, senha = row
+        if senha == password:
+            logging.warning(f'DATABASE - check_user_and_pass: Usuario e senha conferem, usuario autenticado!  USER_ID: {user_id} USER_NAME: {username}')
+            return 2, True, user_id
+        logging.warning(f'DATABASE - check_user_and_pass: Usuario existente porem senha não confere! USER_ID: {user_id} USER_NAME: {username}')
+        return 1, False, user_id
+    except sql.Error:
+        logging.error('DATABASE - Não foi possivel verificar o usuario e senha')
+
+def get_user_and_passw(id):
+    # `id` e a posicao da linha na tabela (como rows[id]), nao a chave primaria
+    try:
+        row = users.at(id) # So a linha pedida, sem ler a tabela inteira
+        if row is None:
+            logging.error('DATABASE - Não foi possivel obter os usuarios!')
+            return None
+        return row[0], row[1]
+    except sql.Error:
+        logging.error('DATABASE - Não foi possivel obter os usuarios!')
+        return None
+
+def get_user_id(username):
+    try:
+        return users.user_id(username)
+    except sql.Error:
+        logging.error('DATABASE - Não foi possivel obter o USER_ID no banco de dados!')
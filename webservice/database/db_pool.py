@@ -0,0 +1,209 @@
+import os
+import time
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """
+    Bounded pool of long-lived sqlite3 connections, checked out per call:
+
+        with pool.connection() as con:
+            ...
+
+    At most `size` connections are ever open in a process; a caller finding
+    them all in use waits up to `timeout` seconds for one to be returned.
+    Connections are never tied to a thread, so the dev server's thread per
+    request does not leave one behind per request. A forked worker starts
+    with an empty pool instead of reusing its parent's handles.
+
+    Every connection is opened in WAL mode with a busy timeout, so readers
+    in other threads/processes don't block on a writer, and keeps sqlite's
+    prepared-statement cache warm across requests.
+    """
+
+    def __init__(self, path, size=8, timeout=5.0, cached_statements=64):
+        self.path = path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()  # Most recently used first: its statement cache is warm
+        self._opened = 0
+        self._pid = os.getpid()
+
+    def _open(self):
+        con = sqlite3.connect(self.path, timeout=self.timeout, cached_statements=self.cached_statements,
+                              check_same_thread=False)  # Used by one caller at a time, from any thread
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+        return con
+
+    def _checkout(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the parent's connections are not ours to use (or close)
+                self._idle = queue.LifoQueue()
+                self._opened = 0
+                self._pid = os.getpid()
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            if self._opened < self.size:
+                self._opened += 1
+                opening = True
+            else:
+                opening = False
+        if opening:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"No free connection to {self.path} after {self.timeout}s") from None
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block."""
+        con = self._checkout()
+        pid = os.getpid()
+        try:
+            yield con
+        except BaseException:
+            if con.in_transaction:
+                con.rollback()
+            raise
+        finally:
+            if pid == self._pid:
+                self._idle.put(con)
+
+    def close(self):
+        """Close the idle connections (call when the pool is no longer used)."""
+        with self._lock:
+            idle, self._idle = self._idle, queue.LifoQueue()
+            while True:
+                try:
+                    idle.get_nowait().close()
+                except queue.Empty:
+                    break
+                self._opened -= 1
+
+    @property
+    def opened(self):
+        """Connections currently open (idle or checked out)."""
+        return self._opened
+
+
+class TTLCache:
+    """Tiny thread-safe key -> value cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl=60.0, max_size=4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if len(self._data) >= self.max_size:
+                now = time.monotonic()
+                self._data = {k: e for k, e in self._data.items() if e[1] >= now}
+                if len(self._data) >= self.max_size:
+                    self._data.clear()
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class UserRepository:
+    """
+    tb_usuario access over a ConnectionPool.
+
+    Lookups go through the UNIQUE index on username (or the primary key) and
+    select only the columns they need. username -> id is cached for `ttl`
+    seconds; misses are never cached, so a user registered by another process
+    is visible immediately.
+    """
+
+    def __init__(self, pool, ttl=60.0):
+        self.pool = pool
+        self._ids = TTLCache(ttl)
+
+    def create_table(self):
+        with self.pool.connection() as con, con:
+            con.execute("CREATE TABLE tb_usuario (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "username TEXT UNIQUE NOT NULL, password TEXT NOT NULL)")
+
+    def drop_table(self):
+        with self.pool.connection() as con, con:
+            con.execute("DROP TABLE tb_usuario")
+        self._ids.clear()
+
+    def add(self, username, password):
+        """Insert a user; returns the new id, or None if the username is taken."""
+        try:
+            with self.pool.connection() as con, con:
+                user_id = con.execute("INSERT INTO tb_usuario (username, password) VALUES (?, ?)",
+                                      (username, password)).lastrowid
+        except sqlite3.IntegrityError:
+            return None
+        self._remember(user_id, username)
+        return user_id
+
+    def credentials(self, username):
+        """(id, password) for `username`, or None."""
+        with self.pool.connection() as con:
+            row = con.execute("SELECT id, password FROM tb_usuario WHERE username = ?", (username,)).fetchone()
+        if row is not None:
+            self._remember(row[0], username)
+        return row
+
+    def user_id(self, username):
+        user_id = self._ids.get(username)
+        if user_id is None:
+            with self.pool.connection() as con:
+                row = con.execute("SELECT id FROM tb_usuario WHERE username = ?", (username,)).fetchone()
+            if row is None:
+                return None
+            user_id = row[0]
+            self._remember(user_id, username)
+        return user_id
+
+    def at(self, position):
+        """
+        (username, password) of the row at `position` in table order (negative
+        counts from the end, like a list index), or None past either end.
+        """
+        order = "ASC" if position >= 0 else "DESC"
+        offset = position if position >= 0 else -position - 1
+        with self.pool.connection() as con:
+            return con.execute(f"SELECT username, password FROM tb_usuario ORDER BY id {order} LIMIT 1 OFFSET ?",
+                               (offset,)).fetchone()
+
+    def _remember(self, user_id, username):
+        self._ids.put(username, user_id)
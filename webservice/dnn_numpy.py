@@ -0,0 +1,325 @@
+import os
+import sys
+import csv
+import argparse
+import logging
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Same flattening order dnn_wrapper expects: rows of digraphs, 5 timings each
+TIMING_KEYS = [
+    "DU.key1.key1",
+    "DD.key1.key2",
+    "DU.key1.key2",
+    "UD.key1.key2",
+    "UU.key1.key2",
+]
+
+
+class _Reader:
+    """Minimal reader for dlib's serialization primitives."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def int(self):
+        # First byte: low nibble = number of little-endian payload bytes, bit 7 = sign
+        control = self.data[self.pos]
+        size = control & 0x0F
+        start = self.pos + 1
+        value = int.from_bytes(self.data[start:start + size], "little")
+        self.pos = start + size
+        return -value if control & 0x80 else value
+
+    def string(self):
+        size = self.int()
+        value = self.data[self.pos:self.pos + size].decode("ascii")
+        self.pos += size
+        return value
+
+    def bool(self):
+        value = self.data[self.pos:self.pos + 1]
+        self.pos += 1
+        if value not in (b"0", b"1"):
+            raise ValueError(f"Corrupt bool at byte {self.pos - 1}")
+        return value == b"1"
+
+    def float(self):
+        # dlib stores floats as (mantissa, exponent); only the value matters here
+        mantissa, exponent = self.int(), self.int()
+        return mantissa * 2.0 ** exponent
+
+    def tensor(self):
+        version = self.int()
+        if version != 2:
+            raise ValueError(f"Unsupported tensor serialization version {version}")
+        shape = tuple(self.int() for _ in range(4))
+        count = shape[0] * shape[1] * shape[2] * shape[3]
+        end = self.pos + 4 * count
+        values = np.frombuffer(self.data, dtype="<f4", count=count, offset=self.pos)
+        self.pos = end
+        return values.astype(np.float32).reshape(shape) if count else np.zeros(shape, dtype=np.float32)
+
+    def alias(self):
+        version = self.int()
+        if version != 1:
+            raise ValueError(f"Unsupported alias_tensor version {version}")
+        return tuple(self.int() for _ in range(4))
+
+    def expect(self, tag):
+        value = self.string()
+        if value != tag:
+            raise ValueError(f"Expected '{tag}' but found '{value}' at byte {self.pos}")
+
+
+# --- Layers ---
+
+class Conv:
+    """dlib con_: 2-D cross-correlation with zero padding, stride and bias."""
+
+    def __init__(self, filters, biases, stride, padding):
+        self.filters = np.ascontiguousarray(filters, dtype=np.float32)   # [F, K, R, C]
+        self.biases = np.ascontiguousarray(biases, dtype=np.float32)     # [F]
+        self.stride = stride
+        self.padding = padding
+
+    def forward(self, x):
+        py, px = self.padding
+        sy, sx = self.stride
+        _, _, r, c = self.filters.shape
+        if py or px:
+            x = np.pad(x, ((0, 0), (0, 0), (py, py), (px, px)))
+        windows = sliding_window_view(x, (r, c), axis=(2, 3))[:, :, ::sy, ::sx]  # [N, K, OR, OC, R, C]
+        out = np.tensordot(windows, self.filters, axes=([1, 4, 5], [1, 2, 3]))   # [N, OR, OC, F]
+        out += self.biases
+        return np.ascontiguousarray(out.transpose(0, 3, 1, 2))
+
+    def __repr__(self):
+        f, k, r, c = self.filters.shape
+        return f"con({f} filters, {r}x{c}, stride={self.stride}, padding={self.padding})"
+
+
+class Relu:
+    def forward(self, x):
+        return np.maximum(x, 0, out=x)
+
+    def __repr__(self):
+        return "relu"
+
+
+class FullyConnected:
+    """dlib fc_: output = flatten(x) @ W + b."""
+
+    def __init__(self, weights, biases):
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)  # [inputs, outputs]
+        self.biases = np.ascontiguousarray(biases, dtype=np.float32)    # [outputs]
+
+    def forward(self, x):
+        x = x.reshape(len(x), -1)
+        if x.shape[1] != self.weights.shape[0]:
+            raise RuntimeError(
+                f"Input size mismatch: fc layer expects {self.weights.shape[0]} values, got {x.shape[1]}")
+        out = x @ self.weights
+        out += self.biases
+        return out
+
+    def __repr__(self):
+        return f"fc({self.weights.shape[0]} -> {self.weights.shape[1]})"
+
+
+def _read_con(r):
+    params = r.tensor().reshape(-1)
+    num_filters, nr, nc, stride_y, stride_x, pad_y, pad_x = (r.int() for _ in range(7))
+    filters_shape = r.alias()
+    biases_shape = r.alias()
+    for _ in range(4):  # learning-rate / weight-decay multipliers
+        r.float()
+    use_bias = r.bool()
+    n_filters = int(np.prod(filters_shape))
+    filters = params[:n_filters].reshape(filters_shape)
+    biases = params[n_filters:n_filters + num_filters] if use_bias else np.zeros(num_filters, np.float32)
+    if filters_shape[0] != num_filters or filters_shape[2:] != (nr, nc):
+        raise ValueError(f"Inconsistent con_ layer: {filters_shape} vs {num_filters}x{nr}x{nc}")
+    return Conv(filters, biases, (stride_y, stride_x), (pad_y, pad_x))
+
+
+def _read_fc(r):
+    num_outputs = r.int()
+    num_inputs = r.int()
+    params = r.tensor().reshape(-1)
+    r.alias()
+    r.alias()
+    bias_mode = r.int()
+    for _ in range(4):
+        r.float()
+    use_bias = r.bool()
+    if bias_mode != 0:
+        raise ValueError("Only fc layers with FC_HAS_BIAS are supported")
+    n_weights = num_inputs * num_outputs
+    weights = params[:n_weights].reshape(num_inputs, num_outputs)
+    biases = params[n_weights:n_weights + num_outputs] if use_bias else np.zeros(num_outputs, np.float32)
+    return FullyConnected(weights, biases)
+
+
+_LAYER_READERS = {
+    "con_5": _read_con,
+    "fc_3": _read_fc,
+    "relu_": lambda r: Relu(),
+}
+
+
+def _read_layer_details(r):
+    tag = r.string()
+    reader = _LAYER_READERS.get(tag)
+    if reader is None:
+        raise ValueError(f"Unsupported layer type '{tag}'")
+    return reader(r)
+
+
+class DnnModel:
+    """
+    NumPy implementation of the typing.dnn network
+    (loss_multiclass_log over con/relu/fc layers with an input<matrix> layer).
+
+    All weights are materialised once as contiguous float32 arrays and
+    forward() scores a whole [N, rows, 5] batch with a handful of BLAS calls.
+    """
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            r = _Reader(f.read())
+        if r.int() != 1:
+            raise ValueError("Unsupported add_loss_layer version")
+        r.expect("loss_multiclass_log_")
+
+        # Nested add_layer objects write their versions outermost first
+        outer = 0
+        while True:
+            version = r.int()
+            if version == 3:
+                break  # Innermost layer, the one attached to the input
+            if version != 2:
+                raise ValueError(f"Unsupported add_layer version {version}")
+            outer += 1
+
+        r.expect("input<matrix>")
+        layers = [_read_layer_details(r)]
+        for _ in range(3):
+            r.bool()
+        for _ in range(3):
+            r.tensor()  # Gradient/cached buffers, empty in a saved net
+        r.int()  # sample expansion factor
+        for _ in range(outer):
+            layers.append(_read_layer_details(r))
+            for _ in range(3):
+                r.bool()
+            for _ in range(3):
+                r.tensor()
+        if r.pos != len(r.data):
+            raise ValueError(f"Trailing data after network ({len(r.data) - r.pos} bytes)")
+        return cls(layers)
+
+    @property
+    def num_classes(self):
+        return next(l for l in reversed(self.layers) if isinstance(l, FullyConnected)).weights.shape[1]
+
+    def forward(self, batch):
+        """Raw class scores for a [N, rows, cols] batch of digraph matrices."""
+        x = np.asarray(batch, dtype=np.float32)
+        if x.ndim != 3:
+            raise RuntimeError(f"Expected a [N, rows, cols] batch, got shape {x.shape}")
+        x = x[:, None, :, :]  # input<matrix> -> one channel
+        for layer in self.layers:
+            x = layer.forward(x)
+        return x
+
+    def predict_batch(self, samples, rows, cols):
+        """Class index for each flat row-major sample of rows*cols values."""
+        batch = np.asarray(samples, dtype=np.float32)
+        if batch.ndim != 2 or batch.shape[1] != rows * cols:
+            raise RuntimeError(f"Input size mismatch: expected {rows}x{cols} values per sample")
+        return np.argmax(self.forward(batch.reshape(-1, rows, cols)), axis=1).tolist()
+
+    def predict(self, flat, rows, cols):
+        return self.predict_batch([flat], rows, cols)[0]
+
+    def __repr__(self):
+        return "DnnModel(" + " -> ".join(map(repr, self.layers)) + ")"
+
+
+# --- dnn_wrapper compatible module API ---
+
+_model = None
+
+
+def load_model(path):
+    global _model
+    _model = DnnModel.load(path)
+    logging.debug(f"Loaded {_model}")
+
+
+def predict(flat, rows, cols):
+    if _model is None:
+        raise RuntimeError("Model not loaded")
+    return _model.predict(flat, rows, cols)
+
+
+def predict_batch(samples, rows, cols):
+    if _model is None:
+        raise RuntimeError("Model not loaded")
+    return _model.predict_batch(samples, rows, cols)
+
+
+# --- Parity check against the native wrapper ---
+
+def _csv_samples(path, rows, limit):
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f, skipinitialspace=True)
+        values = []
+        for row in reader:
+            row = {k.strip(): v for k, v in row.items() if k}
+            try:
+                values.append([float(row[k]) for k in TIMING_KEYS])
+            except (KeyError, TypeError, ValueError):
+                continue
+    samples = [sum(values[i:i + rows], []) for i in range(0, len(values) - rows + 1, rows)]
+    return samples[:limit]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run typing.dnn with NumPy and compare against dnn_wrapper")
+    parser.add_argument("model", help="Path to typing.dnn")
+    parser.add_argument("--csv", help="Typing CSV to draw samples from (random samples otherwise)")
+    parser.add_argument("--rows", type=int, default=3, help="Digraphs per sample")
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    model = DnnModel.load(args.model)
+    print(model)
+    if args.csv:
+        samples = _csv_samples(args.csv, args.rows, args.samples)
+    else:
+        samples = np.random.default_rng(0).normal(200, 150, (args.samples, args.rows * 5)).tolist()
+    ours = model.predict_batch(samples, args.rows, 5)
+    print(f"Scored {len(samples)} samples")
+
+    try:
+        import dnn_wrapper
+    except ImportError:
+        print("dnn_wrapper not importable here; skipping parity check")
+        return 0
+    dnn_wrapper.load_model(args.model)
+    theirs = [dnn_wrapper.predict(s, args.rows, 5) for s in samples]
+    mismatches = sum(a != b for a, b in zip(ours, theirs))
+    print(f"Parity: {len(samples) - mismatches}/{len(samples)} predictions agree")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
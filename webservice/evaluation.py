@@ -0,0 +1,341 @@
+"""
+Offline evaluation of the 2FA KNN on biometria.csv: the FAR/FRR/accuracy table
+of the README (20-, 10- and 5-user data sets), for several K and distance
+metrics, with ROC curves and the equal error rate.
+
+    python evaluation.py
+    python evaluation.py --users 20 10 5 --repeats 10 --k 1 3 5 --metrics manhattan euclidean --json eval.json
+    python evaluation.py --shards database/biometria_shards --scale 100 --workers 8
+
+For each data-set size, `--repeats` random user subsets are drawn; each
+subset is split into `--folds` stratified folds. Per fold, every held-out
+sample attempts to log in as every user of the subset: as its own user it is
+a genuine access, as anyone else an impostor one. An attempt is accepted
+like in regi.py's 1:1 mode (ClaimVerifier): its score (mean distance to the
+K nearest templates of the claimed user) must be within that user's
+threshold, the median plus --spread MADs of the leave-one-out scores among
+the user's own templates, times --margin. Accuracy is the share of correct decisions; the 1:N column
+is the KNN identification accuracy over the same folds.
+
+Subset/fold combinations are scored on a process pool, with one distance
+matrix per metric and fold shared by every K. --scale N adds N-1 jittered
+copies of every user (as new users) to check the run time on larger data.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from knn_model import ResidentKNN, pairwise_distances, robust_threshold, vote
+from shard_store import ShardStore
+
+METRICS = ("manhattan", "euclidean", "chebyshev")
+UNREGISTERED = "999"  # regi.py files training samples of unknown usernames under this id
+
+_X = None       # Dataset of a pool worker, set once by _init_worker
+_labels = None
+
+
+# --- Data ---
+
+def load_dataset(csv_path, shards=None, exclude=(UNREGISTERED,), min_samples=2):
+    """(X, labels) from biometria.csv (or its shards), without excluded users and users with too few samples."""
+    store = ShardStore(shards).open() if shards else None
+    X, labels, _ = ResidentKNN(csv_path, shards=store).load().snapshot()
+    labels = np.array(labels, dtype=object)
+    counts = {u: n for u, n in zip(*np.unique(labels, return_counts=True))}
+    keep = np.array([u not in exclude and counts[u] >= min_samples for u in labels], dtype=bool)
+    dropped = sorted(u for u in counts if u in exclude or counts[u] < min_samples)
+    if dropped:
+        logging.info(f"Leaving out users {', '.join(dropped)} (excluded or fewer than {min_samples} samples)")
+    return np.asarray(X[keep], dtype=np.float32), labels[keep].tolist()
+
+
+def scale_dataset(X, labels, factor, seed=0):
+    """Append factor-1 copies of every user (new ids) with timings jittered by 10% of each column's spread."""
+    if factor <= 1:
+        return X, labels
+    rng = np.random.default_rng(seed)
+    spread = np.nanstd(X, axis=0) * 0.1
+    parts, names = [X], list(labels)
+    for copy in range(1, factor):
+        parts.append(X + rng.normal(size=X.shape).astype(np.float32) * spread)
+        names.extend(f"{label}~{copy}" for label in labels)
+    return np.concatenate(parts), names
+
+
+# --- Plan ---
+
+def plan(labels, sizes, repeats, folds, seed=0):
+    """
+    Tasks (size, repeat, fold, train rows, test rows, users): user subsets are
+    drawn per size and repeat, and every user's samples are dealt into folds.
+    Sizes of 0 (or at least the number of users) mean every user, evaluated once.
+    """
+    rng = np.random.default_rng(seed)
+    by_user = {}
+    for i, label in enumerate(labels):
+        by_user.setdefault(label, []).append(i)
+    users = sorted(by_user)
+    tasks = []
+    for size in sizes:
+        everyone = not size or size >= len(users)
+        for repeat in range(1 if everyone else repeats):
+            subset = users if everyone else sorted(rng.choice(users, size, replace=False).tolist())
+            fold_of = {}
+            for user in subset:
+                rows = rng.permutation(by_user[user])
+                for j, row in enumerate(rows.tolist()):
+                    fold_of[row] = j % min(folds, len(rows))
+            rows = np.array(sorted(fold_of))
+            assigned = np.array([fold_of[r] for r in rows.tolist()])
+            for fold in range(folds):
+                test = rows[assigned == fold]
+                if len(test):
+                    tasks.append((size or len(users), repeat, fold, rows[assigned != fold], test, subset))
+    return tasks
+
+
+# --- Scoring (pool workers) ---
+
+def _init_worker(X, labels):
+    global _X, _labels
+    _X, _labels = X, labels
+
+
+def _k_scores(D, k):
+    """Mean of the k smallest values of every row of D (inf where a row has none)."""
+    if D.shape[1] == 0:
+        return np.full(D.shape[0], np.inf)
+    k = min(k, D.shape[1])
+    return np.partition(D, k - 1, axis=1)[:, :k].mean(axis=1)
+
+
+def _user_scores(D, columns, ks):
+    """
+    {k: (probes, users) matrix of _k_scores of every probe against each
+    user's templates}. Users with the same number of templates are scored
+    together on a (probes, users, templates) view, one partition per group.
+    """
+    scores = {k: np.full((D.shape[0], len(columns)), np.inf, dtype=np.float32) for k in ks}
+    groups = {}
+    for u, cols in enumerate(columns):
+        groups.setdefault(len(cols), []).append(u)
+    for n, members in groups.items():
+        if n == 0:
+            continue
+        block = D[:, np.concatenate([columns[u] for u in members])].reshape(D.shape[0], len(members), n)
+        top = min(max(ks), n)
+        if top < n:
+            block = np.partition(block, top - 1, axis=2)[:, :, :top]
+        block = np.sort(block, axis=2)
+        sums = np.cumsum(block, axis=2)
+        for k in ks:
+            kk = min(k, n)
+            scores[k][:, members] = sums[:, :, kk - 1] / kk
+    return scores
+
+
+def _thresholds(own_distances, k, margin, spread=2.0):
+    """
+    Per-user acceptance threshold from leave-one-out scores among the user's
+    own templates (`own_distances`: one template x template matrix per user).
+    Users with a single template get the median of the others.
+    """
+    thresholds = []
+    for own in own_distances:
+        own = own.copy()
+        np.fill_diagonal(own, np.inf)
+        loo = _k_scores(own, min(k, len(own) - 1)) if len(own) > 1 else np.empty(0)
+        threshold = robust_threshold(loo, spread)
+        thresholds.append(threshold * margin if threshold is not None else None)
+    known = [t for t in thresholds if t is not None]
+    fallback = float(np.median(known)) if known else np.inf
+    return np.array([fallback if t is None else t for t in thresholds])
+
+
+def evaluate_fold(task, ks, metrics, margin, spread=2.0):
+    """
+    Score one fold of one user subset for every (metric, K). Returns
+    {(metric, k): {counts..., "genuine": scores, "impostor": scores}}.
+    """
+    size, repeat, fold, train, test, users = task
+    labels = np.array(_labels, dtype=object)
+    train_labels, test_labels = labels[train], labels[test]
+    y_train = train_labels.tolist()
+    user_index = {u: j for j, u in enumerate(users)}
+    truth = np.array([user_index[u] for u in test_labels.tolist()])
+    own = np.zeros((len(test), len(users)), dtype=bool)
+    own[np.arange(len(test)), truth] = True
+    columns = [np.flatnonzero(train_labels == u) for u in users]
+
+    results = {}
+    for metric in metrics:
+        D = pairwise_distances(_X[test], _X[train], metric)
+        own_distances = [pairwise_distances(_X[train[cols]], _X[train[cols]], metric) for cols in columns]
+        user_scores = _user_scores(D, columns, ks)
+        for k in ks:
+            scores = user_scores[k]
+            accepted = scores <= _thresholds(own_distances, k, margin, spread)[None, :]
+            identified = sum(vote(y_train, row, k)[0] == t for row, t in zip(D, test_labels.tolist()))
+            results[(metric, k)] = {
+                "genuine_attempts": int(own.sum()),
+                "impostor_attempts": int((~own).sum()),
+                "false_rejects": int((own & ~accepted).sum()),
+                "false_accepts": int((~own & accepted).sum()),
+                "identified": int(identified),
+                "probes": len(test),
+                "genuine": scores[own].astype(np.float32),
+                "impostor": scores[~own].astype(np.float32),
+            }
+    return size, results
+
+
+# --- Aggregation ---
+
+def roc(genuine, impostor, points=101):
+    """
+    ROC of a score threshold (accept when score <= t): FAR/FRR at `points`
+    thresholds spread over the score quantiles, plus the equal error rate.
+    """
+    genuine = np.sort(genuine[np.isfinite(genuine)])
+    impostor = np.sort(impostor[np.isfinite(impostor)])
+    if not len(genuine) or not len(impostor):
+        return {"thresholds": [], "far": [], "frr": [], "eer": None, "eer_threshold": None}
+    # Impostor scores far outnumber genuine ones: the rates only change at a
+    # genuine score or one of the impostor quantiles, so those are the candidates
+    sampled = impostor[np.linspace(0, len(impostor) - 1, max(points, 4096)).astype(int)]
+    candidates = np.unique(np.concatenate([genuine, sampled]))
+    all_far = np.searchsorted(impostor, candidates, side="right") / len(impostor)
+    all_frr = 1.0 - np.searchsorted(genuine, candidates, side="right") / len(genuine)
+    i = int(np.argmin(np.abs(all_far - all_frr)))
+    merged = np.sort(np.concatenate([genuine, sampled]))
+    thresholds = np.unique(merged[np.linspace(0, len(merged) - 1, points).astype(int)])
+    far = np.searchsorted(impostor, thresholds, side="right") / len(impostor)
+    frr = 1.0 - np.searchsorted(genuine, thresholds, side="right") / len(genuine)
+    return {
+        "thresholds": thresholds.tolist(),
+        "far": far.tolist(),
+        "frr": frr.tolist(),
+        "eer": float((all_far[i] + all_frr[i]) / 2),
+        "eer_threshold": float(candidates[i]),
+    }
+
+
+def aggregate(fold_results, roc_points=101):
+    """Sum the folds per (users, metric, K) into table rows with rates and ROC data."""
+    totals = {}
+    for size, results in fold_results:
+        for (metric, k), r in results.items():
+            t = totals.setdefault((size, metric, k), {"genuine": [], "impostor": []})
+            for name, value in r.items():
+                if name in ("genuine", "impostor"):
+                    t[name].append(value)
+                else:
+                    t[name] = t.get(name, 0) + value
+    rows = []
+    for (size, metric, k), t in sorted(totals.items(), key=lambda item: (-item[0][0], item[0][1], item[0][2])):
+        attempts = t["genuine_attempts"] + t["impostor_attempts"]
+        errors = t["false_accepts"] + t["false_rejects"]
+        rows.append({
+            "users": size,
+            "metric": metric,
+            "k": k,
+            "genuine_attempts": t["genuine_attempts"],
+            "impostor_attempts": t["impostor_attempts"],
+            "false_accepts": t["false_accepts"],
+            "false_rejects": t["false_rejects"],
+            "far": t["false_accepts"] / t["impostor_attempts"] if t["impostor_attempts"] else None,
+            "frr": t["false_rejects"] / t["genuine_attempts"] if t["genuine_attempts"] else None,
+            "accuracy": 1 - errors / attempts if attempts else None,
+            "identification_accuracy": t["identified"] / t["probes"] if t["probes"] else None,
+            "roc": roc(np.concatenate(t["genuine"]), np.concatenate(t["impostor"]), roc_points),
+        })
+    return rows
+
+
+def run(X, labels, sizes=(20, 10, 5), repeats=5, folds=5, ks=(1,), metrics=("manhattan",),
+        margin=1.0, workers=None, seed=0, roc_points=101, spread=2.0):
+    """Plan, score on a process pool and aggregate; returns the table rows."""
+    tasks = plan(labels, sizes, repeats, folds, seed)
+    workers = workers or os.cpu_count() or 1
+    logging.info(f"Evaluating {len(tasks)} folds of {len(labels)} samples / {len(set(labels))} users "
+                 f"on {workers} processes")
+    if workers == 1:
+        _init_worker(X, labels)
+        fold_results = [evaluate_fold(task, ks, metrics, margin, spread) for task in tasks]
+    else:
+        fold_results = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(X, labels)) as executor:
+            futures = [executor.submit(evaluate_fold, task, ks, metrics, margin, spread) for task in tasks]
+            for future in as_completed(futures):
+                fold_results.append(future.result())
+    return aggregate(fold_results, roc_points)
+
+
+def _percent(value):
+    return f"{value * 100:.2f}%".replace(".", ",") if value is not None else "-"
+
+
+def print_table(rows, out=sys.stdout):
+    """The README results table, one line per (users, metric, K), plus the EER."""
+    print("| Users Data (Users) | Metric | K | True Access | False Access | The amount of FAR | The amount of FRR "
+          "| FAR (%) | FRR (%) | Accuracy | 1:N Accuracy | EER |", file=out)
+    print("| --- | --- | --- | --- | --- | --- | --- | --- | --- | --- | --- | --- |", file=out)
+    for r in rows:
+        print(f"| {r['users']} | {r['metric']} | {r['k']} | {r['genuine_attempts']} | {r['impostor_attempts']} "
+              f"| {r['false_accepts']} | {r['false_rejects']} | {_percent(r['far'])} | {_percent(r['frr'])} "
+              f"| {_percent(r['accuracy'])} | {_percent(r['identification_accuracy'])} "
+              f"| {_percent(r['roc']['eer'])} |", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FAR/FRR/accuracy/EER of the 2FA KNN on biometria.csv")
+    parser.add_argument("--data", default=os.path.join("database", "biometria.csv"))
+    parser.add_argument("--shards", help="Read a shard_store.py directory (e.g. database/biometria_shards) instead")
+    parser.add_argument("--users", type=int, nargs="+", default=[20, 10, 5],
+                        help="User-subset sizes (0 = every user)")
+    parser.add_argument("--repeats", type=int, default=5, help="Random subsets per size")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--k", type=int, nargs="+", default=[1])
+    parser.add_argument("--metrics", nargs="+", default=["manhattan"], choices=METRICS)
+    parser.add_argument("--margin", type=float, default=1.0, help="Threshold multiplier, as VERIFY_MARGIN in regi.py")
+    parser.add_argument("--spread", type=float, default=2.0,
+                        help="MADs above the median leave-one-out score, as VERIFY_SPREAD in regi.py")
+    parser.add_argument("--exclude", nargs="*", default=[UNREGISTERED], help="User ids left out")
+    parser.add_argument("--scale", type=int, default=1, help="Grow the data N times with jittered copies of every user")
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: CPU count)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--roc-points", type=int, default=101)
+    parser.add_argument("--json", help="Write the rows, with ROC curves, here")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    X, labels = load_dataset(args.data, args.shards, exclude=set(args.exclude))
+    X, labels = scale_dataset(X, labels, args.scale, args.seed)
+    if len(set(labels)) < 2:
+        print("Need at least two users with two samples each", file=sys.stderr)
+        return 1
+    rows = run(X, labels, args.users, args.repeats, args.folds, args.k, args.metrics,
+               args.margin, args.workers, args.seed, args.roc_points, args.spread)
+    print_table(rows)
+    elapsed = time.perf_counter() - start
+    print(f"\n{len(labels)} samples, {len(set(labels))} users, {elapsed:.2f}s", file=sys.stderr)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "samples": len(labels), "users": len(set(labels)),
+                       "seconds": elapsed, "rows": rows}, f, indent=2)
+        print(f"Wrote {args.json}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
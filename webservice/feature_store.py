@@ -0,0 +1,333 @@
+import os
+import csv
+import sys
+import argparse
+import threading
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialised within this process
+    fcntl = None
+
+# Column order of the five timing features, as in free-text.csv / database.csv
+TIMING_KEYS = [
+    "DU.key1.key1",
+    "DD.key1.key2",
+    "DU.key1.key2",
+    "UD.key1.key2",
+    "UU.key1.key2",
+]
+CSV_HEADER = ["participant", "session", "key1", "key2", *TIMING_KEYS]
+
+FEATURES_FILE = "features.f32"        # float32 [N, 5]
+KEYS_FILE = "keys.i32"                # int32   [N, 2]  (code points of key1, key2)
+IDS_FILE = "ids.i32"                  # int32   [N, 2]  (participant id, session)
+PARTICIPANTS_FILE = "participants.txt"  # participant id -> name, one per line
+LOCK_FILE = "store.lock"              # flock()ed by writers of every process
+
+_COLUMNS = (
+    (FEATURES_FILE, np.float32, len(TIMING_KEYS)),
+    (KEYS_FILE, np.int32, 2),
+    (IDS_FILE, np.int32, 2),
+)
+
+
+class FeatureStore:
+    """
+    Append-only columnar store for typing digraphs.
+
+    The five timing features live in one packed float32 file, key codes and
+    participant/session ids in parallel int32 files. Readers memory-map the
+    files, so a session stored contiguously is returned as a view into the map
+    without copying or parsing any text. Writers hold an exclusive flock() on
+    store.lock, so worker processes sharing a store keep the columns aligned
+    and agree on participant ids.
+
+    The CSVs stay the source of truth and the web apps do not write here:
+    build or extend a store from them with `python feature_store.py DIR
+    import CSV...` for offline analysis, and export it back with `export`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._names = []          # participant id -> name
+        self._ids = {}            # participant name -> id
+        self._spans = {}          # (participant id, session) -> [(start, stop), ...]
+        self._rows = 0            # rows indexed so far
+        self._maps = None         # (features, keys, ids) memmaps covering _rows
+        self._mapped_rows = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    # --- Opening / refreshing ---
+
+    def open(self):
+        """Create the store directory if needed, repair torn appends and index the rows."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, self._file_lock():
+            for name, _, _ in _COLUMNS:
+                open(self._path(name), "ab").close()
+            self._repair()
+            self._names, self._ids = [], {}
+            self._spans, self._rows = {}, 0
+            self._maps, self._mapped_rows = None, 0
+            self._load_participants()
+            self._index_new_rows()
+        logging.info(f"Feature store opened at {self.directory}: {self._rows} rows, {len(self._names)} participants")
+        return self
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive flock on the store's lock file, shared by every process writing to it."""
+        fd = os.open(self._path(LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # Also releases the flock
+
+    def _repair(self):
+        """Cut every column back to the rows all of them have. The file lock must be held."""
+        rows = self._complete_rows()
+        # An interrupted append may have left one column longer than the others
+        for name, dtype, width in _COLUMNS:
+            size = rows * width * np.dtype(dtype).itemsize
+            if os.path.getsize(self._path(name)) != size:
+                logging.warning(f"Truncating torn append in {self._path(name)} to {rows} rows")
+                with open(self._path(name), "r+b") as f:
+                    f.truncate(size)
+
+    def refresh(self):
+        """Pick up rows appended by another process since the last call."""
+        with self._lock:
+            if self._complete_rows() != self._rows:
+                self._load_participants()
+                self._index_new_rows()
+
+    def _complete_rows(self):
+        counts = []
+        for name, dtype, width in _COLUMNS:
+            try:
+                size = os.path.getsize(self._path(name))
+            except FileNotFoundError:
+                return 0
+            counts.append(size // (width * np.dtype(dtype).itemsize))
+        return min(counts)
+
+    def _load_participants(self):
+        path = self._path(PARTICIPANTS_FILE)
+        if not os.path.isfile(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            names = f.read().split("\n")[:-1]  # Last element is the text after the final newline
+        for name in names[len(self._names):]:
+            self._ids[name] = len(self._names)
+            self._names.append(name)
+
+    def _index_new_rows(self):
+        rows = self._complete_rows()
+        if rows == self._rows:
+            return
+        _, _, ids = self._map(rows)
+        new_ids = np.asarray(ids[self._rows:rows])
+        # Vectorised run detection: one Python iteration per contiguous (participant, session) block
+        change = np.flatnonzero(np.any(new_ids[1:] != new_ids[:-1], axis=1)) + 1
+        starts = np.concatenate(([0], change))
+        stops = np.concatenate((change, [len(new_ids)]))
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            key = (int(new_ids[start, 0]), int(new_ids[start, 1]))
+            self._add_span(key, self._rows + start, self._rows + stop)
+        self._rows = rows
+
+    def _add_span(self, key, start, stop):
+        spans = self._spans.setdefault(key, [])
+        if spans and spans[-1][1] == start:
+            spans[-1] = (spans[-1][0], stop)
+        else:
+            spans.append((start, stop))
+
+    def _map(self, rows):
+        """Return memmaps of the three columns covering at least `rows` rows."""
+        if self._maps is None or self._mapped_rows < rows:
+            if rows == 0:
+                self._maps = tuple(np.empty((0, width), dtype=dtype) for _, dtype, width in _COLUMNS)
+            else:
+                self._maps = tuple(
+                    np.memmap(self._path(name), dtype=dtype, mode="r", shape=(rows, width))
+                    for name, dtype, width in _COLUMNS
+                )
+            self._mapped_rows = rows
+        return self._maps
+
+    # --- Writing ---
+
+    def _participant_id(self, name):
+        pid = self._ids.get(name)
+        if pid is None:
+            pid = len(self._names)
+            with open(self._path(PARTICIPANTS_FILE), "a", encoding="utf-8") as f:
+                f.write(name + "\n")
+            self._ids[name] = pid
+            self._names.append(name)
+        return pid
+
+    def append(self, participant, session, keys, features):
+        """
+        Append one block of digraphs for a participant/session.
+        `keys` is a sequence of (key1, key2) single-character pairs and
+        `features` an [N, 5] array-like of timings. Returns the number of rows written.
+        """
+        participant = participant.strip()
+        if not participant or "\n" in participant:
+            raise ValueError("Participant must be a non-empty single-line string")
+        feats = np.ascontiguousarray(features, dtype=np.float32).reshape(-1, len(TIMING_KEYS))
+        codes = np.array([(ord(k1), ord(k2)) for k1, k2 in keys], dtype=np.int32).reshape(-1, 2)
+        if len(codes) != len(feats):
+            raise ValueError(f"Got {len(codes)} key pairs for {len(feats)} feature rows")
+        if not len(feats):
+            return 0
+
+        with self._lock, self._file_lock():
+            # Another process may have appended participants/rows meanwhile (or died mid-append)
+            self._repair()
+            self._load_participants()
+            self._index_new_rows()
+            pid = self._participant_id(participant)
+            ids = np.empty((len(feats), 2), dtype=np.int32)
+            ids[:, 0] = pid
+            ids[:, 1] = int(session)
+            # ids is written last: a row only becomes visible once every column has it
+            for name, block in ((FEATURES_FILE, feats), (KEYS_FILE, codes), (IDS_FILE, ids)):
+                with open(self._path(name), "ab") as f:
+                    f.write(block.tobytes())
+            self._index_new_rows()
+        return len(feats)
+
+    # --- Reading ---
+
+    def participants(self):
+        with self._lock:
+            return sorted(self._names)
+
+    def sessions(self, participant):
+        with self._lock:
+            pid = self._ids.get(participant)
+            return sorted(s for p, s in self._spans if p == pid)
+
+    def session(self, participant, session):
+        """
+        Return (keys, features) arrays for one participant/session.
+        When the session was written as a single block these are read-only
+        views into the memory map (no copy); otherwise the blocks are joined.
+        """
+        with self._lock:
+            pid = self._ids.get(participant)
+            spans = self._spans.get((pid, int(session)), []) if pid is not None else []
+            features, keys, _ = self._map(self._rows)
+        if not spans:
+            return keys[:0], features[:0]
+        if len(spans) == 1:
+            start, stop = spans[0]
+            return keys[start:stop], features[start:stop]
+        return (np.concatenate([keys[a:b] for a, b in spans]),
+                np.concatenate([features[a:b] for a, b in spans]))
+
+    def columns(self):
+        """Memmapped (features, keys, ids) arrays over every stored row."""
+        with self._lock:
+            return self._map(self._rows)
+
+    def participant_name(self, pid):
+        return self._names[pid]
+
+    def __len__(self):
+        return self._rows
+
+
+# --- Import / export ---
+
+def import_csv(store, paths):
+    """
+    One-shot import of the legacy text CSVs (free-text.csv / database.csv)
+    into `store`. Rows are grouped into consecutive participant/session blocks
+    so each block is a single append. Returns the number of rows imported.
+    """
+    imported = 0
+    for path in paths:
+        if not os.path.isfile(path):
+            logging.debug(f"CSV file not found, skipping: {path}")
+            continue
+        block_key, keys, feats = None, [], []
+        skipped = 0
+        with open(path, newline="", encoding="utf-8") as f:
+            # No skipinitialspace here: it would turn a typed space (" ") into an empty key
+            reader = csv.DictReader(f)
+            for r in reader:
+                row = {k.strip(): v for k, v in r.items() if k and k.strip()}
+                try:
+                    key = (row["participant"].strip(), int(row["session"]))
+                    k1, k2 = row["key1"], row["key2"]
+                    if len(k1) != 1 or len(k2) != 1:
+                        raise ValueError("multi-character key")
+                    values = [float(row[k]) for k in TIMING_KEYS]
+                except (KeyError, TypeError, ValueError, AttributeError):
+                    skipped += 1
+                    continue
+                if key != block_key and keys:
+                    imported += store.append(block_key[0], block_key[1], keys, feats)
+                    keys, feats = [], []
+                block_key = key
+                keys.append((k1, k2))
+                feats.append(values)
+        if keys:
+            imported += store.append(block_key[0], block_key[1], keys, feats)
+        if skipped:
+            logging.warning(f"Skipped {skipped} unusable rows while importing {path}")
+        logging.info(f"Imported {path} into feature store {store.directory}")
+    return imported
+
+
+def export_csv(store, path):
+    """Write every stored row back out in the legacy CSV layout. Returns the row count."""
+    features, keys, ids = store.columns()
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for i in range(len(ids)):
+            writer.writerow([
+                store.participant_name(int(ids[i, 0])), int(ids[i, 1]),
+                chr(keys[i, 0]), chr(keys[i, 1]),
+                *(f"{v:.9g}" for v in features[i].tolist()),  # 9 digits round-trip float32
+            ])
+    return len(ids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Columnar typing-feature store tools")
+    parser.add_argument("store", help="Store directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="Import legacy CSV files into the store")
+    imp.add_argument("csv", nargs="+")
+    exp = sub.add_parser("export", help="Export the store as a legacy CSV file")
+    exp.add_argument("csv")
+    args = parser.parse_args(argv)
+
+    store = FeatureStore(args.store).open()
+    if args.command == "import":
+        print(f"Imported {import_csv(store, args.csv)} rows")
+    else:
+        print(f"Exported {export_csv(store, args.csv)} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import os
+import json
+import zlib
+import logging
+from itertools import chain, islice
+
+# /history paging: without ?limit the whole session is returned (still streamed)
+HISTORY_MAX_LIMIT = int(os.environ.get("HISTORY_MAX_LIMIT", "10000"))
+HISTORY_GZIP_LEVEL = int(os.environ.get("HISTORY_GZIP_LEVEL", "6"))  # 0 disables gzip
+CHUNK_ROWS = 512  # Rows serialised per yielded chunk
+
+FORMATS = ("json", "ndjson", "columnar")
+ID_COLUMNS = ("participant", "session")
+KEY_COLUMNS = ("key1", "key2")
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+_dumps = json.JSONEncoder(separators=(",", ":")).encode
+
+
+class HistoryQuery:
+    """
+    Paging and shape options of a /history request:
+    ?after=<cursor>&limit=<n>&format=json|ndjson|columnar&fields=all|timings
+    The cursor is opaque (the "next" of the previous page); the index checks it.
+    """
+
+    def __init__(self, args):
+        self.after = (args.get("after") or "").strip() or None
+        self.limit = self._int(args.get("limit"), "limit", minimum=1)
+        if self.limit is not None:
+            self.limit = min(self.limit, HISTORY_MAX_LIMIT)
+        self.paged = self.after is not None or self.limit is not None
+        self.format = (args.get("format") or "json").strip().lower()
+        if self.format not in FORMATS:
+            raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+        self.fields = (args.get("fields") or "all").strip().lower()
+        if self.fields not in ("all", "timings"):
+            raise ValueError("fields must be 'all' or 'timings'")
+
+    @staticmethod
+    def _int(value, name, minimum):
+        if value is None or value == "":
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError(f"{name} must be an integer")
+        if value < minimum:
+            raise ValueError(f"{name} must be >= {minimum}")
+        return value
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _columns(row, fields):
+    timings = [c for c in row if c not in ID_COLUMNS and c not in KEY_COLUMNS]
+    return timings if fields == "timings" else [c for c in KEY_COLUMNS if c in row] + timings
+
+
+def _row_array(row, columns):
+    return [row.get(c) if c in KEY_COLUMNS else _number(row.get(c)) for c in columns]
+
+
+def _chunks(items):
+    """Join serialised items into chunks of CHUNK_ROWS."""
+    items = iter(items)
+    while True:
+        block = list(islice(items, CHUNK_ROWS))
+        if not block:
+            return
+        yield block
+
+
+def render(rows, query, cursor, envelope=None):
+    """
+    Serialise history rows lazily, yielding str chunks.
+
+    json:     {"history": [{...}, ...], "next": cursor}
+    columnar: {"columns": [...], "rows": [[...], ...], "next": cursor}, the
+              timing values as numbers and the column names sent only once
+    ndjson:   one row object (or array after a {"columns": [...]} line, with
+              fields=timings) per line; the cursor is only in the headers
+
+    "next" is only added when the request paged (?after or ?limit), so
+    unpaged responses keep their original shape.
+
+    `envelope` nests the JSON object under that key (app.py's {"data": ...}).
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    columns = _columns(first, query.fields) if first is not None else []
+    rows = chain([first], rows) if first is not None else rows
+    columnar = query.format == "columnar" or query.fields == "timings"
+    encode = (lambda r: _dumps(_row_array(r, columns))) if columnar else _dumps
+
+    if query.format == "ndjson":
+        if columnar:
+            yield _dumps({"columns": columns}) + "\n"
+        for block in _chunks(rows):
+            yield "".join(encode(r) + "\n" for r in block)
+        return
+
+    head = '{"columns":' + _dumps(columns) + ',"rows":[' if columnar else '{"history":['
+    yield ('{' + _dumps(envelope) + ':' if envelope else "") + head
+    sep = ""
+    for block in _chunks(rows):
+        yield sep + ",".join(encode(r) for r in block)
+        sep = ","
+    tail = ',"next":' + _dumps(None if cursor is None else str(cursor)) if query.paged else ""
+    yield "]" + tail + "}" + ("}" if envelope else "")
+
+
+def gzip_stream(chunks, level=HISTORY_GZIP_LEVEL):
+    """Gzip a stream of str chunks on the fly (flushing per chunk so clients see rows early)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _logged(chunks):
+    try:
+        yield from chunks
+    except Exception as e:
+        # Headers are already sent; the truncated body is the only signal left
+        logging.error(f"Error while streaming history: {e}")
+        raise
+
+
+def history_response(rows, query, cursor, accept_encoding="", envelope=None):
+    """Streaming Flask response for a history page, gzipped when the client accepts it."""
+    from flask import Response
+
+    body = _logged(render(rows, query, cursor, envelope))
+    headers = {"Vary": "Accept-Encoding"}
+    if cursor is not None:
+        headers["X-Next-Cursor"] = str(cursor)
+    if HISTORY_GZIP_LEVEL > 0 and "gzip" in (accept_encoding or "").lower():
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+    mimetype = NDJSON_MIMETYPE if query.format == "ndjson" else "application/json"
+    return Response(body, mimetype=mimetype, headers=headers)
@@ -2,7 +2,13 @@
 
 import os
 import csv
-import dnn_wrapper
+from label_map import load_label_map, build_label_map
+
+# DNN_BACKEND=numpy runs the pure NumPy engine instead of the native wrapper
+if os.environ.get("DNN_BACKEND") == "numpy":
+    import dnn_numpy as dnn_wrapper
+else:
+    import dnn_wrapper
 
 # 1) Compute project root (one level up from this file)
 THIS_DIR     = os.path.dirname(__file__)
@@ -43,12 +49,9 @@ rows, cols = 3, 5
 predicted_index = dnn_wrapper.predict(flat, rows, cols)
 print(f"Predicted class index: {predicted_index}")
 
-# 6) Reconstruct the participant‑to‑class mapping
-participants = []
-for row in samples:
-    pid = row["participant"].strip()
-    if pid not in participants:
-        participants.append(pid)
+# 6) Class → participant mapping: the label map shipped with the model,
+#    or (for models without one) rebuilt from the CSV
+participants = load_label_map(MODEL_PATH) or build_label_map(CSV_PATH)
 
 print("Class → participant mapping:", participants)
 
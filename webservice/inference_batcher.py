@@ -0,0 +1,117 @@
+import os
+import time
+import queue
+import threading
+import logging
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+_STOP = object()  # Queued by stop(): answer what came before it, then exit
+
+
+class MicroBatcher:
+    """
+    Collects concurrent predict calls into small batches.
+
+    Callers block in predict() while a single scheduler thread gathers
+    requests for at most `window` seconds (or until `max_batch` are waiting),
+    groups them by input shape (rows, cols) and runs each group through
+    `predict_batch(samples, rows, cols)` in one call. Every caller then gets
+    its own class index back, or its own exception. predict() gives up after
+    `timeout` seconds with TimeoutError.
+    """
+
+    def __init__(self, predict_batch, window=0.005, max_batch=32, timeout=30.0):
+        self.predict_batch = predict_batch
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None      # Process the thread runs in (a forked worker starts its own)
+        self._start_lock = threading.Lock()
+        self.batches = 0      # Number of predict_batch calls made
+        self.requests = 0     # Number of samples served
+
+    def start(self):
+        with self._start_lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    self._queue = queue.Queue()  # Forked: the parent's thread did not come along
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="predict-batcher", daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Answer the queued requests and stop the thread; the next start() or submit() starts a new one."""
+        with self._start_lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid() or not thread.is_alive():
+                return
+            self._queue.put((_STOP, None, None, None))
+        thread.join(timeout)
+        with self._start_lock:
+            self._pid = None
+
+    def submit(self, flat, rows, cols):
+        """Queue one sample; returns a Future resolving to its class index."""
+        if self._pid != os.getpid():
+            self.start()
+        future = Future()
+        self._queue.put((flat, rows, cols, future))
+        return future
+
+    def predict(self, flat, rows, cols, timeout=None):
+        """Blocking drop-in for dnn_wrapper.predict(flat, rows, cols); raises TimeoutError after `timeout` (default self.timeout)."""
+        timeout = self.timeout if timeout is None else timeout
+        future = self.submit(flat, rows, cols)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()  # Skipped by the scheduler if it is still queued
+            raise TimeoutError(f"No prediction within {timeout}s") from None
+
+    def _collect(self):
+        """Block for the first request, then gather more until the window closes."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            groups = {}
+            for item in batch:
+                if item[0] is not _STOP and item[3].set_running_or_notify_cancel():
+                    groups.setdefault((item[1], item[2]), []).append(item)
+            for (rows, cols), items in groups.items():
+                self._run_group(rows, cols, items)
+            if any(item[0] is _STOP for item in batch):
+                return
+
+    def _run_group(self, rows, cols, items):
+        try:
+            results = list(self.predict_batch([item[0] for item in items], rows, cols))
+            self.batches += 1
+            self.requests += len(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"predict_batch returned {len(results)} results for {len(items)} samples")
+        except Exception as e:
+            if len(items) == 1:
+                items[0][3].set_exception(e)
+                return
+            # One bad sample must not fail its neighbours: retry them one by one
+            logging.warning(f"Batched prediction of {len(items)} samples failed ({e}), retrying individually")
+            for item in items:
+                self._run_group(rows, cols, [item])
+            return
+        for item, result in zip(items, results):
+            item[3].set_result(result)
@@ -0,0 +1,234 @@
+import time
+import uuid
+import threading
+import logging
+from collections import Counter, deque
+
+# A press still waiting for its keyup after this many newer presses is given up on
+# (lost keyup, e.g. focus left the field) so it cannot stall the stream
+MAX_PENDING_PRESSES = 32
+
+
+def digraph_features(k1, k2):
+    """
+    The five timings of a digraph from two presses given as (key, down, up),
+    in the order the typing page and the CSV use. None if the pair is unusable.
+    """
+    key1, down1, up1 = k1
+    key2, down2, up2 = k2
+    if up1 is None or up2 is None:
+        return None
+    if up1 < down1 or up2 < down2 or down2 < down1:
+        return None
+    if len(key1) != 1 or len(key2) != 1:
+        return None
+    return [
+        up1 - down1,    # Hold time of key1
+        down2 - down1,  # Down-down latency
+        down2 - up1,    # Up-down latency (flight time)
+        up2 - down1,    # Press key1 -> release key2
+        up2 - up1,      # Up-up latency
+    ]
+
+
+class DigraphExtractor:
+    """
+    Incremental version of the typing page's digraph builder.
+
+    Raw keydown/keyup events are fed as they arrive; presses are kept in
+    keydown order (auto-repeat keydowns of a held key are ignored) and every
+    pair of consecutive presses is turned into a digraph as soon as both keys
+    have been released. Only the presses not yet paired are kept in memory.
+    """
+
+    def __init__(self):
+        self._presses = deque()  # [key, down, up], oldest unpaired press first
+        self.invalid = 0         # Pairs skipped for bad timings or non-character keys
+
+    def feed(self, kind, key, t):
+        """Apply one event; returns the list of (key1, key2, features) it completed."""
+        if kind == "down":
+            if not any(p[0] == key and p[2] is None for p in self._presses):
+                self._presses.append([key, t, None])
+        elif kind == "up":
+            for press in reversed(self._presses):
+                if press[0] == key and press[2] is None:
+                    press[2] = t
+                    break
+        else:
+            raise ValueError(f"Unknown key event type: {kind!r}")
+        return self._drain(final=False)
+
+    def finish(self):
+        """Pair whatever is left (presses never released count as invalid)."""
+        return self._drain(final=True)
+
+    def _drain(self, final):
+        out = []
+        presses = self._presses
+        while len(presses) >= 2:
+            k1, k2 = presses[0], presses[1]
+            if not final and (k1[2] is None or k2[2] is None) and len(presses) <= MAX_PENDING_PRESSES:
+                break
+            presses.popleft()
+            features = digraph_features(k1, k2)
+            if features is None:
+                self.invalid += 1
+            else:
+                out.append((k1[0], k2[0], features))
+        if final:
+            presses.clear()
+        return out
+
+
+class TypingStream:
+    """
+    Server-side state of one typing session being streamed.
+
+    Digraphs are extracted as events arrive, and every new window of `window`
+    consecutive digraphs is handed to `scorer(flat, rows, cols)` (which
+    returns a Future, e.g. MicroBatcher.submit) straight away. The per-class
+    votes of the scored windows form the running classification, so by the
+    time the user submits only the last window or two are still in flight.
+    """
+
+    def __init__(self, stream_id, participant, session, scorer=None, window=3, cols=5):
+        self.stream_id = stream_id
+        self.participant = participant
+        self.session = session
+        self.scorer = scorer
+        self.window = window
+        self.cols = cols
+        self.keys = []
+        self.features = []
+        self.votes = Counter()
+        self.scored = 0
+        self.errors = 0
+        self.next_seq = 0
+        self.touched = time.monotonic()
+        self._extractor = DigraphExtractor()
+        self._pending = []
+        self._lock = threading.RLock()  # _vote may run inline when a score is already done
+
+    @property
+    def invalid(self):
+        return self._extractor.invalid
+
+    def feed(self, events, seq=None):
+        """
+        Apply a chunk of events ({"type": "down"|"up", "key": str, "t": ms}).
+        `seq` numbers the chunks from 0: a repeated chunk is ignored (so
+        clients may retry) and a gap raises LookupError. Returns the number
+        of digraphs this chunk completed.
+        """
+        with self._lock:
+            self.touched = time.monotonic()
+            if seq is not None:
+                if seq < self.next_seq:
+                    return 0
+                if seq > self.next_seq:
+                    raise LookupError(f"Expected chunk {self.next_seq}, got {seq}")
+            parsed = []
+            for event in events:
+                try:
+                    parsed.append((event["type"], str(event["key"]), float(event["t"])))
+                except (KeyError, TypeError, ValueError):
+                    raise ValueError(f"Malformed key event: {event!r}")
+            new = []
+            for kind, key, t in parsed:
+                new.extend(self._extractor.feed(kind, key, t))
+            self._absorb(new)
+            self.next_seq += 1
+            return len(new)
+
+    def _absorb(self, digraphs):
+        """Store new digraphs and score the windows they complete. Lock must be held."""
+        for key1, key2, features in digraphs:
+            self.keys.append((key1, key2))
+            self.features.append(features)
+            start = len(self.features) - self.window
+            if self.scorer is not None and start >= 0:
+                flat = [v for row in self.features[start:] for v in row]
+                future = self.scorer(flat, self.window, self.cols)
+                future.add_done_callback(self._vote)
+                self._pending = [f for f in self._pending if not f.done()]
+                self._pending.append(future)
+
+    def _vote(self, future):
+        try:
+            label = future.result()
+        except Exception as e:
+            logging.debug(f"Stream {self.stream_id}: window scoring failed: {e}")
+            self.errors += 1
+            return
+        with self._lock:
+            self.votes[label] += 1
+            self.scored += 1
+
+    def state(self):
+        """Running classification: leading class, its share of the scored windows."""
+        with self._lock:
+            leader = self.votes.most_common(1)
+            return {
+                "digraphs": len(self.keys),
+                "invalid": self.invalid,
+                "windows_scored": self.scored,
+                "predicted_index": leader[0][0] if leader else None,
+                "confidence": leader[0][1] / self.scored if leader else None,
+            }
+
+    def finish(self, timeout=None):
+        """Flush trailing presses and wait for the windows still being scored."""
+        with self._lock:
+            self._absorb(self._extractor.finish())
+            pending, self._pending = self._pending, []
+        for future in pending:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass  # Counted by _vote
+        return self.state()
+
+
+class StreamRegistry:
+    """
+    Open TypingStreams of this process, by id. Streams idle for longer than
+    `ttl` seconds are dropped. State is per process, so with several workers
+    the stream's requests must reach the same one (sticky routing).
+    """
+
+    def __init__(self, scorer=None, window=3, ttl=300.0, max_streams=1000):
+        self.scorer = scorer
+        self.window = window
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def open(self, participant, session):
+        with self._lock:
+            self._expire()
+            if len(self._streams) >= self.max_streams:
+                raise OverflowError("Too many open typing streams")
+            stream = TypingStream(uuid.uuid4().hex, participant, session, self.scorer, self.window)
+            self._streams[stream.stream_id] = stream
+            return stream
+
+    def get(self, stream_id):
+        with self._lock:
+            self._expire()
+            return self._streams.get(stream_id)
+
+    def close(self, stream_id):
+        with self._lock:
+            return self._streams.pop(stream_id, None)
+
+    def _expire(self):
+        """Drop idle streams. Lock must be held."""
+        cutoff = time.monotonic() - self.ttl
+        for stream_id in [s for s, stream in self._streams.items() if stream.touched < cutoff]:
+            logging.info(f"Dropping idle typing stream {stream_id}")
+            del self._streams[stream_id]
+
+    def __len__(self):
+        return len(self._streams)
@@ -0,0 +1,445 @@
+import os
+import io
+import csv
+import bisect
+import threading
+import logging
+
+import numpy as np
+import numpy.random  # Lazy in NumPy 2: a fork (serve.py) must not catch the CV thread importing it
+
+from metrics import ROWS_READ
+
+ALGORITHM = "KNN (Manhattan)"
+VERIFY_ALGORITHM = "KNN (Manhattan) 1:1"
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan  # Missing/invalid timing (the dataset has a few gaps)
+
+
+def manhattan_distances(X, sample):
+    """
+    L1 distance from every row of X to `sample`, ignoring missing (NaN) values.
+    Distances are rescaled by the share of usable dimensions so rows with gaps
+    stay comparable to complete ones.
+    """
+    return distances(X, sample, "manhattan")
+
+
+def distances(X, sample, metric="manhattan"):
+    """NaN-aware distance from every row of X to `sample` (manhattan, euclidean or chebyshev)."""
+    diff = np.abs(X - sample)
+    valid = ~np.isnan(diff)
+    counts = valid.sum(axis=1)
+    diff = np.where(valid, diff, 0.0)
+    if metric == "manhattan":
+        dist = diff.sum(axis=1)
+    elif metric == "euclidean":
+        dist = np.sqrt(np.square(diff).sum(axis=1))
+    elif metric == "chebyshev":
+        return np.where(counts == 0, np.inf, diff.max(axis=1, initial=0.0))
+    else:
+        raise ValueError(f"Unknown metric: {metric}")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = X.shape[1] / counts
+        dist = dist * (np.sqrt(scale) if metric == "euclidean" else scale)
+    dist[counts == 0] = np.inf
+    return dist
+
+
+def pairwise_distances(A, B, metric="manhattan", max_cells=1 << 17):
+    """
+    distances() from every row of A to every row of B, as a (len(A), len(B))
+    float32 matrix with the same NaN handling. Euclidean goes through matrix
+    products; manhattan/chebyshev accumulate one feature at a time over blocks
+    of at most `max_cells` pairs, which keeps the working set in cache instead
+    of materialising an (A, B, features) array.
+    """
+    A = np.asarray(A, dtype=np.float32)
+    B = np.asarray(B, dtype=np.float32)
+    d = A.shape[1]
+    mask_a, mask_b = ~np.isnan(A), ~np.isnan(B)
+    A0, B0 = np.where(mask_a, A, 0.0).T.copy(), np.where(mask_b, B, 0.0).T.copy()
+    gaps = ~mask_a.all(axis=0) | ~mask_b.all(axis=0)  # Features that need masking
+    if gaps.any():
+        counts = mask_a.astype(np.float32) @ mask_b.T.astype(np.float32)
+    else:
+        counts = np.full((len(A), len(B)), float(d), dtype=np.float32)
+    if metric == "euclidean":
+        ma, mb = mask_a.astype(np.float64), mask_b.astype(np.float64)
+        A64, B64 = A0.T.astype(np.float64), B0.T.astype(np.float64)
+        sq = np.square(A64) @ mb.T + ma @ np.square(B64).T - 2.0 * (A64 @ B64.T)
+        dist = np.sqrt(np.maximum(sq, 0.0)).astype(np.float32)
+    elif metric in ("manhattan", "chebyshev"):
+        dist = np.zeros((len(A), len(B)), dtype=np.float32)
+        width = max(1, min(len(B), max_cells))
+        step = max(1, max_cells // width)
+        tmp = np.empty((min(step, len(A)), width), dtype=np.float32)
+        for row in range(0, len(A), step):
+            rows = slice(row, row + step)
+            for col in range(0, len(B), width):
+                cols = slice(col, col + width)
+                out = dist[rows, cols]
+                t = tmp[:out.shape[0], :out.shape[1]]
+                for j in range(d):
+                    np.subtract(A0[j, rows, None], B0[j, None, cols], out=t)
+                    np.abs(t, out=t)
+                    if gaps[j]:
+                        t *= mask_a[rows, j, None] & mask_b[None, cols, j]
+                    if metric == "manhattan":
+                        out += t
+                    else:
+                        np.maximum(out, t, out=out)
+    else:
+        raise ValueError(f"Unknown metric: {metric}")
+    if metric != "chebyshev":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = d / counts
+            dist *= np.sqrt(scale) if metric == "euclidean" else scale
+    dist[counts == 0] = np.inf
+    return dist
+
+
+def robust_threshold(distances, spread=2.0):
+    """
+    Acceptance threshold from a user's leave-one-out distances: their median
+    plus `spread` times their MAD (scaled to a standard deviation), so a
+    single outlying template cannot stretch it the way the maximum would.
+    None if no distance is finite.
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    distances = distances[np.isfinite(distances)]
+    if not len(distances):
+        return None
+    median = float(np.median(distances))
+    mad = float(np.median(np.abs(distances - median)))
+    return median + spread * 1.4826 * mad
+
+
+def vote(labels, distances, k, weights="uniform"):
+    """
+    Majority vote among the k nearest labels; ties go to the closest neighbour.
+    With weights="distance" each neighbour counts 1/distance (exact matches win).
+    """
+    k = max(1, min(k, len(labels)))
+    nearest = np.argpartition(distances, k - 1)[:k] if k < len(labels) else np.arange(len(labels))
+    nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+    counts = {}
+    for idx in nearest.tolist():
+        if weights == "distance":
+            weight = 1.0 / distances[idx] if distances[idx] > 0 else np.inf
+        else:
+            weight = 1
+        counts[labels[idx]] = counts.get(labels[idx], 0) + weight
+    best = max(counts.values())
+    for idx in nearest.tolist():  # Closest first
+        if counts[labels[idx]] == best:
+            return labels[idx], float(distances[idx])
+
+
+class ResidentKNN:
+    """
+    Manhattan KNN over the typing vectors in biometria.csv, fitted once and
+    kept in memory. refresh() tails the CSV (or the shards) by byte offset,
+    like TypingIndex, and appends the new rows to a growable buffer: every
+    worker process picks up enrollments written by the others without
+    re-reading the file, and classifying a login sample never parses it.
+    """
+
+    def __init__(self, csv_path, k=1, shards=None):
+        self.csv_path = csv_path
+        self.k = k
+        self.shards = shards      # ShardStore with one CSV per user, read instead of csv_path
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()  # One load/refresh at a time
+        self._files = {}          # path -> (inode, offset) of the bytes fitted so far
+        self._X = np.empty((0, 0), dtype=np.float32)
+        self._labels = []
+        self._rows_by_label = {}  # user id -> row indices, for 1:1 verification
+        self._n = 0
+        self.n_features = None
+        self.generation = 0  # Bumped whenever the training data changes
+
+    def load(self):
+        """Read the whole CSV (or every shard) once (last column is the user id / CLASS)."""
+        with self._refresh_lock:
+            return self._load()
+
+    def _load(self):
+        rows, labels, n_features, files = [], [], None, {}
+        if self.shards is not None:
+            self.shards.reload()
+            paths = self.shards.paths()
+        else:
+            paths = [self.csv_path]
+        for path in paths:
+            n_features = self._read(path, rows, labels, n_features, files)
+
+        with self._lock:
+            self._files = files
+            self.n_features = n_features
+            self._X = np.array(rows, dtype=np.float32).reshape(len(rows), n_features or 0)
+            self._labels = labels
+            self._rows_by_label = {}
+            for i, label in enumerate(labels):
+                self._rows_by_label.setdefault(label, []).append(i)
+            self._n = len(rows)
+            self.generation += 1
+        source = f"{len(paths)} shards in {self.shards.root}" if self.shards is not None else self.csv_path
+        logging.info(f"KNN model fitted on {self._n} samples from {source}")
+        return self
+
+    def refresh(self, label=None):
+        """
+        Absorb the rows appended to the CSV (or shards) since the last
+        load/refresh, by any process, reading only the new bytes. With shards,
+        `label` limits this to that user's segment. A file that was replaced
+        or truncated is re-read from scratch. Returns the number of new rows.
+        """
+        with self._refresh_lock:
+            if self.shards is not None:
+                self.shards.reload()
+                if label is None:
+                    paths = self.shards.paths()
+                else:
+                    path = self.shards.path(str(label).strip())
+                    paths = [path] if path else []
+            else:
+                paths = [self.csv_path]
+            pending = []
+            for path in paths:
+                inode, offset = self._files.get(path, (None, 0))
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if inode is not None and (st.st_ino != inode or st.st_size < offset):
+                    logging.warning(f"{path} was replaced or truncated, refitting the KNN model")
+                    before = self._n
+                    self._load()
+                    return max(0, self._n - before)
+                if st.st_size > offset:
+                    pending.append(path)
+            if not pending:
+                return 0
+            rows, labels, files = [], [], dict(self._files)
+            n_features = self.n_features
+            for path in pending:
+                n_features = self._read(path, rows, labels, n_features, files, whole_lines=True)
+            with self._lock:
+                self._files = files
+                self.n_features = n_features
+                if rows:
+                    self._append(np.array(rows, dtype=np.float32).reshape(len(rows), n_features), labels)
+            return len(rows)
+
+    @staticmethod
+    def _read(path, rows, labels, n_features, files, whole_lines=False):
+        """
+        Append the samples of one CSV, from the offset recorded in `files`, to
+        rows/labels and record the new offset; returns the feature count. With
+        whole_lines, a partly written last line is left for the next call.
+        """
+        inode, offset = files.get(path, (None, 0))
+        try:
+            with open(path, "rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                f.seek(offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            logging.warning(f"Typing data not found: {path}")
+            return n_features
+        if whole_lines:
+            chunk = chunk[:chunk.rfind(b"\n") + 1]
+        files[path] = (inode, offset + len(chunk))
+        read = 0
+        reader = csv.reader(io.StringIO(chunk.decode("utf-8", errors="replace"), newline=""))
+        if offset == 0:
+            header = next(reader, None)
+            if header and n_features is None:
+                n_features = len(header) - 1
+        for line in reader:
+            if not line or not n_features:
+                continue
+            if len(line) != n_features + 1:
+                logging.warning(f"Skipping row with {len(line)} columns in {path} (expected {n_features + 1})")
+                continue
+            rows.append([_to_float(v) for v in line[:-1]])
+            labels.append(line[-1].strip())
+            read += 1
+        ROWS_READ.inc(read, source=os.path.basename(path))
+        return n_features
+
+    def _sample_vector(self, values):
+        sample = np.array([_to_float(v) for v in values], dtype=np.float32)
+        if self.n_features is not None and len(sample) != self.n_features:
+            logging.warning(f"Typing sample has {len(sample)} values, model expects {self.n_features}; padding/truncating")
+            fixed = np.full(self.n_features, np.nan, dtype=np.float32)
+            fixed[:min(len(sample), self.n_features)] = sample[:self.n_features]
+            sample = fixed
+        return sample
+
+    def _append(self, samples, labels):
+        """Add rows to the fitted data without refitting. Lock must be held."""
+        if self._X.shape[1] != self.n_features:
+            self._X = np.empty((0, self.n_features), dtype=np.float32)
+        if self._n + len(samples) > len(self._X):
+            # Grow geometrically so appends stay amortised O(1)
+            grown = np.empty((max(16, 2 * len(self._X), self._n + len(samples)), self.n_features), dtype=np.float32)
+            grown[:self._n] = self._X[:self._n]
+            self._X = grown
+        self._X[self._n:self._n + len(samples)] = samples
+        for label in labels:
+            self._labels.append(label)
+            self._rows_by_label.setdefault(label, []).append(self._n)
+            self._n += 1
+        self.generation += 1
+
+    def snapshot(self):
+        """(X, labels, generation) for the rows currently fitted; X is a read-only view."""
+        with self._lock:
+            X = self._X[:self._n]
+            X.flags.writeable = False
+            return X, self._labels[:self._n], self.generation
+
+    def templates(self, label):
+        """Copy of the enrolled vectors of one user (empty if unknown); cost scales with that user only."""
+        with self._lock:
+            rows = self._rows_by_label.get(str(label).strip(), ())
+            return self._X[list(rows)] if rows else np.empty((0, self.n_features or 0), dtype=np.float32)
+
+    def labels(self):
+        """Enrolled user ids."""
+        with self._lock:
+            return list(self._rows_by_label)
+
+    def classify(self, values):
+        """
+        Classify one typing sample. Returns (predicted user id, distance,
+        algorithm name), mirroring the (prediction, ..., algorithm) tuple the
+        login route used to get from Classificador.
+        """
+        X, labels, _ = self.snapshot()
+        if not labels:
+            raise RuntimeError("KNN model has no enrolled samples")
+        sample = self._sample_vector(values)
+        predicted, distance = vote(labels, manhattan_distances(X, sample), self.k)
+        return predicted, distance, ALGORITHM
+
+    def __len__(self):
+        return self._n
+
+
+class ClaimVerifier:
+    """
+    1:1 verification of a claimed user against a ResidentKNN.
+
+    Only the claimed user's enrolled vectors are scored: the sample's score is
+    its Manhattan distance to the nearest of them, accepted when it is within
+    that user's threshold. The threshold is robust_threshold() of the
+    leave-one-out nearest-neighbour distances among the user's own templates
+    (median + `spread` MADs), times `margin`, cached until the user enrolls
+    more samples. Users with a single template
+    use the running median of the cached thresholds of the other users, so a
+    login never scores anyone else's templates; prime() fills the cache off
+    the login path.
+    """
+
+    def __init__(self, model, margin=1.0, spread=2.0):
+        self.model = model
+        self.margin = margin
+        self.spread = spread
+        self._lock = threading.Lock()
+        self._thresholds = {}  # user id -> (template count, own threshold or None)
+        self._sorted = []      # Own thresholds of every cached user, for the median
+
+    def _genuine_threshold(self, templates):
+        if len(templates) < 2:
+            return None
+        loo = [manhattan_distances(np.delete(templates, i, axis=0), t).min()
+               for i, t in enumerate(templates)]
+        return robust_threshold(loo, self.spread)
+
+    def threshold(self, label, templates=None):
+        """Acceptance threshold for `label` (None when there is nothing to derive it from)."""
+        label = str(label).strip()
+        if templates is None:
+            templates = self.model.templates(label)
+        cached = self._thresholds.get(label)
+        if cached is not None and cached[0] == len(templates):
+            threshold = cached[1]
+        else:
+            threshold = self._genuine_threshold(templates)
+            if threshold is not None:
+                threshold *= self.margin
+            with self._lock:
+                previous = self._thresholds.get(label)
+                if previous is not None and previous[1] is not None:
+                    del self._sorted[bisect.bisect_left(self._sorted, previous[1])]
+                if threshold is not None:
+                    bisect.insort(self._sorted, threshold)
+                self._thresholds[label] = (len(templates), threshold)
+        return threshold if threshold is not None else self._fallback_threshold()
+
+    def _fallback_threshold(self):
+        """Median of the cached per-user thresholds (None until one is known)."""
+        with self._lock:
+            n = len(self._sorted)
+            if not n:
+                return None
+            return (self._sorted[(n - 1) // 2] + self._sorted[n // 2]) / 2
+
+    def prime(self):
+        """Compute every enrolled user's threshold now (e.g. during warm-up) instead of at their first login."""
+        for label in self.model.labels():
+            self.threshold(label)
+        return self
+
+    def verify(self, label, values):
+        """
+        Returns (accepted, distance, threshold) for a sample claimed to be
+        typed by `label`. Unknown users are rejected with distance None.
+        """
+        templates = self.model.templates(label)
+        if not len(templates):
+            return False, None, None
+        sample = self.model._sample_vector(values)
+        distance = float(manhattan_distances(templates, sample).min())
+        threshold = self.threshold(label, templates)
+        return threshold is not None and distance <= threshold, distance, threshold
+
+
+def cross_val_accuracy(X, labels, k=1, folds=5, seed=0, executor=None, metric="manhattan", weights="uniform"):
+    """
+    Plain k-fold cross-validated accuracy of the KNN (Manhattan by default).
+    With an `executor` (e.g. a ProcessPoolExecutor) the folds run in parallel.
+    """
+    n = len(labels)
+    if n < 2:
+        return None
+    folds = max(2, min(folds, n))
+    order = np.random.default_rng(seed).permutation(n)
+    splits = np.array_split(order, folds)
+    if executor is None:
+        hits = sum(_fold_hits(X, labels, test, k, metric, weights) for test in splits)
+    else:
+        X = np.ascontiguousarray(X)
+        hits = sum(executor.map(_fold_hits, [X] * folds, [labels] * folds, splits,
+                                [k] * folds, [metric] * folds, [weights] * folds))
+    return hits / n
+
+
+def _fold_hits(X, labels, test, k, metric="manhattan", weights="uniform"):
+    train = np.ones(len(labels), dtype=bool)
+    train[test] = False
+    X_train = X[train]
+    y_train = [labels[i] for i in np.flatnonzero(train).tolist()]
+    hits = 0
+    for i in test.tolist():
+        predicted, _ = vote(y_train, distances(X_train, X[i], metric), k, weights)
+        hits += predicted == labels[i]
+    return hits
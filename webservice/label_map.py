@@ -0,0 +1,91 @@
+import os
+import csv
+import sys
+import json
+import hashlib
+import argparse
+import logging
+
+
+def label_map_path(model_path):
+    """Location of the label map for a model: typing.dnn -> typing.labels.json."""
+    root, _ = os.path.splitext(model_path)
+    return root + ".labels.json"
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def build_label_map(csv_path):
+    """
+    Class index -> participant, in order of first appearance in the training
+    CSV (the order the network's output classes were assigned in).
+    """
+    labels, seen = [], set()
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f, skipinitialspace=True)
+        for row in reader:
+            row = {k.strip(): v for k, v in row.items() if k}
+            pid = (row.get("participant") or "").strip()
+            if pid and pid not in seen:
+                seen.add(pid)
+                labels.append(pid)
+    return labels
+
+
+def save_label_map(model_path, labels, source=None):
+    """Write the label map next to the model, tagged with the model's hash."""
+    path = label_map_path(model_path)
+    data = {
+        "model": os.path.basename(model_path),
+        "model_sha256": _sha256(model_path),
+        "source": os.path.basename(source) if source else None,
+        "labels": list(labels),
+    }
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, path)
+    return path
+
+
+def load_label_map(model_path, verify=True):
+    """
+    Return the class index -> participant list saved for `model_path`, or None
+    when there is no map. With verify=True a map produced for a different
+    model file is rejected (ValueError) instead of silently mislabelling.
+    """
+    path = label_map_path(model_path)
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if verify and data.get("model_sha256") != _sha256(model_path):
+        raise ValueError(f"Label map {path} was produced for a different model file")
+    labels = data.get("labels")
+    if not isinstance(labels, list) or not all(isinstance(l, str) for l in labels):
+        raise ValueError(f"Label map {path} is malformed")
+    return labels
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the class index -> participant map next to a model")
+    parser.add_argument("model", help="Path to the trained model (e.g. typing.dnn)")
+    parser.add_argument("csv", help="Training CSV the model was produced from")
+    args = parser.parse_args(argv)
+
+    labels = build_label_map(args.csv)
+    path = save_label_map(args.model, labels, source=args.csv)
+    print(f"Wrote {len(labels)} labels to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,409 @@
+import os
+import io
+import json
+import time
+import heapq
+import random
+import pstats
+import cProfile
+import threading
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Prometheus' default latency buckets (seconds)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Opt-in request profiler: METRICS_PROFILE_RATE of requests run under cProfile,
+# the METRICS_SLOW_KEEP slowest (profiled or not) are kept with their stage breakdown.
+METRICS_PROFILE_RATE = float(os.environ.get("METRICS_PROFILE_RATE", "0"))
+METRICS_SLOW_KEEP = int(os.environ.get("METRICS_SLOW_KEEP", "20"))
+
+# Pre-forked workers (serve.py sets METRICS_DIR): each process writes its
+# values there every METRICS_FLUSH_S seconds and /metrics sums every file.
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+METRICS_FLUSH_S = float(os.environ.get("METRICS_FLUSH_S", "1"))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self, values=None):
+        """Text exposition of this process' values, or of `values` ({label values: value}) if given."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        lines.extend(self._render_items(sorted(values.items())))
+        return "\n".join(lines)
+
+    def snapshot(self):
+        """[[label values, value], ...] as plain JSON-able lists."""
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._values.items()]
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_items(self, items):
+        for key, value in items:
+            yield f"{self.name}{_labels(self.labelnames, key)} {value}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1], value[2]]
+
+    @staticmethod
+    def merge(a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_items(self, items):
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, merged=None):
+        """This process' metrics, or `merged` ({name: {label values: value}}, see ProcessSnapshots)."""
+        if merged is None:
+            return "\n".join(m.render() for m in self._metrics) + "\n"
+        return "\n".join(m.render(merged.get(m.name, {})) for m in self._metrics) + "\n"
+
+    def snapshot(self):
+        return {m.name: m.snapshot() for m in self._metrics}
+
+    def merge(self, snapshots):
+        """Sum snapshot() results of several processes: {name: {label values: value}}."""
+        kinds = {m.name: m for m in self._metrics}
+        totals = {}
+        for snapshot in snapshots:
+            for name, items in snapshot.items():
+                metric = kinds.get(name)
+                if metric is None:
+                    continue
+                into = totals.setdefault(name, {})
+                for key, value in items:
+                    key = tuple(key)
+                    into[key] = metric.merge(into[key], value) if key in into else value
+        return totals
+
+
+class ProcessSnapshots:
+    """
+    Metrics of pre-forked workers, which each count only their own requests.
+    Every process writes `registry.snapshot()` to its own file in `directory`
+    every `interval` seconds (started by the first request it serves) and on
+    write(); merged() sums the files of every process, exited ones included,
+    so whichever worker answers /metrics reports the totals of all of them.
+    Without a directory nothing is written.
+    """
+
+    def __init__(self, registry, directory=None, interval=1.0):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._pid = None    # Process that owns _path (a forked worker gets its own)
+        self._path = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.directory is None or (self._pid == os.getpid() and self._thread is not None):
+            return self
+        with self._lock:
+            self._own_path()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+                self._thread.start()
+        return self
+
+    def _own_path(self):
+        """This process' file, named by pid and a random tag so a reused pid starts a new one. Lock held."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._path = os.path.join(self.directory, f"{self._pid}-{os.urandom(4).hex()}.json")
+            self._thread = None
+        return self._path
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except Exception as e:
+                logging.error(f"Could not write metrics snapshot: {e}")
+
+    def write(self):
+        """Write this process' current values (atomically, readers never see half a file)."""
+        if self.directory is None:
+            return
+        with self._lock:
+            path = self._own_path()
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.registry.snapshot(), f, separators=(",", ":"))
+            os.replace(tmp, path)
+
+    def merged(self):
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.warning(f"Skipping metrics snapshot {name}: {e}")
+        return self.registry.merge(snapshots)
+
+
+REGISTRY = Registry()
+SNAPSHOTS = ProcessSnapshots(REGISTRY, METRICS_DIR, METRICS_FLUSH_S)
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "kdt_request_seconds", "Wall time of HTTP requests.", ("endpoint", "method", "status")))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "kdt_stage_seconds", "Time spent in each pipeline stage.", ("endpoint", "stage")))
+ROWS_READ = REGISTRY.register(Counter(
+    "kdt_rows_read_total", "Typing-data rows parsed from CSV files.", ("source",)))
+DIGRAPHS_REJECTED = REGISTRY.register(Counter(
+    "kdt_digraphs_rejected_total", "Digraphs dropped by payload validation.", ("endpoint",)))
+CSV_LOCK_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "kdt_csv_lock_wait_seconds", "Time spent waiting for the CSV append lock.", ("path",)))
+
+
+# --- Per-request traces ---
+
+_current = threading.local()
+
+
+class RequestTrace:
+    def __init__(self, endpoint, method):
+        self.endpoint = endpoint
+        self.method = method
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.stages = []  # (stage, seconds) in order
+        self.profiler = None
+        self.status = None  # Set from the response; None if no response was made
+
+
+def current_trace():
+    return getattr(_current, "trace", None)
+
+
+@contextmanager
+def traced(trace):
+    """Attribute stages timed on this thread to `trace` (work a request handed to another thread)."""
+    previous = getattr(_current, "trace", None)
+    _current.trace = trace
+    try:
+        yield
+    finally:
+        _current.trace = previous
+
+
+@contextmanager
+def stage(name, endpoint=None):
+    """
+    Time a block as pipeline stage `name`. The endpoint label comes from the
+    request being handled on this thread ("background" outside requests).
+    """
+    trace = current_trace()
+    if endpoint is None:
+        endpoint = trace.endpoint if trace is not None else "background"
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, endpoint=endpoint, stage=name)
+        if trace is not None:
+            trace.stages.append((name, elapsed))
+
+
+class SlowRequestLog:
+    """
+    The `keep` slowest requests seen so far with their stage breakdown. With a
+    `sample_rate` above 0 that share of requests also runs under cProfile and
+    the slow entries carry the top of their cumulative profile.
+    """
+
+    def __init__(self, keep=20, sample_rate=0.0, profile_lines=25):
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self.profile_lines = profile_lines
+        self._heap = []  # (seconds, seq, entry)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def should_profile(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def record(self, trace, status, seconds):
+        if self.keep <= 0:
+            return
+        with self._lock:
+            if len(self._heap) >= self.keep and seconds <= self._heap[0][0]:
+                return
+        entry = {
+            "endpoint": trace.endpoint,
+            "method": trace.method,
+            "status": status,
+            "seconds": seconds,
+            "started": trace.wall_started,
+            "stages": [{"stage": s, "seconds": t} for s, t in trace.stages],
+        }
+        if trace.profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(trace.profiler, stream=out).sort_stats("cumulative").print_stats(self.profile_lines)
+            entry["profile"] = out.getvalue()
+        with self._lock:
+            self._seq += 1
+            item = (seconds, self._seq, entry)
+            if len(self._heap) < self.keep:
+                heapq.heappush(self._heap, item)
+            else:
+                heapq.heappushpop(self._heap, item)
+
+    def dump(self):
+        """Slowest first."""
+        with self._lock:
+            return [entry for _, _, entry in sorted(self._heap, key=lambda i: -i[0])]
+
+
+SLOW_REQUESTS = SlowRequestLog(METRICS_SLOW_KEEP, METRICS_PROFILE_RATE)
+
+
+def instrument(app):
+    """
+    Time every request of a Flask app, and add GET /metrics (Prometheus text
+    format; every worker's totals when METRICS_DIR is set, this process'
+    otherwise) and GET /metrics/slow (this process' slowest requests).
+    """
+    from flask import request, jsonify, Response
+
+    @app.before_request
+    def _start_trace():
+        rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        trace = RequestTrace(rule, request.method)
+        if SLOW_REQUESTS.should_profile():
+            trace.profiler = cProfile.Profile()
+            trace.profiler.enable()
+        _current.trace = trace
+
+    @app.teardown_request
+    def _finish_trace(exc):
+        trace = current_trace()
+        if trace is None:
+            return
+        _current.trace = None
+        if trace.profiler is not None:
+            trace.profiler.disable()
+        seconds = time.perf_counter() - trace.started
+        SNAPSHOTS.start()
+        # An unhandled exception is a 500 whatever response status was recorded
+        status = 500 if exc is not None else trace.status or 200
+        REQUEST_SECONDS.observe(seconds, endpoint=trace.endpoint, method=trace.method, status=status)
+        try:
+            SLOW_REQUESTS.record(trace, status, seconds)
+        except Exception as e:
+            logging.error(f"Could not record slow request: {e}")
+
+    @app.after_request
+    def _status(response):
+        trace = current_trace()
+        if trace is not None:
+            trace.status = response.status_code
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics_endpoint():
+        if SNAPSHOTS.directory is None:
+            return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+        # Our own values are current, the other workers' at most METRICS_FLUSH_S old
+        SNAPSHOTS.write()
+        return Response(REGISTRY.render(SNAPSHOTS.merged()), mimetype="text/plain; version=0.0.4")
+
+    @app.route("/metrics/slow", methods=["GET"])
+    def slow_requests_endpoint():
+        return jsonify(slow_requests=SLOW_REQUESTS.dump(), sample_rate=SLOW_REQUESTS.sample_rate)
+
+    return app
@@ -0,0 +1,427 @@
+import os
+import re
+import csv
+import time
+import queue
+import threading
+import logging
+
+from label_map import load_label_map, label_map_path
+from metrics import REGISTRY, Counter, Histogram
+
+MODEL_PREDICT_SECONDS = REGISTRY.register(Histogram(
+    "kdt_model_predict_seconds", "DNN batch prediction time by model version.", ("version", "role")))
+SHADOW_PREDICTIONS = REGISTRY.register(Counter(
+    "kdt_shadow_predictions_total", "Shadow model predictions compared with the active model.",
+    ("active", "shadow", "result")))
+
+TIMING_KEYS = ["DU.key1.key1", "DD.key1.key2", "DU.key1.key2", "UD.key1.key2", "UU.key1.key2"]
+ACTIVE_FILE = "ACTIVE"  # Pins the active version (rollback); otherwise the newest version wins
+SHADOW_FILE = "SHADOW"  # Names a version to run side by side with the active one
+
+
+class Prediction(int):
+    """A class index that remembers which model version produced it."""
+
+    def __new__(cls, index, version):
+        obj = super().__new__(cls, index)
+        obj.version = version
+        return obj
+
+
+class _GlobalEngine:
+    """
+    Engine for backends that keep a single global model (the native
+    dnn_wrapper): whichever version is asked to predict is (re)loaded under a
+    lock first, so in-flight batches always finish on the model they started on.
+    """
+
+    _lock = threading.Lock()
+    _loaded = {}  # backend module name -> path currently loaded
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        if self._loaded.get(self.backend.__name__) != self.path:
+            self.backend.load_model(self.path)
+            self._loaded[self.backend.__name__] = self.path
+
+    def predict_batch(self, samples, rows, cols):
+        with self._lock:
+            self._load()
+            predict_batch = getattr(self.backend, "predict_batch", None)
+            if predict_batch is not None:
+                return list(predict_batch(samples, rows, cols))
+            return [self.backend.predict(flat, rows, cols) for flat in samples]
+
+
+def load_engine(backend, path, exclusive=False):
+    """
+    Load `path` with `backend`. Backends exposing a model class (dnn_numpy)
+    give independent instances; others share their global model. With
+    exclusive=True a global backend is replaced by dnn_numpy so two versions
+    can stay resident (shadow mode).
+    """
+    model_class = getattr(backend, "DnnModel", None)
+    if model_class is None and exclusive:
+        import dnn_numpy
+        model_class = dnn_numpy.DnnModel
+    if model_class is not None:
+        return model_class.load(path)
+    return _GlobalEngine(backend, path)
+
+
+def holdout_from_csv(path, rows=3, limit=200):
+    """
+    Up to `limit` samples of `rows` consecutive digraphs from a typing CSV,
+    never spanning two participant/sessions, with their participant labels.
+    """
+    samples, labels = [], []
+    if not path or not os.path.isfile(path):
+        return samples, labels
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f, skipinitialspace=True)
+        window, owner = [], None
+        for row in reader:
+            row = {k.strip(): v for k, v in row.items() if k}
+            key = (row.get("participant"), row.get("session"))
+            try:
+                values = [float(row[k]) for k in TIMING_KEYS]
+            except (KeyError, TypeError, ValueError):
+                window, owner = [], None
+                continue
+            if key != owner:
+                window, owner = [], key
+            window.extend(values)
+            if len(window) == rows * len(TIMING_KEYS):
+                samples.append(window)
+                labels.append(key[0])
+                window = []
+                if len(samples) >= limit:
+                    break
+    return samples, labels
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def _mtimes(path):
+    """(model mtime, label map mtime or None): replacing either file makes a new version."""
+    try:
+        labels = os.path.getmtime(label_map_path(path))
+    except FileNotFoundError:
+        labels = None
+    return os.path.getmtime(path), labels
+
+
+class ModelVersion:
+    def __init__(self, name, path, engine, labels, validation):
+        self.name = name
+        self.path = path
+        self.engine = engine
+        self.labels = labels or []
+        self.validation = validation
+        self.loaded_at = time.time()
+        self.mtime = _mtimes(path)
+
+    def predict_batch(self, samples, rows, cols, role="active"):
+        start = time.perf_counter()
+        results = self.engine.predict_batch(samples, rows, cols)
+        MODEL_PREDICT_SECONDS.observe(time.perf_counter() - start, version=self.name, role=role)
+        return [Prediction(int(r), self) for r in results]
+
+    def describe(self):
+        return {
+            "version": self.name,
+            "path": self.path,
+            "classes": getattr(self.engine, "num_classes", None) or len(self.labels) or None,
+            "loaded_at": self.loaded_at,
+            "validation": self.validation,
+        }
+
+
+class ModelRegistry:
+    """
+    Versioned typing models, hot-swapped without restarting workers.
+
+    Versions are `<name>.dnn` files (with an optional `<name>.labels.json`)
+    in `models_dir`; without any, `fallback_path` is served as the only
+    version. A watcher thread polls the directory, loads a new version off
+    the request path, validates it on a held-out sample and then swaps it in
+    with a single reference assignment: batches already running keep the
+    version they started with, new ones get the new version. A file named
+    ACTIVE pins a version (rollback); one named SHADOW runs that version on
+    the same inputs after each active batch, on its own thread, to compare
+    latency and agreement without affecting responses.
+    """
+
+    def __init__(self, models_dir, backend, fallback_path=None, holdout=None, rows=3,
+                 min_accuracy=0.0, poll_interval=2.0, shadow_queue=64):
+        self.models_dir = models_dir
+        self.backend = backend
+        self.fallback_path = fallback_path
+        self.holdout = holdout  # () -> (samples, participant labels); labels may be empty
+        self.rows = rows
+        self.min_accuracy = min_accuracy
+        self.poll_interval = poll_interval
+        self._active = None
+        self._shadow = None
+        self._loaded = {}        # (name, mtimes, exclusive) -> ModelVersion in use
+        self._failed = {}        # (name, mtimes, exclusive) -> error, not retried until a file changes
+        self._signature = None
+        self._reload_lock = threading.Lock()
+        self._stats_lock = threading.Lock()  # shadow_stats, updated from request and shadow threads
+        self._shadow_queue = queue.Queue(shadow_queue)
+        self._threads_pid = None
+        self._threads = []
+        self._stopped = threading.Event()
+        self.shadow_stats = {"compared": 0, "agreed": 0, "dropped": 0, "errors": 0}
+
+    # --- Versions on disk ---
+
+    def _available(self):
+        """name -> path of the versions on disk."""
+        found = {}
+        if self.models_dir and os.path.isdir(self.models_dir):
+            for entry in os.listdir(self.models_dir):
+                if entry.endswith(".dnn"):
+                    found[entry[:-4]] = os.path.join(self.models_dir, entry)
+        if not found and self.fallback_path and os.path.isfile(self.fallback_path):
+            name = os.path.splitext(os.path.basename(self.fallback_path))[0]
+            found[name] = self.fallback_path
+        return found
+
+    def _pin(self, filename):
+        if not self.models_dir:
+            return None
+        try:
+            with open(os.path.join(self.models_dir, filename), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _current_signature(self):
+        available = self._available()
+        stats = []
+        for name, path in sorted(available.items()):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            labels = label_map_path(path)
+            try:
+                lst = os.stat(labels)
+                labels_stat = (lst.st_size, lst.st_mtime)
+            except FileNotFoundError:
+                labels_stat = None
+            stats.append((name, st.st_size, st.st_mtime, labels, labels_stat))
+        return tuple(stats), self._pin(ACTIVE_FILE), self._pin(SHADOW_FILE)
+
+    # --- Loading and swapping ---
+
+    def _load(self, name, path, exclusive=False):
+        key = (name, _mtimes(path), exclusive)
+        version = self._loaded.get(key)
+        if version is not None:
+            return version
+        if key in self._failed:
+            raise RuntimeError(self._failed[key])
+        try:
+            labels = None
+            try:
+                labels = load_label_map(path)
+            except ValueError as e:
+                logging.warning(f"Model {name}: {e}; predictions will not be resolved to participants")
+            engine = load_engine(self.backend, path, exclusive)
+            version = ModelVersion(name, path, engine, labels, None)
+            version.validation = self._validate(version)
+        except Exception as e:
+            self._failed[key] = str(e)
+            raise
+        self._loaded[key] = version
+        return version
+
+    def _validate(self, version):
+        """Score the held-out sample; raise if the model errors, answers out of range or is too inaccurate."""
+        samples, labels = self.holdout() if self.holdout else ([], [])
+        if not samples:
+            return {"samples": 0, "accuracy": None}
+        start = time.perf_counter()
+        predictions = version.engine.predict_batch(samples, self.rows, len(TIMING_KEYS))
+        seconds = time.perf_counter() - start
+        classes = getattr(version.engine, "num_classes", None) or len(version.labels) or None
+        if classes is not None and any(not 0 <= int(p) < classes for p in predictions):
+            raise RuntimeError(f"Model {version.name} predicted classes outside 0..{classes - 1}")
+        accuracy = None
+        if version.labels and labels:
+            hits = sum(0 <= p < len(version.labels) and version.labels[p] == l for p, l in zip(predictions, labels))
+            accuracy = hits / len(labels)
+            if accuracy < self.min_accuracy:
+                raise RuntimeError(f"Model {version.name} held-out accuracy {accuracy:.3f} < {self.min_accuracy}")
+        return {"samples": len(samples), "accuracy": accuracy, "seconds": seconds}
+
+    def reload(self):
+        """Bring the active (and shadow) version in line with the directory; returns True if anything changed."""
+        with self._reload_lock:
+            signature = self._current_signature()
+            if signature == self._signature:
+                return False
+            self._signature = signature
+            available = self._available()
+            pinned, shadow_name = signature[1], signature[2]
+            if pinned is not None and pinned not in available:
+                logging.error(f"Pinned model version '{pinned}' not found in {self.models_dir}")
+                pinned = None
+            candidates = [pinned] if pinned else sorted(available, key=_natural_key, reverse=True)
+
+            changed = False
+            for name in candidates:
+                if self._active is not None and self._active.name == name and \
+                        self._active.mtime == _mtimes(available[name]):
+                    break  # Already serving the preferred version
+                try:
+                    version = self._load(name, available[name])
+                except Exception as e:
+                    logging.error(f"Model version '{name}' rejected: {e}")
+                    continue
+                previous, self._active = self._active, version
+                changed = True
+                logging.info(f"Serving model version '{name}' (was '{previous.name if previous else None}'), "
+                             f"validation {version.validation}")
+                break
+            if self._active is None:
+                logging.error("No usable model version; predictions will fail")
+
+            shadow = None
+            if shadow_name and shadow_name in available and \
+                    (self._active is None or shadow_name != self._active.name):
+                try:
+                    shadow = self._load(shadow_name, available[shadow_name], exclusive=True)
+                except Exception as e:
+                    logging.error(f"Shadow model version '{shadow_name}' rejected: {e}")
+            if shadow is not self._shadow:
+                logging.info(f"Shadow model version: {shadow.name if shadow else None}")
+                self._shadow, changed = shadow, True
+            # Keep only what is in use
+            in_use = {self._active, self._shadow}
+            self._loaded = {k: v for k, v in self._loaded.items() if v in in_use}
+            return changed
+
+    def start(self):
+        """Initial (blocking) load, then the watcher and shadow threads."""
+        self.reload()
+        return self.start_threads()
+
+    def start_threads(self):
+        """Start the watcher and shadow threads (again in a forked worker, which inherits the models but not the threads)."""
+        if self._threads_pid == os.getpid() and self._threads:
+            return self
+        if self._threads_pid not in (None, os.getpid()):
+            self._reload_lock = threading.Lock()
+            self._stats_lock = threading.Lock()
+            self._shadow_queue = queue.Queue(self._shadow_queue.maxsize)
+            _GlobalEngine._lock = threading.Lock()
+        self._threads_pid = os.getpid()
+        self._stopped = threading.Event()
+        self._threads = [threading.Thread(target=target, args=(self._stopped,), name=name, daemon=True)
+                         for target, name in ((self._watch, "model-watcher"), (self._run_shadow, "model-shadow"))]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop_threads(self, timeout=None):
+        """Stop the watcher and shadow threads (e.g. before forking); start_threads() starts them again."""
+        if self._threads_pid != os.getpid() or not self._threads:
+            return
+        self._stopped.set()
+        try:
+            self._shadow_queue.put_nowait(None)  # Wakes the shadow thread (a full queue wakes it anyway)
+        except queue.Full:
+            pass
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _watch(self, stopped):
+        while not stopped.wait(self.poll_interval):
+            try:
+                self.reload()
+            except Exception as e:
+                logging.error(f"Model registry reload failed: {e}")
+
+    # --- Serving ---
+
+    def active(self):
+        return self._active
+
+    def predict_batch(self, samples, rows, cols):
+        """MicroBatcher-compatible: one version for the whole batch, Prediction results."""
+        version = self._active
+        if version is None:
+            raise RuntimeError("No model loaded")
+        results = version.predict_batch(samples, rows, cols)
+        if self._shadow is not None:
+            try:
+                self._shadow_queue.put_nowait((self._shadow, samples, rows, cols, results))
+            except queue.Full:
+                with self._stats_lock:
+                    self.shadow_stats["dropped"] += 1
+        return results
+
+    def _run_shadow(self, stopped):
+        while True:
+            item = self._shadow_queue.get()
+            if item is None or stopped.is_set():
+                return
+            shadow, samples, rows, cols, results = item
+            try:
+                theirs = shadow.predict_batch(samples, rows, cols, role="shadow")
+            except Exception as e:
+                with self._stats_lock:
+                    self.shadow_stats["errors"] += 1
+                logging.debug(f"Shadow model {shadow.name} failed: {e}")
+                continue
+            for ours, other in zip(results, theirs):
+                # Compare participants when both have label maps (class orders may differ)
+                if ours.version.labels and shadow.labels:
+                    agree = _resolve(ours) == _resolve(other)
+                else:
+                    agree = int(ours) == int(other)
+                with self._stats_lock:
+                    self.shadow_stats["compared"] += 1
+                    self.shadow_stats["agreed"] += agree
+                SHADOW_PREDICTIONS.inc(active=ours.version.name, shadow=shadow.name,
+                                       result="agree" if agree else "disagree")
+
+    def status(self):
+        with self._stats_lock:
+            stats = dict(self.shadow_stats)
+        stats["agreement"] = stats["agreed"] / stats["compared"] if stats["compared"] else None
+        return {
+            "models_dir": self.models_dir,
+            "available": sorted(self._available(), key=_natural_key),
+            "active": self._active.describe() if self._active else None,
+            "shadow": self._shadow.describe() if self._shadow else None,
+            "shadow_stats": stats,
+            "rejected": [{"version": k[0], "error": v} for k, v in self._failed.items()],
+        }
+
+
+def _resolve(prediction):
+    labels = prediction.version.labels
+    return labels[prediction] if 0 <= prediction < len(labels) else None
+
+
+def resolve_label(prediction, registry=None):
+    """Participant for a prediction, using the label map of the version that made it."""
+    if prediction is None:
+        return None
+    version = getattr(prediction, "version", None) or (registry.active() if registry else None)
+    if version is None or not 0 <= prediction < len(version.labels):
+        return None
+    return version.labels[prediction]
@@ -0,0 +1,90 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Binary /predict body: N*5 little-endian float32 timings followed by N*2
+# little-endian uint32 key code points (key1, key2). participant and session
+# travel in the query string.
+PACKED_MIMETYPE = "application/x-digraphs-f32"
+FEATURES_PER_DIGRAPH = 5
+_ROW_BYTES = FEATURES_PER_DIGRAPH * 4 + 2 * 4
+
+Digraphs = namedtuple("Digraphs", ["keys", "features", "received"])
+Digraphs.__doc__ = """
+Validated digraphs: `keys` is a list of (key1, key2) strings, `features` a
+float64 [N, 5] array of the rows that passed validation and `received` the
+number of digraphs in the payload before validation.
+"""
+
+
+class PayloadError(ValueError):
+    """The payload is structurally unusable (wrong sizes, types or encoding)."""
+
+
+def _valid_codes(codes):
+    """Unicode scalar values only (no NUL, no surrogates, nothing past U+10FFFF)."""
+    return (codes > 0) & (codes < 0x110000) & ((codes < 0xD800) | (codes > 0xDFFF))
+
+
+def _select(codes, features):
+    valid = _valid_codes(codes).all(axis=1) & np.isfinite(features).all(axis=1)
+    codes = codes[valid]
+    keys = list(zip(map(chr, codes[:, 0].tolist()), map(chr, codes[:, 1].tolist())))
+    return keys, features[valid]
+
+
+def parse_packed(body):
+    """Decode and validate a PACKED_MIMETYPE request body."""
+    if not body or len(body) % _ROW_BYTES:
+        raise PayloadError(f"Packed payload size must be a non-zero multiple of {_ROW_BYTES} bytes")
+    n = len(body) // _ROW_BYTES
+    features = np.frombuffer(body, dtype="<f4", count=n * FEATURES_PER_DIGRAPH).reshape(n, FEATURES_PER_DIGRAPH)
+    codes = np.frombuffer(body, dtype="<u4", offset=n * FEATURES_PER_DIGRAPH * 4).reshape(n, 2).astype(np.int64)
+    # float32 carries ~7 significant digits; round to 0.1 us so the text CSV doesn't get float32 noise
+    keys, features = _select(codes, np.round(features.astype(np.float64), 4))
+    return Digraphs(keys, features, n)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _key_codes(column, name, n=None):
+    if isinstance(column, str):
+        codes = np.frombuffer(column.encode("utf-32-le", "surrogatepass"), dtype="<u4").astype(np.int64)
+    elif isinstance(column, list) and all(isinstance(k, str) and len(k) == 1 for k in column):
+        codes = np.frombuffer("".join(column).encode("utf-32-le", "surrogatepass"), dtype="<u4").astype(np.int64)
+    else:
+        raise PayloadError(f"'{name}' must be a string or a list of single characters")
+    if n is not None and len(codes) != n:
+        raise PayloadError(f"'{name}' has {len(codes)} keys, expected {n}")
+    return codes
+
+
+def parse_columnar(data):
+    """
+    Decode and validate the columnar JSON form:
+    {"format": "columnar", "key1": "hel", "key2": "ell", "features": [...N*5 or N x 5...]}
+    """
+    raw = data.get("features")
+    if not isinstance(raw, list) or not raw:
+        raise PayloadError("'features' must be a non-empty numeric array")
+    # Checked before numpy sees them: it would parse "1.5" and true as numbers
+    rows = raw if all(isinstance(row, list) for row in raw) else [raw]
+    if not all(_is_number(v) for row in rows for v in row):
+        raise PayloadError("'features' values must be numbers (not strings or booleans)")
+    try:
+        # JSON numbers are doubles already; float64 keeps them exact (ragged rows raise here)
+        features = np.array(raw, dtype=np.float64)
+    except (ValueError, OverflowError) as e:
+        raise PayloadError("'features' must be a non-empty numeric array") from e
+    if features.size == 0:
+        raise PayloadError("'features' must be a non-empty numeric array")
+    if features.size % FEATURES_PER_DIGRAPH or features.ndim not in (1, 2) or \
+            (features.ndim == 2 and features.shape[1] != FEATURES_PER_DIGRAPH):
+        raise PayloadError(f"'features' must hold {FEATURES_PER_DIGRAPH} values per digraph")
+    features = features.reshape(-1, FEATURES_PER_DIGRAPH)
+    n = len(features)
+    codes = np.stack([_key_codes(data.get("key1"), "key1", n), _key_codes(data.get("key2"), "key2", n)], axis=1)
+    keys, features = _select(codes, features)
+    return Digraphs(keys, features, n)
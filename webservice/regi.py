@@ -1,22 +1,65 @@
 
 # IMPORTS DE LIBS PROPRIAS
 from database.db_connect import drop_db, create_db, add_user_and_passw, check_user_and_passw, get_user_id
-from knn_sdk.ClassificadorKNN import Classificador
-import datetime
+from csv_appender import CsvAppender
+from shard_store import ShardStore, ShardedAppender
+from metrics import instrument, stage
+from audit_log import AuditLog
+from warmup import Warmup
+from admission import Bulkhead, register as register_admission
+import time
 
-import csv
 from flask import Flask, render_template, request, jsonify, url_for
 
-import dnn_wrapper
-
-dnn_wrapper.load_model("typing.dnn")
-pred = dnn_wrapper.predict(flat_sample, rows, cols)
-
 TYPING_DATA_PATH = './database/biometria.csv' # Pasta onde será salvo os dados .csv e banco
-LOG_NAME = 'resultados.log'
+BIOMETRIA_SHARDS_DIR = './database/biometria_shards' # Com manifest.json (python shard_store.py migrate ... --key CLASS) usa um csv por usuario
+SHARD_WRITERS = 4 # Threads de gravacao em lote quando o csv esta dividido por usuario
+LOG_NAME = 'resultados.jsonl' # Log de auditoria em JSON Lines (FAR/FRR: python audit_log.py resultados.jsonl)
+LOG_MAX_BYTES = 10 * 1024 * 1024 # Rotaciona para resultados.jsonl.1 .. .5 ao passar deste tamanho
 K = 1
-SPLIT = 0.8
+CV_FOLDS = 5 # ~80/20 treino/teste em cada fold
+TUNING_FOLDS = 3
+TUNING_CACHE_DIR = './database/tuning_cache' # Resultados do best_params por hash (dados + grade)
+AUTH2_MODE = '1:1' # '1:1' verifica so o usuario informado; '1:N' classifica contra todos os usuarios
+# No modo 1:1 o campo 'predict' do auth2 e o user_id informado se a amostra foi aceita, senao '-';
+# no 1:N continua sendo o usuario previsto pelo KNN
+VERIFY_MARGIN = 1.0 # Multiplicador do limiar de cada usuario no modo 1:1
+VERIFY_SPREAD = 2.0 # Limiar = mediana + VERIFY_SPREAD * MAD das distancias leave-one-out do usuario
+# Controle de admissao: o trabalho de ML roda em pools proprios e limitados (threads + fila).
+# Passando do limite a resposta e 503 com Retry-After na hora, sem prender as threads das rotas leves.
+# A soma de workers + fila dos pools deve ficar abaixo das threads por processo (serve.py --threads, 8)
+AUTH2_WORKERS = 2 # Verificacoes/classificacoes simultaneas do /login/auth2
+AUTH2_QUEUE = 2 # Logins esperando por uma thread livre antes de recusar
+AUTH2_MAX_WAIT = 2.0 # Segundos na fila; depois disso o login e descartado com 503
+TUNING_WORKERS = 1 # Chamadas simultaneas de /best_params (hash dos dados + disparo do job)
+TUNING_QUEUE = 1
+TUNING_MAX_WAIT = 5.0
 app = Flask(__name__, static_folder='./static')
+instrument(app) # Tempo por etapa em GET /metrics, requisicoes mais lentas em GET /metrics/slow
+
+# Modelos (numpy, KNN, validacao cruzada, busca de parametros) carregados por uma
+# thread de aquecimento: /, /login e /cadastro respondem sem esperar por eles e
+# GET /ready passa a 200 quando terminam. Rotas que usam o modelo aguardam.
+warmup = Warmup()
+warmup.register(app)
+knn_model = None # Modelo KNN residente: ajustado uma unica vez e atualizado com as linhas novas do csv
+cv_metric = None # Acuracia (validacao cruzada) recalculada em segundo plano somente quando os dados mudam
+verifier = None # Verificacao 1:1: compara a amostra apenas com os templates do usuario informado
+tuning_jobs = None # Busca de hiperparametros em segundo plano (pool de processos + cache por hash dos dados e da grade)
+VERIFY_ALGORITHM = None
+# Gravacao em lote no csv (um fsync por lote, com trava de arquivo entre processos).
+# Dividido por usuario, cada arquivo tem sua propria trava e usuarios diferentes nao se esperam
+biometria_shards = ShardStore(BIOMETRIA_SHARDS_DIR).open() if ShardStore.exists(BIOMETRIA_SHARDS_DIR) else None
+if biometria_shards is not None:
+	csv_appender = ShardedAppender(biometria_shards, writers=SHARD_WRITERS).start()
+else:
+	csv_appender = CsvAppender(TYPING_DATA_PATH).start()
+# Log de auditoria gravado em lote por uma thread, fora da requisicao
+audit_log = AuditLog(LOG_NAME, max_bytes=LOG_MAX_BYTES).start()
+# Pools limitados das rotas de ML (fila e recusas em GET /metrics, ocupacao em GET /admission)
+auth2_pool = Bulkhead('auth2', AUTH2_WORKERS, AUTH2_QUEUE, AUTH2_MAX_WAIT)
+tuning_pool = Bulkhead('best_params', TUNING_WORKERS, TUNING_QUEUE, TUNING_MAX_WAIT, retry_after=5)
+register_admission(app, (auth2_pool, tuning_pool))
 
 @app.route('/')
 def home():
@@ -39,6 +82,7 @@ def cadastro():
 
 
 @app.route('/cadastro/biometria', methods = ['POST'])
+@warmup.required
 def biometria():
 	if request.method == 'POST':
 		response = dict(request.get_json())
@@ -46,15 +90,16 @@ def biometria():
 		data = response['data']
 		data.append(user_id) # adiciona o user id ao fim da lista
 		try:
-			with open(TYPING_DATA_PATH, 'a', newline='') as file:			
-				writer = csv.writer(file)
-				writer.writerow(data)
+			with stage('csv_append'):
+				csv_appender.append([data], durable=True) # Cadastro so responde depois de gravado em disco
+			atualizar_modelo(user_id) # Le so as linhas novas do csv, sem reajuste completo
 
 			return jsonify({'biometric_cod': 'Success'})
 		except:
 			return jsonify({'biometric_cod': 'Não foi possivel cadastrar os dados biometricos'})
 
 @app.route('/treinar/biometria', methods = ['POST'])
+@warmup.required
 def treinar():
 	if request.method == 'POST':
 		response = dict(request.get_json())
@@ -65,9 +110,9 @@ def treinar():
 			user_id = 999 
 		data.append(user_id) # adiciona o user id ao fim da lista
 		try:
-			with open(TYPING_DATA_PATH, 'a', newline='') as file:			
-				writer = csv.writer(file)
-				writer.writerow(data)
+			with stage('csv_append'):
+				gravacao = csv_appender.append([data]) # Treino pode ser gravado no proximo lote
+			gravacao.add_done_callback(lambda _: atualizar_modelo(user_id)) # Entra no modelo quando chegar ao disco
 
 			return jsonify({'biometric_cod': 'Success'})
 		except:
@@ -84,7 +129,8 @@ def auth1():
 	username  = response['username']
 	password = response['password']
 
-	id, result, user_id = check_user_and_passw(username, password)
+	with stage('db_lookup'):
+		id, result, user_id = check_user_and_passw(username, password)
 
 	if result:
 		return jsonify({'auth1_code': 'success', 'id_usuario': user_id})
@@ -95,42 +141,51 @@ def auth1():
 			return jsonify({'auth1_code': 'PasswordIsWrong'})
 
 @app.route('/login/auth2', methods = ['POST']) # Rota para a segunda autenticação
+@warmup.required
 def auth2():
-	response = dict(request.get_json())
+	inicio = time.perf_counter()
+	with stage('parse'):
+		response = dict(request.get_json())
 	amostra_digitacao  = response['typing_data']
 	user_id = response['user_id']
 	
-	##### Classificação
-	classifica = Classificador(TYPING_DATA_PATH, amostra_digitacao, SPLIT, K)
-	resultado = classifica.knn_manhattan_sem_treino()
-	cross_val_score = classifica.get_cv_score()
+	# Cadastros feitos por outros workers (serve.py --workers N): le so o que foi acrescentado ao csv
+	atualizar_modelo(user_id if AUTH2_MODE == '1:1' else None)
+	cross_val_score = cv_metric.value # Valor em cache, sem validacao cruzada por login
+	# Roda no pool do auth2: com ele cheio o login recebe 503 (Overloaded) em vez de esperar
+	match, resultado, limiar = auth2_pool.call(comparar_amostra, user_id, amostra_digitacao)
+	
+	registro = {'user_id': str(user_id), 'predicted': str(resultado[0]), 'algorithm': resultado[2], 'k': K,
+				'match': match, 'accuracy': cross_val_score, 'distance': resultado[1], 'threshold': limiar,
+				'mode': AUTH2_MODE, 'latency_ms': round((time.perf_counter() - inicio) * 1000, 3)}
+	if 'genuine' in response: # Campanhas de teste marcam tentativas de impostor com genuine=false
+		registro['genuine'] = response['genuine']
+	with stage('log_write'):
+		audit_log.log('auth2', **registro)
+
+	return jsonify({'user_id':str(user_id), 'predict': resultado[0], 'accuracy': cross_val_score, 'result': str(match), 'algoritimo': resultado[2], 'distance': resultado[1], 'threshold': limiar})
 
-	if str(user_id) in resultado[0]:
-		match = True
+def atualizar_modelo(user_id=None):
+	# O modelo residente segue o csv (ou o arquivo do usuario, se dividido) pelo offset, como o TypingIndex;
+	# assim cada worker enxerga os cadastros gravados pelos outros
+	with stage('knn_refresh'):
+		novas = knn_model.refresh(user_id)
+	if novas:
+		cv_metric.notify()
+
+def comparar_amostra(user_id, amostra_digitacao):
+	if AUTH2_MODE == '1:1':
+		##### Verificação (custo proporcional as amostras do usuario informado)
+		with stage('verify'):
+			match, distancia, limiar = verifier.verify(user_id, amostra_digitacao)
+		resultado = (str(user_id) if match else '-', distancia, VERIFY_ALGORITHM)
 	else:
-		match = False
-	
-	data_hora_atual = datetime.datetime.now()
-	data_atual = data_hora_atual.strftime("%d/%m/%Y %H:%M:%S ")
-    
-	with open(LOG_NAME, 'a') as arquivo: # Cria o arquivo de log
-		arquivo.write('[+]  Usuario Real: ')
-		arquivo.write(str(user_id))
-		arquivo.write(' | Usuario Previsto: ')
-		arquivo.write(str(resultado[0]))
-		arquivo.write(' | Algoritimo: ')
-		arquivo.write(str(resultado[2]))
-		arquivo.write(' | Valor de K: ')
-		arquivo.write(str(K))
-		arquivo.write(' | Match: ')
-		arquivo.write(str(match))
-		arquivo.write(' | Accuracy: ')
-		arquivo.write(str(cross_val_score))
-		arquivo.write(' | Data: ')
-		arquivo.write(data_atual)
-		arquivo.write('\n')
-
-	return jsonify({'user_id':str(user_id), 'predict': resultado[0], 'accuracy': cross_val_score, 'result': str(match), 'algoritimo': resultado[2]})
+		##### Classificação 1:N (consulta ao modelo residente inteiro)
+		with stage('classify'):
+			resultado = knn_model.classify(amostra_digitacao)
+		limiar = None
+		match = resultado[0] == str(user_id)
+	return match, resultado, limiar
 
 @app.route('/treinar', methods = ['GET', 'POST'])
 def treina_bio():
@@ -141,28 +196,73 @@ def treina_bio():
 def best_params():
 	return render_template('./best_params/best_params.html')
 
+def log_best_params(resultado):
+	best_score = resultado['best_score']
+	best_params = resultado['best_params']
+	best_estimator = resultado['best_estimator']
+
+	audit_log.log('best_params', best_score=best_score, best_params=best_params, best_estimator=str(best_estimator))
+
+@warmup.step('knn')
+def carregar_modelos():
+	global knn_model, cv_metric, verifier, tuning_jobs, VERIFY_ALGORITHM
+	# Imports aqui de proposito: numpy e o resto da pilha de ML ficam fora do import do app
+	from knn_model import ResidentKNN, ClaimVerifier, VERIFY_ALGORITHM
+	from cv_metric import BackgroundCVScore
+	from tuning_jobs import TuningJobs
+
+	modelo = ResidentKNN(TYPING_DATA_PATH, K, shards=biometria_shards).load()
+	cv_metric = BackgroundCVScore(modelo, K, CV_FOLDS).start()
+	verifier = ClaimVerifier(modelo, VERIFY_MARGIN, VERIFY_SPREAD).prime() # Limiares calculados aqui, nao no primeiro login
+	tuning_jobs = TuningJobs(lambda: knn_model.snapshot()[:2], TUNING_FOLDS,
+							 cache_dir=TUNING_CACHE_DIR, on_done=log_best_params)
+	knn_model = modelo
+
+@app.route('/best_params/jobs', methods = ['POST'])
+@warmup.required
+def best_params_submit():
+	response = request.get_json(silent=True) or {}
+	try:
+		job = tuning_pool.call(tuning_jobs.submit, response.get('grid'))
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
+	return jsonify(job), 200 if job['status'] == 'done' else 202
+
+@app.route('/best_params/jobs/<job_id>', methods = ['GET'])
+@warmup.required
+def best_params_job(job_id):
+	job = tuning_jobs.status(job_id)
+	if job is None:
+		return jsonify({'error': 'Job não encontrado'}), 404
+	return jsonify(job)
+
 @app.route('/best_params/result', methods = ['GET'])
+@warmup.required
 def best_params_result():
-	amostra_digitacao = '' # Aritificio para permitir a utilização da classe
-	classifica = Classificador(TYPING_DATA_PATH, amostra_digitacao, 0.7, 3)
-	best_score, best_params, best_estimator = classifica.hyper_parameters_tuning()
-
-	data_hora_atual = datetime.datetime.now()
-	data_atual = data_hora_atual.strftime("%d/%m/%Y %H:%M:%S ")
-
-	with open(LOG_NAME, 'a') as arquivo: # Cria o arquivo de log
-		arquivo.write('[+]  Best Score: ')
-		arquivo.write(str(best_score))
-		arquivo.write(' |  Best Params: ')
-		arquivo.write(str(best_params))
-		arquivo.write(' |  Best Estimator: ')
-		arquivo.write(str(best_estimator))
-		arquivo.write(' | Data: ')
-		arquivo.write(data_atual)
-		arquivo.write('\n')
-
-	return jsonify({'best_score':str(best_score), 'best_params': str(best_params), 'best_estimator': str(best_estimator) })
+	# Mantido por compatibilidade: devolve o resultado em cache ou o job para acompanhamento
+	job = tuning_pool.call(tuning_jobs.submit)
+	if job['status'] != 'done':
+		return jsonify(job), 202
+	resultado = job['result']
+	return jsonify({'best_score':str(resultado['best_score']), 'best_params': str(resultado['best_params']), 'best_estimator': str(resultado['best_estimator']), 'job_id': job['job_id'] })
 	
+def shutdown():
+	# Chamado pelo serve.py no pai antes do fork e em cada worker ao sair: grava o que
+	# esta na fila e para as threads (um worker nao pode herdar uma trava presa por elas)
+	if cv_metric is not None:
+		cv_metric.stop()
+	csv_appender.close()
+	audit_log.close()
+
+def post_fork():
+	# Chamado pelo serve.py em cada worker: threads nao sobrevivem ao fork
+	csv_appender.start()
+	audit_log.start()
+	if cv_metric is not None:
+		cv_metric.start()
+
+warmup.start() # Depois de todas as rotas e funcoes definidas (carregar_modelos usa log_best_params)
+
 # Server Start
 if __name__ == '__main__':
 	app.run(host='127.0.0.1', debug=True, port=3000)
@@ -0,0 +1,342 @@
+"""
+Production launcher: preload an app once, then fork workers that share it.
+
+    python serve.py server --workers 4 --threads 8 --bind 127.0.0.1:3000
+
+The parent imports the app module and waits for its warm-up (model, label
+map, typing index, KNN data), freezes the GC so those objects stay in
+copy-on-write pages, opens the listening socket and forks the workers. Each
+worker serves the shared socket with a fixed pool of request threads.
+
+Signals to the parent: SIGHUP restarts the workers one by one (a new one is
+forked before an old one is stopped), SIGTERM/SIGINT stop them gracefully:
+they stop accepting, finish in-flight requests for up to --graceful-timeout
+seconds and are killed after that. Dead workers are replaced.
+
+Keep-alive connections hold a request thread while idle, so a connection
+that sends no new request within --keepalive seconds is closed (0 closes
+every connection after its response). The fixed thread pool is never pinned
+by idle clients for the whole --timeout.
+
+App modules may define shutdown() to flush their writers and stop their
+background threads, and post_fork() to start them again. The parent calls
+shutdown() before forking, so no worker inherits a lock held by a thread
+that did not come along, and each worker calls it before exiting.
+
+Per-process state (e.g. open /stream sessions) is not shared between
+workers, so streaming needs a single worker or sticky routing. --workers
+therefore defaults to 1 for an app with /stream routes (the CPU count
+otherwise), and asking for more logs a warning.
+
+Metrics are counted per process, so each worker writes its values to
+METRICS_DIR (a temporary directory unless set; one per serve.py instance)
+and GET /metrics, whichever worker answers it, reports the sum over all
+workers, including ones that have exited. /metrics/slow stays per worker.
+"""
+import os
+import gc
+import sys
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import logging
+import argparse
+import importlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APPS = ("server", "app", "regi")
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server whose connections are handled by a fixed pool of threads."""
+
+    # Read by BaseWSGIServer: HTTP/1.1 (keep-alive before Werkzeug 2.1, which closes every connection)
+    multithread = True
+
+    def __init__(self, host, port, app, threads, handler, fd=None):
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="request")
+        super().__init__(host, port, app, handler=handler, fd=fd)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class TimedRequestHandler(WSGIRequestHandler):
+    """
+    Request handler whose reads/writes give up after `timeout` seconds and
+    whose keep-alive connections are closed after `keepalive` idle seconds.
+    """
+
+    timeout = None
+    keepalive = 2.0
+
+    def handle_one_request(self):
+        if getattr(self, "_served", False):
+            # Between requests: wait at most `keepalive` for the next one to start
+            if self.keepalive <= 0:
+                self.close_connection = True
+                return
+            self.connection.settimeout(self.keepalive)
+            try:
+                idle = not self.rfile.peek(1)
+            except (TimeoutError, OSError):
+                idle = True
+            if idle:
+                self.close_connection = True
+                return
+            self.connection.settimeout(self.timeout)
+        self._served = True
+        super().handle_one_request()
+
+
+def _handler(timeout, keepalive):
+    return type("TimedRequestHandler", (TimedRequestHandler,),
+                {"timeout": timeout or None, "keepalive": keepalive})
+
+
+def _call_hook(module, name):
+    hook = getattr(module, name, None)
+    if hook is not None:
+        hook()
+
+
+def _write_metrics():
+    # The apps' metrics module, if loaded: leave this worker's final values for /metrics
+    metrics = sys.modules.get("metrics")
+    if metrics is not None:
+        metrics.SNAPSHOTS.write()
+
+
+def _stream_routes(app):
+    """Routes whose sessions live in the worker that opened them."""
+    return sorted(rule.rule for rule in app.url_map.iter_rules() if rule.rule.startswith("/stream"))
+
+
+def _metrics_dir():
+    """METRICS_DIR for the workers (read when the app imports metrics.py); True if we created it."""
+    directory = os.environ.get("METRICS_DIR")
+    if not directory:
+        os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="kdt-metrics-")
+        return True
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):  # Left by an earlier run
+        if name.endswith((".json", ".tmp")):
+            os.remove(os.path.join(directory, name))
+    return False
+
+
+def _parse_bind(bind):
+    host, _, port = bind.rpartition(":")
+    return host.strip("[]") or "127.0.0.1", int(port)
+
+
+class Arbiter:
+    """Parent process: forks, watches and restarts the workers."""
+
+    def __init__(self, module, sock, args):
+        self.module = module
+        self.sock = sock
+        self.args = args
+        self.workers = {}  # pid -> start time
+        self.retiring = set()  # Workers we asked to stop; their exit is expected
+        self.stopping = False
+        self.restart_requested = False
+
+    # --- Worker side ---
+
+    def _serve(self):
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the parent, which stops us
+        _call_hook(self.module, "post_fork")
+        host, port = _parse_bind(self.args.bind)
+        server = PooledWSGIServer(host, port, self.module.app, self.args.threads,
+                                  _handler(self.args.timeout, self.args.keepalive), fd=self.sock.fileno())
+
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever, which runs on this (the main) thread
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        logging.info(f"Worker {os.getpid()} serving on {self.args.bind} with {self.args.threads} threads")
+        server.serve_forever()
+        # Finish the requests already accepted, within the grace period
+        drain = threading.Thread(target=server.pool.shutdown, kwargs={"wait": True}, daemon=True)
+        drain.start()
+        drain.join(self.args.graceful_timeout)
+        logging.info(f"Worker {os.getpid()} stopped")
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return pid
+        code = 0
+        try:
+            self._serve()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            # os._exit skips atexit: flush the CSV/audit writers explicitly
+            try:
+                _call_hook(self.module, "shutdown")
+                _write_metrics()
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+
+    # --- Parent side ---
+
+    def _signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.restart_requested = True
+        elif signum in (signal.SIGTERM, signal.SIGINT):
+            self.stopping = True
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            started = self.workers.pop(pid, None)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif started is not None:
+                code = os.waitstatus_to_exitcode(status)
+                logging.warning(f"Worker {pid} exited ({code}) after {time.monotonic() - started:.1f}s")
+
+    def _stop(self, pids, timeout):
+        self.retiring.update(pids)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + timeout
+        while any(pid in self.workers for pid in pids) and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in pids:
+            if pid in self.workers:
+                logging.warning(f"Worker {pid} did not stop within {timeout}s, killing it")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        while any(pid in self.workers for pid in pids):
+            self._reap()
+            time.sleep(0.05)
+
+    def _rolling_restart(self):
+        logging.info("Restarting workers")
+        for old in list(self.workers):
+            self.spawn()
+            self._stop([old], self.args.graceful_timeout + 1)
+
+    def run(self):
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._signal)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)  # Just interrupts the sleep
+        logging.info(f"Master {os.getpid()}: {self.args.workers} workers of '{self.args.app}' on {self.args.bind}")
+        failures = 0
+        while not self.stopping:
+            self._reap()
+            if self.restart_requested:
+                self.restart_requested = False
+                self._rolling_restart()
+            missing = self.args.workers - len(self.workers)
+            if missing > 0:
+                # Back off when workers keep dying right after starting
+                time.sleep(min(failures, 10))
+                for _ in range(missing):
+                    self.spawn()
+                failures += 1
+            else:
+                failures = 0
+            time.sleep(0.5)
+        logging.info("Stopping workers")
+        self._stop(list(self.workers), self.args.graceful_timeout + 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Preload an app and serve it from forked worker processes")
+    parser.add_argument("app", nargs="?", choices=APPS, default=os.environ.get("SERVE_APP", "server"))
+    parser.add_argument("--bind", default=os.environ.get("SERVE_BIND", "127.0.0.1:3000"))
+    parser.add_argument("--workers", type=int,
+                        default=int(os.environ["SERVE_WORKERS"]) if os.environ.get("SERVE_WORKERS") else None,
+                        help="Worker processes (default: 1 for apps with /stream sessions, else the CPU count)")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("SERVE_THREADS", "8")),
+                        help="Request threads per worker")
+    parser.add_argument("--timeout", type=float, default=float(os.environ.get("SERVE_TIMEOUT", "30")),
+                        help="Seconds a connection may stay idle while reading or writing (0: no limit)")
+    parser.add_argument("--keepalive", type=float, default=float(os.environ.get("SERVE_KEEPALIVE", "2")),
+                        help="Seconds a keep-alive connection may wait for its next request (0: close after each response)")
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.environ.get("SERVE_GRACEFUL_TIMEOUT", "30")),
+                        help="Seconds a stopping worker gets to finish in-flight requests")
+    parser.add_argument("--backlog", type=int, default=2048)
+    args = parser.parse_args(argv)
+
+    if not hasattr(os, "fork"):
+        parser.error("serve.py needs os.fork(); use the app's own __main__ on this platform")
+
+    # The apps resolve some data paths (database.db, biometria.csv) relative to their directory
+    os.chdir(BASE_DIR)
+    sys.path.insert(0, BASE_DIR)
+    created_metrics_dir = _metrics_dir()
+    module = importlib.import_module(args.app)
+    logging.getLogger().setLevel(logging.INFO)
+    streams = _stream_routes(module.app)
+    if args.workers is None:
+        args.workers = 1 if streams else os.cpu_count() or 1
+    elif args.workers > 1 and streams:
+        logging.warning(f"'{args.app}' keeps {streams[0]} sessions in the worker that opened them: "
+                        f"with {args.workers} workers, streaming clients need sticky routing")
+    # Workers must inherit the loaded models, not a half-finished warm-up thread
+    warmup = getattr(module, "warmup", None)
+    if warmup is not None and not warmup.wait():
+        logging.error(f"Warm-up of '{args.app}' failed, workers will report not ready: {warmup.errors}")
+
+    # Fork from a single-threaded parent: stop the writers, compaction, model
+    # watcher etc. (post_fork starts them in each worker)
+    _call_hook(module, "shutdown")
+    running = [t.name for t in threading.enumerate() if t is not threading.main_thread() and t.is_alive()]
+    if running:
+        logging.warning(f"Forking with background threads still running: {', '.join(running)}")
+
+    host, port = _parse_bind(args.bind)
+    sock = socket.create_server((host, port), family=socket.AF_INET6 if ":" in host else socket.AF_INET,
+                                backlog=args.backlog)
+    sock.set_inheritable(True)
+
+    # Move everything loaded so far out of the collector's reach: scanning it
+    # would write to its pages and un-share them in every worker
+    gc.collect()
+    gc.freeze()
+    Arbiter(module, sock, args).run()
+    if created_metrics_dir:
+        shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
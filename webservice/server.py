@@ -1,9 +1,33 @@
 import os
 import csv
 from flask import Flask, render_template, request, jsonify
-import dnn_wrapper
-import threading
 import logging
+from typing_index import TypingIndex, CursorError, StaleCursor
+from inference_batcher import MicroBatcher
+from model_registry import ModelRegistry, holdout_from_csv, resolve_label
+from predict_payload import PACKED_MIMETYPE, PayloadError, parse_packed, parse_columnar
+from csv_appender import CsvAppender
+from compaction import CompactionJob
+from shard_store import ShardStore, ShardedAppender, ShardedTypingIndex
+from keystream import StreamRegistry
+from conditional_get import ResponseMemo, conditional_get
+from history_stream import HistoryQuery, history_response
+from metrics import instrument, stage, DIGRAPHS_REJECTED
+from warmup import Warmup
+
+# ——— DNN backend ———
+# DNN_BACKEND=native uses the compiled dnn_wrapper, DNN_BACKEND=numpy the pure
+# NumPy engine (dnn_numpy); the default "auto" prefers native when it is installed.
+DNN_BACKEND = os.environ.get("DNN_BACKEND", "auto")
+if DNN_BACKEND == "numpy":
+    import dnn_numpy as dnn_wrapper
+else:
+    try:
+        import dnn_wrapper
+    except ImportError:
+        if DNN_BACKEND == "native":
+            raise
+        import dnn_numpy as dnn_wrapper
 
 # ——— Logging setup ———
 logging.basicConfig(level=logging.DEBUG,
@@ -20,65 +44,151 @@ app = Flask(
     template_folder=TEMPLATE_DIR,
     static_folder=STATIC_DIR
 )
-_csv_lock = threading.Lock()
+instrument(app)  # Per-stage timings on GET /metrics, slowest requests on GET /metrics/slow
+
+# Model, typing index and feature store are loaded by a warm-up thread so the
+# process answers (/, /metrics, GET /ready) right away; routes needing them wait
+warmup = Warmup()
+warmup.register(app)
 
 # ——— Paths ———
 MODEL_PATH = os.path.abspath(os.path.join(BASE_DIR, os.pardir, "typing.dnn"))
+MODELS_DIR = os.environ.get("MODELS_DIR", os.path.abspath(os.path.join(BASE_DIR, os.pardir, "models")))
 BASE_CSV = os.path.join(DATA_DIR, "free-text.csv")
 EXT_CSV = os.path.join(DATA_DIR, "free-text-new.csv")
 
-# ——— Load DNN once ———
-try:
-    if not os.path.isfile(MODEL_PATH):
-        raise FileNotFoundError(f"Cannot find model at {MODEL_PATH}")
-    dnn_wrapper.load_model(MODEL_PATH)
-    logging.info(f"DNN model loaded successfully from {MODEL_PATH}")
-except FileNotFoundError as e:
-    logging.error(f"Error loading DNN model: {e}")
-    # In a production setting, you might want to disable prediction
-    # functionality or exit the application.
-    # For now, we'll let the app start but prediction will fail.
-except Exception as e:
-    logging.error(f"An unexpected error occurred during DNN model loading: {e}")
-    # Same consideration as above for production.
+# ——— Inference batching ———
+# Concurrent /predict calls arriving within the window are run as one batch
+PREDICT_BATCH_WINDOW_MS = float(os.environ.get("PREDICT_BATCH_WINDOW_MS", "5"))
+PREDICT_MAX_BATCH = int(os.environ.get("PREDICT_MAX_BATCH", "32"))
+PREDICT_TIMEOUT_S = float(os.environ.get("PREDICT_TIMEOUT_S", "10"))  # Longer: 503, the request thread is freed
+
+# ——— CSV write-behind ———
+# Rows are group-committed (one write + fsync per batch) under a file lock so
+# several worker processes can share EXT_CSV. CSV_DURABLE=1, or "durable": true
+# in a request, waits for the fsync before responding.
+CSV_FLUSH_ROWS = int(os.environ.get("CSV_FLUSH_ROWS", "256"))
+CSV_FLUSH_MS = float(os.environ.get("CSV_FLUSH_MS", "50"))
+CSV_DURABLE = os.environ.get("CSV_DURABLE", "0") == "1"
+
+# ——— Compaction ———
+# Once EXT_CSV grows past COMPACT_EXT_BYTES a background job merges it into
+# BASE_CSV: deduplicated, sorted by participant/session, with a byte-offset
+# index (see compaction.py). COMPACT_INTERVAL_S=0 disables the job.
+COMPACT_EXT_BYTES = int(os.environ.get("COMPACT_EXT_BYTES", str(32 << 20)))
+COMPACT_INTERVAL_S = float(os.environ.get("COMPACT_INTERVAL_S", "300"))
+
+# ——— Sharded typing data ———
+# With a manifest in TYPING_SHARDS_DIR (python shard_store.py migrate ...) each
+# participant's rows live in their own CSV under their own lock, written by
+# SHARD_WRITERS group-commit threads; /sessions and /history read only that
+# participant's file (at most TYPING_SHARD_CACHE of them stay indexed). The
+# single-file CSVs and their compaction are then no longer used.
+TYPING_SHARDS_DIR = os.environ.get("TYPING_SHARDS_DIR", os.path.join(DATA_DIR, "shards"))
+SHARD_WRITERS = int(os.environ.get("SHARD_WRITERS", "4"))
+TYPING_SHARD_CACHE = int(os.environ.get("TYPING_SHARD_CACHE", "256"))
+
+typing_shards = ShardStore(TYPING_SHARDS_DIR).open() if ShardStore.exists(TYPING_SHARDS_DIR) else None
+
+# ——— Streaming ingestion ———
+# Windows of STREAM_WINDOW consecutive digraphs (the model's input rows) are
+# scored while the user types; open streams idle for STREAM_TTL_S are dropped.
+STREAM_WINDOW = int(os.environ.get("STREAM_WINDOW", "3"))
+STREAM_TTL_S = float(os.environ.get("STREAM_TTL_S", "300"))
+
+# ——— Model registry (hot reload) ———
+# Versions are MODELS_DIR/<version>.dnn (+ <version>.labels.json, see label_map.py);
+# without any, MODEL_PATH is served. New versions are validated on rows of
+# EXT_CSV (collected after training, so held out) and swapped in without a
+# restart. MODELS_DIR/ACTIVE pins a version, MODELS_DIR/SHADOW shadows one.
+MODEL_POLL_S = float(os.environ.get("MODEL_POLL_S", "2"))
+MODEL_MIN_ACCURACY = float(os.environ.get("MODEL_MIN_ACCURACY", "0"))
+MODEL_HOLDOUT_SAMPLES = int(os.environ.get("MODEL_HOLDOUT_SAMPLES", "200"))
+
+model_registry = ModelRegistry(
+    MODELS_DIR,
+    dnn_wrapper,
+    fallback_path=MODEL_PATH,
+    holdout=lambda: holdout_from_csv(EXT_CSV, STREAM_WINDOW, MODEL_HOLDOUT_SAMPLES),
+    rows=STREAM_WINDOW,
+    min_accuracy=MODEL_MIN_ACCURACY,
+    poll_interval=MODEL_POLL_S,
+)
+
+@warmup.step("model")
+def _load_model():
+    try:
+        model_registry.start()
+        if model_registry.active() is not None:
+            logging.info(f"DNN model version '{model_registry.active().name}' loaded ({dnn_wrapper.__name__} backend)")
+    except Exception as e:
+        # The app still starts (history keeps working); prediction fails until a model loads
+        logging.error(f"An unexpected error occurred during DNN model loading: {e}")
+
+predict_batcher = MicroBatcher(
+    model_registry.predict_batch,
+    window=PREDICT_BATCH_WINDOW_MS / 1000.0,
+    max_batch=PREDICT_MAX_BATCH,
+    timeout=PREDICT_TIMEOUT_S,
+).start()
+
+typing_streams = StreamRegistry(predict_batcher.submit, window=STREAM_WINDOW, ttl=STREAM_TTL_S)
 
 # ——— Bootstrap new CSV header if missing ———
-if not os.path.isfile(EXT_CSV):
+# The appender also writes it into EXT_CSV if the file is removed later on
+try:
+    with open(BASE_CSV, newline="", encoding="utf-8") as fin:
+        CSV_HEADER = next(csv.reader(fin))
+except (OSError, StopIteration) as e:
+    logging.error(f"Error reading the CSV header from {BASE_CSV}: {e}")
+    CSV_HEADER = None
+
+if CSV_HEADER and not os.path.isfile(EXT_CSV):
     try:
         os.makedirs(DATA_DIR, exist_ok=True)  # Ensure directory exists before creating file
-        with open(BASE_CSV, newline="", encoding="utf-8") as fin, \
-             open(EXT_CSV, "w", newline="", encoding="utf-8") as fout:
-            writer = csv.writer(fout)
-            writer.writerow(next(csv.reader(fin)))  # copy header
+        with open(EXT_CSV, "w", newline="", encoding="utf-8") as fout:
+            csv.writer(fout).writerow(CSV_HEADER)
         logging.info(f"Created new extended CSV file: {EXT_CSV} with header from {BASE_CSV}")
     except Exception as e:
         logging.error(f"Error bootstrapping extended CSV file: {e}")
         # Non-critical error, the application can still function for history viewing.
         pass
 
-def read_all_rows():
-    """
-    Read both original and appended CSVs,
-    strip whitespace from header names, drop blank keys,
-    and return list of clean dicts.
-    """
-    rows = []
-    for path in (BASE_CSV, EXT_CSV):
-        try:
-            with open(path, newline="", encoding="utf-8") as f:
-                raw = csv.DictReader(f, skipinitialspace=True)
-                for r in raw:
-                    # clean keys and drop empties
-                    clean = {k.strip(): v for k, v in r.items() if k and k.strip()}
-                    # only consider rows that actually have a participant and session
-                    if "participant" in clean and "session" in clean:
-                        rows.append(clean)
-        except FileNotFoundError:
-            logging.warning(f"CSV file not found: {path}")
-            # If one CSV is missing, we can still try to read the other.
-        except Exception as e:
-            logging.error(f"Error reading CSV file {path}: {e}")
-    return rows
+# ——— Resident typing-data index (built once, tails EXT_CSV or the shards) ———
+if typing_shards is not None:
+    typing_index = ShardedTypingIndex(typing_shards, cache=TYPING_SHARD_CACHE)
+else:
+    typing_index = TypingIndex(BASE_CSV, EXT_CSV)
+warmup.step("typing_index")(typing_index.load)
+# GET responses memoized per (endpoint, args, index generation); ETags answer repeat polls with 304
+response_memo = ResponseMemo()
+
+if typing_shards is not None:
+    csv_appender = ShardedAppender(
+        typing_shards,
+        writers=SHARD_WRITERS,
+        max_rows=CSV_FLUSH_ROWS,
+        max_delay=CSV_FLUSH_MS / 1000.0,
+        durable=CSV_DURABLE,
+    ).start()
+    compaction_job = None  # Segments are per participant already
+else:
+    csv_appender = CsvAppender(
+        EXT_CSV,
+        max_rows=CSV_FLUSH_ROWS,
+        max_delay=CSV_FLUSH_MS / 1000.0,
+        durable=CSV_DURABLE,
+        header=CSV_HEADER,
+    ).start()
+    compaction_job = CompactionJob(
+        BASE_CSV,
+        EXT_CSV,
+        min_bytes=COMPACT_EXT_BYTES,
+        interval=COMPACT_INTERVAL_S,
+        on_done=lambda stats: typing_index.refresh(),
+    ).start()
+
+warmup.start()
 
 # ——— Routes ———
 
@@ -87,38 +197,49 @@ def home():
     return render_template("biometric_test.html")
 
 @app.route("/participants", methods=["GET"])
+@warmup.required
 def list_participants():
     try:
-        parts = sorted({r["participant"] for r in read_all_rows()})
-        return jsonify(participants=parts)
+        typing_index.refresh()
+        return conditional_get(typing_index, response_memo,
+                               lambda: jsonify(participants=typing_index.participants()))
     except Exception as e:
         logging.error(f"Error listing participants: {e}")
         return jsonify(error="Failed to retrieve participants"), 500
 
 @app.route("/sessions", methods=["GET"])
+@warmup.required
 def list_sessions():
     part = request.args.get("participant", "")
     try:
-        sess = sorted({
-            r["session"]
-            for r in read_all_rows()
-            if r["participant"] == part
-        })
-        return jsonify(sessions=sess)
+        typing_index.refresh(part)
+        return conditional_get(typing_index.scope(part), response_memo,
+                               lambda: jsonify(sessions=typing_index.sessions(part)))
     except Exception as e:
         logging.error(f"Error listing sessions for participant '{part}': {e}")
         return jsonify(error="Failed to retrieve sessions"), 500
 
 @app.route("/history", methods=["GET"])
+@warmup.required
 def view_history():
     part = request.args.get("participant", "")
     sess = request.args.get("session", "")
     try:
-        hist = [
-            r for r in read_all_rows()
-            if r["participant"] == part and r["session"] == sess
-        ]
-        return jsonify(history=hist)
+        query = HistoryQuery(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    try:
+        typing_index.refresh(part)
+
+        def build():
+            # Rows are serialised lazily while the response is sent (?after/?limit page through them)
+            rows, cursor = typing_index.history_page(part, sess, query.after, query.limit)
+            return history_response(rows, query, cursor, request.headers.get("Accept-Encoding", ""))
+        return conditional_get(typing_index.scope(part), response_memo, build)
+    except StaleCursor as e:
+        return jsonify(error=str(e)), 410
+    except CursorError as e:
+        return jsonify(error=str(e)), 400
     except Exception as e:
         logging.error(f"Error viewing history for participant '{part}', session '{sess}': {e}")
         return jsonify(error="Failed to retrieve history"), 500
@@ -128,9 +249,16 @@ def view_history():
 os.makedirs(DATA_DIR, exist_ok=True)
 
 @app.route("/predict", methods=["POST"])
+@warmup.required
 def predict():
-    data = request.get_json(force=True)
-    app.logger.debug("RAW PREDICT PAYLOAD: %r", data)
+    # Packed binary bodies carry only the digraphs; participant/session come in the query string
+    packed = request.mimetype == PACKED_MIMETYPE
+    if packed:
+        data = request.args
+    else:
+        with stage("parse"):
+            data = request.get_json(force=True)
+        app.logger.debug("RAW PREDICT PAYLOAD: %r", data)
 
     # Input validation and sanitization
     part = data.get("participant", "").strip()
@@ -143,34 +271,61 @@ def predict():
             return jsonify(error="Session must be a positive integer"), 400
     except (TypeError, ValueError):
         return jsonify(error="Session must be an integer"), 400
+    durable = CSV_DURABLE or str(data.get("durable", "")).lower() in ("1", "true")
+
+    if packed or data.get("format") == "columnar":
+        # Compact payloads: vectorised validation and conversion with NumPy
+        try:
+            with stage("validate"):
+                parsed = parse_packed(request.get_data()) if packed else parse_columnar(data)
+        except PayloadError as e:
+            return jsonify(error=str(e)), 400
+        keys, rows = parsed.keys, parsed.features.tolist()
+        flat = parsed.features.ravel().tolist()
+        rejected = parsed.received - len(keys)
+        if rejected:
+            logging.warning(f"Skipped {rejected} invalid digraphs in compact payload")
+    else:
+        raw = data.get("digraphs", [])
+        if not isinstance(raw, list) or not raw:
+            return jsonify(error="Must send at least one digraph"), 400
+
+        with stage("validate"):
+            flat, digs = [], []
+            for i, d in enumerate(raw):
+                k1 = d.get("key1")
+                k2 = d.get("key2")
+                feats = d.get("features")
+                if (
+                    isinstance(k1, str) and len(k1) == 1 and
+                    isinstance(k2, str) and len(k2) == 1 and
+                    isinstance(feats, list) and len(feats) == 5 and
+                    all(isinstance(f, (int, float)) for f in feats) # Validate feature types
+                ):
+                    digs.append(d)
+                    flat.extend(feats)
+                else:
+                    logging.warning(f"Invalid digraph at index {i}: {d}")
+            keys = [(d["key1"], d["key2"]) for d in digs]
+            rows = [d["features"] for d in digs]
+        rejected = len(raw) - len(keys)
+    if rejected:
+        DIGRAPHS_REJECTED.inc(rejected, endpoint="/predict")
 
-    raw = data.get("digraphs", [])
-    if not isinstance(raw, list) or not raw:
-        return jsonify(error="Must send at least one digraph"), 400
-
-    flat, digs = [], []
-    for i, d in enumerate(raw):
-        k1 = d.get("key1")
-        k2 = d.get("key2")
-        feats = d.get("features")
-        if (
-            isinstance(k1, str) and len(k1) == 1 and
-            isinstance(k2, str) and len(k2) == 1 and
-            isinstance(feats, list) and len(feats) == 5 and
-            all(isinstance(f, (int, float)) for f in feats) # Validate feature types
-        ):
-            digs.append(d)
-            flat.extend(feats)
-        else:
-            logging.warning(f"Invalid digraph at index {i}: {d}")
-
-    if not digs:
+    if not keys:
         return jsonify(error="No valid character digraphs to process"), 400
 
     # Prediction with explicit error handling for the DNN
     predicted_index = None
     try:
-        predicted_index = dnn_wrapper.predict(flat, len(digs), 5)
+        with stage("predict"):
+            predicted_index = predict_batcher.predict(flat, len(keys), 5)
+    except TimeoutError as e:
+        logging.error(f"DNN prediction timed out: {e}")
+        response = jsonify(error="Prediction timed out, retry later")
+        response.status_code = 503
+        response.headers["Retry-After"] = "1"
+        return response
     except RuntimeError as e:
         logging.error(f"DNN prediction error (likely input size mismatch): {e}")
         return jsonify(error=f"Prediction failed due to input size mismatch: {e}"), 400
@@ -178,31 +333,155 @@ def predict():
         logging.error(f"Unexpected error during prediction: {e}")
         return jsonify(error="An unexpected error occurred during prediction"), 500
 
-    # Append to CSV with better error handling
+    error, saved = _save_typing_data(part, sess, keys, rows, durable)
+    if error:
+        return error
+
+    return jsonify(
+        predicted_index=predicted_index,
+        predicted_user=_label(predicted_index),
+        saved=saved
+    )
+
+def _label(predicted_index):
+    # Resolved with the label map of the model version that made the prediction
+    return resolve_label(predicted_index, model_registry)
+
+def _save_typing_data(part, sess, keys, rows, durable):
+    """
+    Append digraphs to the CSV; returns (error response, None) or (None, saved).
+    saved is True for durable rows, which are fsynced by now, and "queued" for
+    write-behind rows: a write error then only reaches the appender's Future,
+    so they are indexed from its callback once they are on disk.
+    """
     rows_to_write = [
-        [part, sess, d["key1"], d["key2"], *d["features"]]
-        for d in digs
+        [part, sess, k1, k2, *feats]
+        for (k1, k2), feats in zip(keys, rows)
     ]
-    saved = False
     try:
-        with _csv_lock:
-            with open(EXT_CSV, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerows(rows_to_write)
-            saved = True
-            logging.info(f"Successfully appended {len(rows_to_write)} rows to {EXT_CSV} for participant '{part}', session '{sess}'")
+        with stage("csv_append"):
+            future = csv_appender.append(rows_to_write, durable=durable)
+        logging.info(f"{'Appended' if durable else 'Queued'} {len(rows_to_write)} rows to "
+                     f"{TYPING_SHARDS_DIR if typing_shards is not None else EXT_CSV} for participant '{part}', session '{sess}'")
     except IOError as e:
         logging.error(f"IOError while writing to CSV: {e}")
-        return jsonify(error=f"Could not save typing data due to a file error: {e}"), 500
+        return (jsonify(error=f"Could not save typing data due to a file error: {e}"), 500), None
     except Exception as e:
         logging.exception("Unexpected error during CSV append")
-        return jsonify(error=f"Could not save typing data due to an unexpected error: {e}"), 500
+        return (jsonify(error=f"Could not save typing data due to an unexpected error: {e}"), 500), None
+
+    # Runs right away for durable rows, on the appender's writer thread otherwise
+    future.add_done_callback(lambda f: _typing_data_written(f, part, sess, len(rows_to_write)))
+    return None, True if durable else "queued"
+
+def _typing_data_written(future, part, sess, count):
+    """Appender callback: index the rows once they are on disk, or log that they were lost."""
+    error = future.exception()
+    if error is not None:
+        logging.error(f"Lost {count} queued rows for participant '{part}', session '{sess}': {error}")
+        return
+    try:
+        with stage("index_refresh"):
+            typing_index.refresh(part)
+    except Exception as e:
+        logging.error(f"Error refreshing the typing index for participant '{part}': {e}")
+
+# ——— Streaming ingestion: raw key events in, digraphs extracted server-side ———
+
+@app.route("/stream", methods=["POST"])
+@warmup.required
+def open_stream():
+    data = request.get_json(force=True, silent=True) or {}
+    part = str(data.get("participant", "")).strip()
+    if not part:
+        return jsonify(error="Participant must be a non-empty string"), 400
+    try:
+        sess = int(data.get("session"))
+        if sess <= 0:
+            return jsonify(error="Session must be a positive integer"), 400
+    except (TypeError, ValueError):
+        return jsonify(error="Session must be an integer"), 400
+    try:
+        stream = typing_streams.open(part, sess)
+    except OverflowError as e:
+        return jsonify(error=str(e)), 503
+    return jsonify(stream_id=stream.stream_id, window=STREAM_WINDOW), 201
+
+@app.route("/stream/<stream_id>/events", methods=["POST"])
+def stream_events(stream_id):
+    stream = typing_streams.get(stream_id)
+    if stream is None:
+        return jsonify(error="Unknown or expired stream"), 404
+    data = request.get_json(force=True, silent=True) or {}
+    events = data.get("events")
+    if not isinstance(events, list):
+        return jsonify(error="'events' must be a list"), 400
+    try:
+        seq = int(data["seq"]) if data.get("seq") is not None else None
+        completed = stream.feed(events, seq)
+    except LookupError as e:
+        return jsonify(error=str(e), expected_seq=stream.next_seq), 409
+    except (TypeError, ValueError) as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(completed=completed, **stream.state())
+
+@app.route("/stream/<stream_id>/finish", methods=["POST"])
+def finish_stream(stream_id):
+    stream = typing_streams.close(stream_id)
+    if stream is None:
+        return jsonify(error="Unknown or expired stream"), 404
+    data = request.get_json(force=True, silent=True) or {}
+    durable = CSV_DURABLE or str(data.get("durable", "")).lower() in ("1", "true")
+
+    with stage("predict"):
+        state = stream.finish(timeout=5)
+    if state["invalid"]:
+        DIGRAPHS_REJECTED.inc(state["invalid"], endpoint="/stream/<stream_id>/finish")
+    if not stream.keys:
+        return jsonify(error="No valid character digraphs to process", invalid=state["invalid"]), 400
+    if stream.errors and not state["windows_scored"]:
+        logging.error(f"Stream {stream_id}: none of its windows could be scored")
+
+    error, saved = _save_typing_data(stream.participant, stream.session, stream.keys, stream.features, durable)
+    if error:
+        return error
 
     return jsonify(
-        predicted_index=predicted_index,
-        predicted_user=part,
+        predicted_index=state["predicted_index"],
+        predicted_user=_label(state["predicted_index"]),
+        confidence=state["confidence"],
+        windows_scored=state["windows_scored"],
+        digraphs_processed=state["digraphs"],
+        digraphs_received=state["digraphs"] + state["invalid"],
         saved=saved
     )
 
+@app.route("/models", methods=["GET"])
+def list_models():
+    return jsonify(model_registry.status())
+
+# ——— Pre-fork serving (serve.py) ———
+
+def shutdown():
+    """
+    Flush queued CSV rows and stop the background threads. serve.py calls it
+    in the parent before forking (so no worker inherits a lock held by one of
+    them) and in each worker before it exits.
+    """
+    model_registry.stop_threads()
+    predict_batcher.stop()
+    if compaction_job is not None:
+        compaction_job.stop()
+    csv_appender.close()
+
+def post_fork():
+    """Start the background threads again in a worker forked from the preloaded parent."""
+    model_registry.start_threads()
+    predict_batcher.start()
+    csv_appender.start()
+    # Every worker checks for compaction; the compaction lock lets one at a time work
+    if compaction_job is not None:
+        compaction_job.start()
+
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=3000, debug=True)
\ No newline at end of file
@@ -0,0 +1,439 @@
+"""
+Sharded CSV storage: one segment file per key (participant, or user id for
+biometria.csv), listed in a manifest.
+
+    python shard_store.py migrate database/shards database/free-text.csv database/free-text-new.csv
+    python shard_store.py migrate database/biometria_shards database/biometria.csv --key CLASS
+    python shard_store.py ls database/shards
+
+Layout: <root>/manifest.json ({"header", "key_column", "shards": {key: file}})
+and <root>/<file>.csv per key, each starting with the header. Every segment
+is appended to under its own flock, so writers of different participants
+never wait for each other, and reading one participant touches only its
+file. The apps switch to this layout when the manifest exists (migrate with
+the apps stopped, then start them again).
+"""
+import os
+import io
+import csv
+import sys
+import json
+import zlib
+import hashlib
+import argparse
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from urllib.parse import quote
+
+from csv_appender import CsvAppender
+from typing_index import TypingIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows: manifest updates are only serialised within this process
+    fcntl = None
+
+MANIFEST = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+def segment_name(key):
+    """File name for a key: percent-encoded (so it is reversible and never hidden), hashed when long."""
+    name = quote(key, safe="-_")
+    if not name or len(name) > 120:
+        name = "h-" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return name + ".csv"
+
+
+def _write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ShardStore:
+    """The manifest of a sharded directory; creates segments as new keys show up."""
+
+    def __init__(self, root, header=None, key_column=None):
+        self.root = root
+        self.header = header
+        self.key_column = key_column
+        self.key_index = None
+        self._shards = {}          # key -> segment file name
+        self._stat = None          # (mtime_ns, size) of the manifest as loaded
+        self._lock = threading.Lock()
+        self.generation = 0        # Bumped whenever the manifest is (re)loaded with changes
+
+    @staticmethod
+    def exists(root):
+        return os.path.isfile(os.path.join(root, MANIFEST))
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, MANIFEST)
+
+    def open(self):
+        """Load the manifest, creating an empty one if a header and key column were given."""
+        os.makedirs(self.root, exist_ok=True)
+        if not self.exists(self.root):
+            if not self.header or not self.key_column:
+                raise FileNotFoundError(f"No shard manifest in {self.root}")
+            with self._manifest_lock():
+                if not self.exists(self.root):
+                    self._save({})
+        self.reload()
+        return self
+
+    def reload(self):
+        """Re-read the manifest if another process changed it; True if it did."""
+        try:
+            st = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return False
+        if (st.st_mtime_ns, st.st_size) == self._stat:
+            return False
+        with open(self.manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported shard manifest version in {self.root}: {manifest.get('version')}")
+        with self._lock:
+            self.header = manifest["header"]
+            self.key_column = manifest["key_column"]
+            self.key_index = self.header.index(self.key_column)
+            self._shards = manifest["shards"]
+            self._stat = (st.st_mtime_ns, st.st_size)
+            self.generation += 1
+        return True
+
+    def _save(self, shards):
+        _write_json(self.manifest_path, {"version": MANIFEST_VERSION, "header": self.header,
+                                         "key_column": self.key_column, "shards": shards})
+
+    def _manifest_lock(self):
+        return _FileLock(os.path.join(self.root, "manifest.lock"))
+
+    # --- Queries ---
+
+    def keys(self):
+        with self._lock:
+            return list(self._shards)
+
+    def path(self, key):
+        """Segment of `key`, or None if it has none yet."""
+        with self._lock:
+            name = self._shards.get(key)
+        return os.path.join(self.root, name) if name else None
+
+    def paths(self):
+        with self._lock:
+            return [os.path.join(self.root, name) for name in self._shards.values()]
+
+    def version(self):
+        """(generation, tag, last_modified) of the manifest, as TypingIndex.version()."""
+        with self._lock:
+            stat = self._stat or (0, 0)
+        return self.generation, f"m{stat[0]}-{stat[1]}", stat[0] / 1e9 if stat[0] else None
+
+    # --- Writing ---
+
+    def create(self, key):
+        """Path of the segment of `key`, creating the file (with the header) and its manifest entry if needed."""
+        path = self.path(key)
+        if path is not None:
+            return path
+        with self._manifest_lock():
+            self.reload()  # Another process may have added it meanwhile
+            path = self.path(key)
+            if path is not None:
+                return path
+            name = segment_name(key)
+            path = os.path.join(self.root, name)
+            buf = io.StringIO()
+            csv.writer(buf).writerow(self.header)
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                pass  # Left by a crash before the manifest was written: reuse it
+            else:
+                try:
+                    os.write(fd, buf.getvalue().encode("utf-8"))
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            with self._lock:
+                shards = dict(self._shards)
+            shards[key] = name
+            self._save(shards)
+            self.reload()
+        return path
+
+
+class _FileLock:
+    """Exclusive flock on a lock file for the duration of a with block."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self.fd)  # Also releases the flock
+        self.fd = None
+
+
+class ShardedAppender:
+    """
+    CsvAppender for a ShardStore: rows go to their key's segment. Segments are
+    spread over `writers` group-commit threads by key hash, so different
+    participants are written and fsynced in parallel, each under its own lock.
+    """
+
+    def __init__(self, store, writers=4, max_rows=256, max_delay=0.05, durable=False):
+        self.store = store
+        self.durable = durable
+        self._lanes = [CsvAppender(None, max_rows=max_rows, max_delay=max_delay, durable=durable,
+                                   lock_label=os.path.basename(os.path.normpath(store.root)),
+                                   header=store.header)
+                       for _ in range(max(1, writers))]
+
+    def start(self):
+        for lane in self._lanes:
+            lane.start()
+        return self
+
+    def _lane(self, key):
+        return self._lanes[zlib.crc32(key.encode("utf-8")) % len(self._lanes)]
+
+    def append(self, rows, durable=None, timeout=None):
+        """As CsvAppender.append(); rows are grouped by their key column."""
+        durable = self.durable if durable is None else durable
+        groups = OrderedDict()
+        for row in rows:
+            groups.setdefault(str(row[self.store.key_index]).strip(), []).append(row)
+        futures = [self._lane(key).append(group, durable=False, path=self.store.create(key))
+                   for key, group in groups.items()]
+        if len(futures) == 1:
+            future = futures[0]
+        else:
+            future = _gather(futures)
+        if durable:
+            future.result(timeout)
+        return future
+
+    def flush(self, timeout=None):
+        for lane in self._lanes:
+            lane.flush(timeout)
+
+    def close(self, timeout=None):
+        for lane in self._lanes:
+            lane.close(timeout)
+
+    @property
+    def rows(self):
+        return sum(lane.rows for lane in self._lanes)
+
+    @property
+    def batches(self):
+        return sum(lane.batches for lane in self._lanes)
+
+
+def _gather(futures):
+    """A Future for the total row count of several appends (or the first error)."""
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            combined.set_exception(errors[0])
+        else:
+            combined.set_result(sum(f.result() for f in futures))
+
+    if not futures:
+        combined.set_result(0)
+    for f in futures:
+        f.add_done_callback(done)
+    return combined
+
+
+class ShardedTypingIndex:
+    """
+    TypingIndex over a ShardStore of typing digraphs. Each participant's
+    segment is indexed (and tailed) on its own when first read, so a query
+    costs only that participant's rows; at most `cache` segments stay
+    resident, least recently used first out.
+    """
+
+    def __init__(self, store, cache=256):
+        self.store = store
+        self.cache = max(1, cache)
+        self._shards = OrderedDict()  # participant -> TypingIndex
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the manifest; segments are loaded lazily."""
+        self.store.reload()
+        with self._lock:
+            self._shards.clear()
+        logging.info(f"Sharded typing data in {self.store.root}: {len(self.store.keys())} participants")
+
+    def refresh(self, participant=None):
+        """Pick up new participants and, for `participant`, rows appended to its segment."""
+        self.store.reload()
+        if participant is None:
+            return 0
+        with self._lock:
+            shard = self._shards.get(participant)
+        return shard.refresh() if shard is not None else 0
+
+    def _shard(self, participant):
+        with self._lock:
+            shard = self._shards.get(participant)
+            if shard is not None:
+                self._shards.move_to_end(participant)
+                return shard
+        path = self.store.path(participant)
+        if path is None:
+            return None
+        shard = TypingIndex(None, path)
+        shard.load()
+        with self._lock:
+            shard = self._shards.setdefault(participant, shard)
+            self._shards.move_to_end(participant)
+            while len(self._shards) > self.cache:
+                self._shards.popitem(last=False)
+        return shard
+
+    def scope(self, participant):
+        """Object whose version() covers `participant`'s rows (for conditional GETs)."""
+        return self._shard(participant) or self
+
+    def version(self):
+        return self.store.version()
+
+    def participants(self):
+        return sorted(self.store.keys())
+
+    def sessions(self, participant):
+        shard = self._shard(participant)
+        return shard.sessions(participant) if shard is not None else []
+
+    def history(self, participant, session):
+        shard = self._shard(participant)
+        return shard.history(participant, session) if shard is not None else []
+
+    def history_page(self, participant, session, after=None, limit=None):
+        shard = self._shard(participant)
+        if shard is None:
+            return iter(()), None
+        return shard.history_page(participant, session, after, limit)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(shard) for shard in self._shards.values())
+
+
+# --- Migration ---
+
+def migrate(sources, root, key_column):
+    """
+    Split single-file CSVs into a new sharded directory `root` (which must
+    not have a manifest yet), keeping file order within each key. Columns
+    are matched by name, with the first source's header first. Returns
+    {key: rows}.
+    """
+    if ShardStore.exists(root):
+        raise FileExistsError(f"{root} already has a shard manifest")
+    header, groups, skipped = None, OrderedDict(), 0
+    for path in sources:
+        if not os.path.isfile(path):
+            logging.warning(f"CSV file not found, skipping: {path}")
+            continue
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)  # No skipinitialspace: a typed space is a key
+            source_header = [h.strip() for h in next(reader, [])]
+            if not source_header:
+                continue
+            if header is None:
+                header = source_header
+            header += [name for name in source_header if name and name not in header]
+            positions = [source_header.index(name) if name in source_header else None for name in header]
+            key_index = header.index(key_column)
+            for row in reader:
+                if not row:
+                    continue
+                row = [row[i] if i is not None and i < len(row) else "" for i in positions]
+                key = row[key_index].strip()
+                if not key:
+                    skipped += 1
+                    continue
+                groups.setdefault(key, []).append(row)
+    if header is None:
+        raise ValueError("None of the source CSVs has a header")
+
+    # Build next to the target and rename, so a half-written migration is never picked up
+    staging = root.rstrip(os.sep) + ".migrating"
+    os.makedirs(staging, exist_ok=True)
+    shards = {}
+    for key, rows in groups.items():
+        name = segment_name(key)
+        with open(os.path.join(staging, name), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        shards[key] = name
+    _write_json(os.path.join(staging, MANIFEST), {"version": MANIFEST_VERSION, "header": header,
+                                                  "key_column": key_column, "shards": shards})
+    if os.path.isdir(root):
+        if os.listdir(root):
+            raise FileExistsError(f"{root} is not empty")
+        os.rmdir(root)
+    os.replace(staging, root)
+    if skipped:
+        logging.warning(f"Skipped {skipped} rows without a {key_column}")
+    return {key: len(rows) for key, rows in groups.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sharded (one CSV per participant/user) typing data")
+    sub = parser.add_subparsers(dest="command", required=True)
+    mig = sub.add_parser("migrate", help="Split single-file CSVs into a new shard directory")
+    mig.add_argument("root", help="Shard directory to create (database/shards, database/biometria_shards)")
+    mig.add_argument("csv", nargs="+", help="Source CSVs, oldest first")
+    mig.add_argument("--key", default="participant", help="Column to shard by (CLASS for biometria.csv)")
+    ls = sub.add_parser("ls", help="List the shards of a directory")
+    ls.add_argument("root")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        counts = migrate(args.csv, args.root, args.key)
+        print(f"Migrated {sum(counts.values())} rows into {len(counts)} shards in {args.root}")
+    else:
+        store = ShardStore(args.root).open()
+        for key in sorted(store.keys()):
+            path = store.path(key)
+            print(f"{key}\t{os.path.getsize(path) if os.path.isfile(path) else 'missing'}\t{os.path.basename(path)}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
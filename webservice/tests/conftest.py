@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The service modules are flat files in webservice/, imported by name as the apps do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,34 @@
+import threading
+import time
+
+import pytest
+
+from admission import Bulkhead, Overloaded
+
+
+def test_calls_beyond_workers_plus_queue_are_refused():
+    bulkhead = Bulkhead("test", workers=1, queue=1, max_wait=None)
+    release = threading.Event()
+    running = bulkhead.submit(release.wait, 10)
+    queued = bulkhead.submit(lambda: "queued")
+    with pytest.raises(Overloaded) as refused:
+        bulkhead.submit(lambda: "refused")
+    assert refused.value.reason == "queue_full" and refused.value.pool == "test"
+    assert bulkhead.status()["pending"] == 2
+    release.set()
+    assert running.result(10) and queued.result(10) == "queued"
+    assert bulkhead.status()["pending"] == 0
+    assert bulkhead.call(lambda: "admitted again") == "admitted again"
+
+
+def test_calls_that_waited_too_long_are_shed():
+    bulkhead = Bulkhead("test", workers=1, queue=1, max_wait=0.05)
+    ran = []
+    running = bulkhead.submit(time.sleep, 0.2)
+    queued = bulkhead.submit(ran.append, 1)
+    with pytest.raises(Overloaded) as shed:
+        queued.result(10)
+    assert shed.value.reason == "queue_timeout"
+    assert ran == []
+    running.result(10)
+    assert bulkhead.status()["pending"] == 0
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+from flask import Flask
+
+from conditional_get import ResponseMemo, conditional_get
+
+
+class _Index:
+    """Stands in for TypingIndex.version()."""
+
+    def __init__(self, last_modified):
+        self.generation, self.tag, self.last_modified = 1, "a", last_modified
+
+    def version(self):
+        return self.generation, self.tag, self.last_modified
+
+
+@pytest.fixture
+def served():
+    app = Flask(__name__)
+    index, memo, builds = _Index(time.time() - 60), ResponseMemo(), []
+
+    @app.route("/history")
+    def history():
+        def build():
+            builds.append(1)
+            return f"body {index.tag}"
+        return conditional_get(index, memo, build)
+
+    return app.test_client(), index, builds
+
+
+def test_matching_etag_is_answered_with_304_without_building(served):
+    client, index, builds = served
+    first = client.get("/history?participant=p")
+    assert first.status_code == 200 and first.headers["Cache-Control"] == "no-cache"
+    again = client.get("/history?participant=p", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304 and again.headers["ETag"] == first.headers["ETag"]
+    assert len(builds) == 1
+
+
+def test_unchanged_version_is_served_from_the_memo(served):
+    client, index, builds = served
+    assert client.get("/history").data == client.get("/history").data == b"body a"
+    assert len(builds) == 1
+
+
+def test_new_data_changes_the_etag(served):
+    client, index, builds = served
+    etag = client.get("/history").headers["ETag"]
+    index.generation, index.tag = 2, "b"
+    response = client.get("/history", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.data == b"body b"
+    assert response.headers["ETag"] != etag
+
+
+def test_if_modified_since_is_honoured_for_settled_data(served):
+    client, index, builds = served
+    last_modified = client.get("/history").headers["Last-Modified"]
+    assert client.get("/history", headers={"If-Modified-Since": last_modified}).status_code == 304
+
+
+def test_if_modified_since_is_ignored_within_the_data_s_last_second(served):
+    client, index, builds = served
+    index.last_modified = time.time()
+    response = client.get("/history")
+    assert "Last-Modified" not in response.headers
+    # Another append in this same second would be hidden by a date-based 304
+    since = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(index.last_modified + 1))
+    assert client.get("/history", headers={"If-Modified-Since": since}).status_code == 200
+
+
+def test_etag_takes_precedence_over_if_modified_since(served):
+    client, index, builds = served
+    last_modified = client.get("/history").headers["Last-Modified"]
+    response = client.get("/history", headers={"If-None-Match": '"stale"', "If-Modified-Since": last_modified})
+    assert response.status_code == 200
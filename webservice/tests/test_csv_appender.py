@@ -0,0 +1,92 @@
+import csv
+import multiprocessing
+
+import pytest
+
+from csv_appender import CsvAppender, fcntl
+
+HEADER = ["writer", "seq", "payload"]
+ROWS_PER_WRITER = 400
+ROWS_PER_APPEND = 4
+# Long enough that a row spans several write() calls' worth of data if unlocked
+PAYLOAD = "x" * 2048
+
+
+def _write_rows(path, writer, durable, done):
+    appender = CsvAppender(path, max_rows=16, max_delay=0.001).start()
+    futures = []
+    for start in range(0, ROWS_PER_WRITER, ROWS_PER_APPEND):
+        rows = [[writer, seq, PAYLOAD] for seq in range(start, start + ROWS_PER_APPEND)]
+        futures.append(appender.append(rows, durable=durable, timeout=30))
+    written = sum(future.result(30) for future in futures)
+    appender.close()
+    done.put((writer, written))
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "typing.csv"
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerow(HEADER)
+    return str(path)
+
+
+@pytest.mark.skipif(fcntl is None, reason="cross-process appends need fcntl.flock")
+@pytest.mark.parametrize("durable", [False, True])
+def test_two_processes_append_whole_rows(csv_path, durable):
+    ctx = multiprocessing.get_context("fork")
+    done = ctx.Queue()
+    writers = [ctx.Process(target=_write_rows, args=(csv_path, name, durable, done)) for name in ("a", "b")]
+    for p in writers:
+        p.start()
+    results = dict(done.get(timeout=60) for _ in writers)
+    for p in writers:
+        p.join(30)
+        assert p.exitcode == 0
+
+    # Every future resolved to the number of rows it queued
+    assert results == {"a": ROWS_PER_WRITER, "b": ROWS_PER_WRITER}
+
+    with open(csv_path, newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == HEADER
+    body = rows[1:]
+    assert len(body) == 2 * ROWS_PER_WRITER
+    # No torn or interleaved rows: every line is one complete row
+    assert all(len(row) == 3 and row[2] == PAYLOAD for row in body)
+    for name in ("a", "b"):
+        # Each writer's rows arrive complete and in the order it appended them
+        assert [int(row[1]) for row in body if row[0] == name] == list(range(ROWS_PER_WRITER))
+
+
+def test_durable_append_is_on_disk_when_it_returns(csv_path):
+    appender = CsvAppender(csv_path, max_delay=5.0).start()
+    try:
+        future = appender.append([["a", 0, "y"]], durable=True, timeout=10)
+        assert future.result() == 1
+        with open(csv_path, newline="") as f:
+            assert list(csv.reader(f))[-1] == ["a", "0", "y"]
+    finally:
+        appender.close()
+
+
+def test_flush_writes_queued_rows(csv_path):
+    appender = CsvAppender(csv_path, max_delay=5.0).start()
+    try:
+        future = appender.append([["a", 1, "z"]])
+        appender.flush(timeout=10)
+        assert future.done() and future.result() == 1
+    finally:
+        appender.close()
+
+
+def test_missing_file_is_created_with_header(tmp_path):
+    path = str(tmp_path / "new.csv")
+    appender = CsvAppender(path, header=HEADER).start()
+    try:
+        appender.append([["a", 0, "y"]], durable=True, timeout=10)
+        appender.append([["a", 1, "z"]], durable=True, timeout=10)
+        with open(path, newline="") as f:
+            assert list(csv.reader(f)) == [HEADER, ["a", "0", "y"], ["a", "1", "z"]]
+    finally:
+        appender.close()
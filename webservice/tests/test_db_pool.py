@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+
+import pytest
+
+from database.db_pool import ConnectionPool
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "test.db"), size=3, timeout=0.2)
+    with pool.connection() as con, con:
+        con.execute("CREATE TABLE t (v INTEGER)")
+    yield pool
+    pool.close()
+
+
+def _run_threads(n, target):
+    errors = []
+
+    def run():
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+
+def test_finished_threads_leave_no_connections_behind(pool):
+    seen = set()
+
+    def query():
+        with pool.connection() as con:
+            seen.add(id(con))
+            con.execute("SELECT count(*) FROM t").fetchone()
+
+    for _ in range(20):
+        _run_threads(5, query)
+    # 100 threads came and went; the pool never grew past its size
+    assert pool.opened <= pool.size
+    assert len(seen) <= pool.size
+    pool.close()
+    assert pool.opened == 0
+
+
+def test_sequential_threads_reuse_one_connection(pool):
+    used = []
+
+    def query():
+        with pool.connection() as con:
+            used.append(id(con))
+
+    for _ in range(10):
+        _run_threads(1, query)
+    assert len(set(used)) == 1
+    assert pool.opened == 1
+
+
+def test_checkout_waits_then_times_out_when_exhausted(pool):
+    held = [pool.connection() for _ in range(pool.size)]
+    for cm in held:
+        cm.__enter__()
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            with pool.connection():
+                pass
+        assert pool.opened == pool.size
+    finally:
+        for cm in held:
+            cm.__exit__(None, None, None)
+    with pool.connection() as con:
+        assert con.execute("SELECT 1").fetchone() == (1,)
+
+
+def test_failed_block_rolls_back_before_returning_the_connection(pool):
+    with pytest.raises(RuntimeError):
+        with pool.connection() as con:
+            con.execute("INSERT INTO t VALUES (1)")
+            raise RuntimeError("boom")
+    with pool.connection() as con:
+        assert not con.in_transaction
+        assert con.execute("SELECT count(*) FROM t").fetchone() == (0,)
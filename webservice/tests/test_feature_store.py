@@ -0,0 +1,105 @@
+import csv
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from feature_store import FeatureStore, export_csv, import_csv, fcntl, FEATURES_FILE, TIMING_KEYS
+
+
+def _block(n, seed):
+    rng = np.random.default_rng(seed)
+    keys = [(chr(97 + i % 26), chr(97 + (i + 1) % 26)) for i in range(n)]
+    return keys, rng.random((n, len(TIMING_KEYS)), dtype=np.float32)
+
+
+def _assert_aligned(store, expected):
+    """Every column has one row per digraph and each session reads back what was appended."""
+    features, keys, ids = store.columns()
+    assert len(features) == len(keys) == len(ids) == sum(len(k) for k, _ in expected.values())
+    for (participant, session), (block_keys, block_features) in expected.items():
+        got_keys, got_features = store.session(participant, session)
+        assert [(chr(a), chr(b)) for a, b in got_keys.tolist()] == block_keys
+        np.testing.assert_array_equal(got_features, block_features)
+
+
+def test_columns_stay_aligned_after_appends(tmp_path):
+    store = FeatureStore(str(tmp_path)).open()
+    expected = {}
+    for i, (participant, session) in enumerate([("p1", 1), ("p2", 1), ("p1", 2), ("p3", 7)]):
+        keys, feats = _block(5 + i, i)
+        assert store.append(participant, session, keys, feats) == len(keys)
+        expected[(participant, session)] = (keys, feats)
+    _assert_aligned(store, expected)
+    assert store.participants() == ["p1", "p2", "p3"]
+    assert store.sessions("p1") == [1, 2]
+
+    # A fresh reader sees the same rows
+    _assert_aligned(FeatureStore(str(tmp_path)).open(), expected)
+
+
+def test_interleaved_blocks_of_one_session_are_joined(tmp_path):
+    store = FeatureStore(str(tmp_path)).open()
+    k1, f1 = _block(3, 1)
+    k2, f2 = _block(2, 2)
+    k3, f3 = _block(4, 3)
+    store.append("p1", 1, k1, f1)
+    store.append("p2", 1, k2, f2)
+    store.append("p1", 1, k3, f3)
+    _assert_aligned(store, {("p1", 1): (k1 + k3, np.concatenate([f1, f3])), ("p2", 1): (k2, f2)})
+
+
+def test_open_truncates_a_torn_append(tmp_path):
+    store = FeatureStore(str(tmp_path)).open()
+    keys, feats = _block(4, 0)
+    store.append("p1", 1, keys, feats)
+    # A writer that died after the features column but before the others
+    with open(tmp_path / FEATURES_FILE, "ab") as f:
+        f.write(feats[:2].tobytes())
+    _assert_aligned(FeatureStore(str(tmp_path)).open(), {("p1", 1): (keys, feats)})
+
+
+def _append_blocks(directory, writer, done):
+    store = FeatureStore(directory).open()
+    for i in range(30):
+        keys, feats = _block(3, hash((writer, i)) % 1000)
+        store.append(f"{writer}-{i % 3}", i, keys, feats)
+    done.put(writer)
+
+
+@pytest.mark.skipif(fcntl is None, reason="cross-process appends need fcntl.flock")
+def test_processes_sharing_a_store_keep_columns_and_ids_aligned(tmp_path):
+    FeatureStore(str(tmp_path)).open()
+    ctx = multiprocessing.get_context("fork")
+    done = ctx.Queue()
+    writers = [ctx.Process(target=_append_blocks, args=(str(tmp_path), name, done)) for name in ("a", "b", "c")]
+    for p in writers:
+        p.start()
+    for _ in writers:
+        done.get(timeout=60)
+    for p in writers:
+        p.join(30)
+        assert p.exitcode == 0
+
+    store = FeatureStore(str(tmp_path)).open()
+    features, keys, ids = store.columns()
+    assert len(features) == len(keys) == len(ids) == 3 * 30 * 3
+    # Participant ids were assigned under the lock: each name got exactly one
+    assert store.participants() == sorted(f"{w}-{i}" for w in "abc" for i in range(3))
+    for writer in "abc":
+        for i in range(30):
+            assert len(store.session(f"{writer}-{i % 3}", i)[0]) == 3
+
+
+def test_export_round_trips_float32(tmp_path):
+    store = FeatureStore(str(tmp_path / "a")).open()
+    keys, feats = _block(6, 4)
+    store.append("p1", 3, keys, feats)
+    path = str(tmp_path / "out.csv")
+    assert export_csv(store, path) == 6
+
+    copy = FeatureStore(str(tmp_path / "b")).open()
+    assert import_csv(copy, [path]) == 6
+    np.testing.assert_array_equal(copy.session("p1", 3)[1], feats)
+    with open(path, newline="") as f:
+        assert next(csv.reader(f))[:2] == ["participant", "session"]
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from knn_model import ClaimVerifier, robust_threshold
+
+
+class _Model:
+    """The part of ResidentKNN that ClaimVerifier uses."""
+
+    def __init__(self, templates):
+        self._templates = {label: np.array(rows, dtype=np.float32) for label, rows in templates.items()}
+
+    def templates(self, label):
+        return self._templates.get(str(label), np.empty((0, 1), dtype=np.float32))
+
+    def labels(self):
+        return list(self._templates)
+
+    def _sample_vector(self, values):
+        return np.array(values, dtype=np.float32)
+
+
+def test_robust_threshold_ignores_a_single_outlier():
+    # Median 3, MAD 1: 3 + 2 * 1.4826, where the maximum would be 100
+    assert robust_threshold([1, 2, 3, 4, 100], spread=2.0) == pytest.approx(3 + 2 * 1.4826)
+    assert robust_threshold([np.inf, np.nan]) is None
+
+
+def test_outlying_template_does_not_stretch_the_threshold():
+    # Leave-one-out distances 1, 1, 1, 1 and 97 (the outlier)
+    verifier = ClaimVerifier(_Model({"7": [[0], [1], [2], [3], [100]]}))
+    assert verifier.threshold("7") == pytest.approx(1.0)
+    assert verifier.verify("7", [3.5]) == (True, 0.5, pytest.approx(1.0))
+    accepted, distance, _ = verifier.verify("7", [50])
+    assert not accepted and distance == 47
+
+
+def test_margin_and_spread_scale_the_threshold():
+    model = _Model({"7": [[0], [1], [3], [6]]})  # Leave-one-out distances 1, 1, 2, 3
+    assert ClaimVerifier(model, spread=0.0).threshold("7") == pytest.approx(1.5)
+    assert ClaimVerifier(model, margin=2.0, spread=0.0).threshold("7") == pytest.approx(3.0)
+    assert ClaimVerifier(model, spread=1.0).threshold("7") == pytest.approx(1.5 + 0.5 * 1.4826)
+
+
+def test_single_template_users_get_the_median_of_the_others():
+    verifier = ClaimVerifier(_Model({
+        "1": [[0], [1]],          # threshold 1
+        "2": [[0], [3]],          # threshold 3
+        "3": [[0], [10]],         # threshold 10
+        "4": [[5]],               # no own threshold
+    })).prime()
+    assert verifier.threshold("4") == pytest.approx(3.0)
+
+
+def test_threshold_is_recomputed_when_templates_change():
+    model = _Model({"7": [[0], [1]]})
+    verifier = ClaimVerifier(model, spread=0.0)
+    assert verifier.threshold("7") == pytest.approx(1.0)
+    model._templates["7"] = np.array([[0], [4], [8]], dtype=np.float32)
+    assert verifier.threshold("7") == pytest.approx(4.0)
+
+
+def test_unknown_user_is_rejected():
+    verifier = ClaimVerifier(_Model({"7": [[0], [1]]}))
+    assert verifier.verify("8", [0]) == (False, None, None)
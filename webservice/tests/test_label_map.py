@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from label_map import label_map_path, load_label_map, save_label_map
+
+
+@pytest.fixture
+def model(tmp_path):
+    path = tmp_path / "typing.dnn"
+    path.write_bytes(b"weights v1")
+    return str(path)
+
+
+def test_round_trip(model):
+    save_label_map(model, ["p1", "p2"])
+    assert load_label_map(model) == ["p1", "p2"]
+
+
+def test_map_for_another_model_file_is_rejected(model):
+    save_label_map(model, ["p1", "p2"])
+    with open(model, "wb") as f:
+        f.write(b"weights v2")
+    with pytest.raises(ValueError, match="different model file"):
+        load_label_map(model)
+    assert load_label_map(model, verify=False) == ["p1", "p2"]
+
+
+def test_missing_map_is_none(model):
+    assert load_label_map(model) is None
+
+
+def test_malformed_map_is_rejected(model):
+    save_label_map(model, ["p1"])
+    path = label_map_path(model)
+    with open(path) as f:
+        data = json.load(f)
+    data["labels"] = ["p1", 2]
+    with open(path, "w") as f:
+        json.dump(data, f)
+    with pytest.raises(ValueError, match="malformed"):
+        load_label_map(model)
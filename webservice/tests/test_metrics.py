@@ -0,0 +1,42 @@
+import pytest
+
+from metrics import Counter, Histogram, ProcessSnapshots, Registry
+
+
+def _registry():
+    registry = Registry()
+    requests = registry.register(Counter("t_requests_total", "Requests.", ("endpoint",)))
+    seconds = registry.register(Histogram("t_seconds", "Latency.", ("endpoint",), buckets=(0.1, 1.0)))
+    return registry, requests, seconds
+
+
+def test_merged_snapshots_sum_every_process(tmp_path):
+    # Two "workers": one registry each, sharing the snapshot directory
+    first, first_requests, first_seconds = _registry()
+    second, second_requests, second_seconds = _registry()
+    first_requests.inc(endpoint="/a")
+    first_seconds.observe(0.05, endpoint="/a")
+    second_requests.inc(2, endpoint="/a")
+    second_requests.inc(endpoint="/b")
+    second_seconds.observe(0.5, endpoint="/a")
+
+    # Same pid here, but every ProcessSnapshots picks its own file
+    ProcessSnapshots(first, str(tmp_path)).write()
+    ProcessSnapshots(second, str(tmp_path)).write()
+    assert len(list(tmp_path.glob("*.json"))) == 2
+
+    merged = ProcessSnapshots(first, str(tmp_path)).merged()
+    assert merged["t_requests_total"] == {("/a",): 3, ("/b",): 1}
+    counts, total, count = merged["t_seconds"][("/a",)]
+    assert counts == [1, 1, 0] and count == 2 and total == pytest.approx(0.55)
+    text = first.render(merged)
+    assert 't_requests_total{endpoint="/a"} 3' in text
+    assert 't_seconds_bucket{endpoint="/a",le="1.0"} 2' in text
+    assert 't_seconds_count{endpoint="/a"} 2' in text
+
+
+def test_without_directory_nothing_is_written(tmp_path):
+    registry, requests, _ = _registry()
+    requests.inc(endpoint="/a")
+    ProcessSnapshots(registry).write()
+    assert 't_requests_total{endpoint="/a"} 1' in registry.render()
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from predict_payload import PayloadError, parse_columnar
+
+
+def _payload(features, key1="ab", key2="bc"):
+    return {"format": "columnar", "key1": key1, "key2": key2, "features": features}
+
+
+def test_flat_and_nested_features_are_parsed_as_float64():
+    flat = parse_columnar(_payload([1234.5678, 2, 3, 4, 5, 6, 7, 8, 9, 10]))
+    nested = parse_columnar(_payload([[1234.5678, 2, 3, 4, 5], [6, 7, 8, 9, 10]]))
+    for digraphs in (flat, nested):
+        assert digraphs.keys == [("a", "b"), ("b", "c")]
+        assert digraphs.features.dtype == np.float64
+        assert digraphs.features[0, 0] == 1234.5678  # float32 would give 1234.5677
+        assert digraphs.received == 2
+
+
+@pytest.mark.parametrize("features", [
+    ["1.5", 2, 3, 4, 5],            # numeric string
+    [True, 2, 3, 4, 5],             # bool
+    [None, 2, 3, 4, 5],
+    [[1, 2, 3, 4, 5], [1, 2]],      # ragged
+    [1, [2, 3], 4, 5, 6],           # mixed nesting
+    [1, 2, 3, 4],                   # not a multiple of 5
+    [[1, 2, 3, 4, 5, 6]],           # wrong row width
+    [],
+    "1,2,3,4,5",
+    None,
+])
+def test_malformed_features_are_rejected(features):
+    with pytest.raises(PayloadError):
+        parse_columnar(_payload(features, key1="a", key2="b"))
+
+
+def test_key_count_must_match_rows():
+    with pytest.raises(PayloadError):
+        parse_columnar(_payload([1, 2, 3, 4, 5], key1="ab", key2="b"))
+
+
+def test_non_finite_rows_and_invalid_keys_are_dropped():
+    digraphs = parse_columnar(_payload([[1, 2, 3, 4, 5], [1e400, 2, 3, 4, 5], [1, 2, 3, 4, 5]],
+                                       key1="\x00ac", key2="bbb"))
+    assert digraphs.keys == [("c", "b")]
+    assert digraphs.received == 3
@@ -0,0 +1,62 @@
+import time
+
+import numpy as np
+import pytest
+
+from tuning_jobs import TuningJobs
+
+GRID = {"n_neighbors": [1, 3]}
+
+
+def _dataset(shift=0.0):
+    rng = np.random.default_rng(0)
+    X = np.concatenate([rng.normal(center + shift, 0.1, size=(6, 4)) for center in (0, 5, 10)])
+    labels = [label for label in ("p1", "p2", "p3") for _ in range(6)]
+    return lambda: (X.astype(np.float32), labels)
+
+
+def _wait(jobs, job_id, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = jobs.status(job_id)
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"Tuning job {job_id} did not finish")
+
+
+@pytest.fixture
+def make_jobs():
+    made = []
+
+    def make(dataset, cache_dir):
+        jobs = TuningJobs(dataset, folds=3, workers=1, cache_dir=str(cache_dir))
+        made.append(jobs)
+        return jobs
+
+    yield make
+    for jobs in made:
+        if jobs._executor is not None:
+            jobs._executor.shutdown()
+
+
+def test_results_are_cached_in_memory_and_on_disk(make_jobs, tmp_path):
+    jobs = make_jobs(_dataset(), tmp_path)
+    first = jobs.submit(GRID)
+    assert not first["cached"]
+    done = _wait(jobs, first["job_id"])
+    assert done["status"] == "done" and done["progress"] == {"done": 2, "total": 2}
+    assert done["result"]["best_score"] == 1.0
+
+    again = jobs.submit(GRID)
+    assert again["cached"] and again["status"] == "done" and again["result"] == done["result"]
+
+    restarted = make_jobs(_dataset(), tmp_path).submit(GRID)
+    assert restarted["cached"] and restarted["result"] == done["result"]
+
+
+def test_changed_data_or_grid_is_not_served_from_the_cache(make_jobs, tmp_path):
+    jobs = make_jobs(_dataset(), tmp_path)
+    _wait(jobs, jobs.submit(GRID)["job_id"])
+    assert not jobs.submit({"n_neighbors": [1]})["cached"]
+    assert not make_jobs(_dataset(shift=1.0), tmp_path).submit(GRID)["cached"]
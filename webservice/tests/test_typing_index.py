@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from typing_index import CursorError, StaleCursor, TypingIndex, _decode_cursor, _encode_cursor
+
+HEADER = "participant,session,key1,key2,DU.key1.key1,DD.key1.key2,DU.key1.key2,UD.key1.key2,UU.key1.key2\n"
+
+
+def _rows(participant, session, n, start=0):
+    return "".join(f"{participant},{session},a,b,{i},1,1,1,1\n" for i in range(start, start + n))
+
+
+@pytest.fixture
+def index(tmp_path):
+    base, ext = tmp_path / "base.csv", tmp_path / "ext.csv"
+    base.write_text(HEADER + _rows("p1", 1, 3) + _rows("p2", 1, 2))
+    ext.write_text(HEADER + _rows("p1", 1, 2, start=3))
+    index = TypingIndex(str(base), str(ext))
+    index.load()
+    return index
+
+
+def _page(index, after=None, limit=2):
+    rows, cursor = index.history_page("p1", "1", after, limit)
+    return [row["DU.key1.key1"] for row in rows], cursor
+
+
+def test_cursor_round_trip():
+    cursor = _encode_cursor("p1", 1, "layout", 42)
+    assert _decode_cursor(cursor, "p1", "1", "layout") == 42
+    with pytest.raises(StaleCursor):
+        _decode_cursor(cursor, "p1", "1", "other-layout")
+    with pytest.raises(CursorError):
+        _decode_cursor(cursor, "p2", "1", "layout")
+
+
+@pytest.mark.parametrize("cursor", ["", "not base64!", "bm90IGpzb24", _encode_cursor("p1", 1, "x", -1)[:-2]])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(CursorError) as raised:
+        _decode_cursor(cursor, "p1", "1", "x")
+    assert not isinstance(raised.value, StaleCursor)
+
+
+def test_pages_span_base_and_extended_rows(index):
+    first, cursor = _page(index)
+    second, cursor = _page(index, cursor)
+    third, cursor = _page(index, cursor)
+    assert (first, second, third) == (["0", "1"], ["2", "3"], ["4"])
+    assert cursor is None
+
+
+def test_cursor_survives_appends(index):
+    _, cursor = _page(index, limit=4)
+    with open(index.ext_csv, "a") as f:
+        f.write(_rows("p1", 1, 1, start=5))
+    index.refresh()
+    assert _page(index, cursor, limit=10) == (["4", "5"], None)
+
+
+def test_cursor_from_before_a_compaction_is_stale(index):
+    _, cursor = _page(index)
+    # What compaction.py does: a new base file (with the extended rows) and an emptied extended file
+    replacement = index.base_csv + ".new"
+    with open(replacement, "w") as f:
+        f.write(HEADER + _rows("p1", 1, 5) + _rows("p2", 1, 2))
+    os.replace(replacement, index.base_csv)
+    with open(index.ext_csv, "w") as f:
+        f.write(HEADER)
+    index.refresh()
+    with pytest.raises(StaleCursor):
+        _page(index, cursor)
+    assert _page(index, None, limit=10)[0] == ["0", "1", "2", "3", "4"]
+
+
+def test_cursor_for_another_session_is_rejected(index):
+    _, cursor = _page(index)
+    with pytest.raises(CursorError):
+        index.history_page("p2", "1", cursor, 2)
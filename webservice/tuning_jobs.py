@@ -0,0 +1,215 @@
+import os
+import json
+import uuid
+import time
+import hashlib
+import itertools
+import threading
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from knn_model import cross_val_accuracy
+
+# Same search space the research workflow used for KNeighborsClassifier
+DEFAULT_GRID = {
+    "n_neighbors": [1, 3, 5, 7, 9, 11],
+    "metric": ["manhattan", "euclidean", "chebyshev"],
+    "weights": ["uniform", "distance"],
+}
+_ALLOWED = {
+    "n_neighbors": lambda v: isinstance(v, int) and not isinstance(v, bool) and v > 0,
+    "metric": lambda v: v in ("manhattan", "euclidean", "chebyshev"),
+    "weights": lambda v: v in ("uniform", "distance"),
+}
+
+
+def validate_grid(grid):
+    """Check a user supplied grid; returns a normalised copy or raises ValueError."""
+    if grid is None:
+        return dict(DEFAULT_GRID)
+    if not isinstance(grid, dict) or not grid:
+        raise ValueError("Grid must be a non-empty object")
+    clean = {}
+    for name, values in grid.items():
+        check = _ALLOWED.get(name)
+        if check is None:
+            raise ValueError(f"Unknown parameter: {name}")
+        if not isinstance(values, list) or not values or not all(check(v) for v in values):
+            raise ValueError(f"Invalid values for {name}: {values!r}")
+        clean[name] = sorted(set(values), key=str)
+    for name, values in DEFAULT_GRID.items():
+        clean.setdefault(name, [values[0]])
+    return clean
+
+
+def dataset_digest(X, labels):
+    """Content hash of the training data, used to key cached tuning results."""
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(X, dtype=np.float32).tobytes())
+    h.update("\n".join(labels).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _evaluate(X, labels, params, folds):
+    """Worker-side scoring of one grid point."""
+    score = cross_val_accuracy(X, labels, params["n_neighbors"], folds,
+                               metric=params["metric"], weights=params["weights"])
+    return params, score
+
+
+def _estimator_repr(params):
+    return "KNeighborsClassifier(" + ", ".join(f"{k}={v!r}" for k, v in sorted(params.items())) + ")"
+
+
+class TuningJobs:
+    """
+    Asynchronous hyperparameter search over the resident KNN data.
+
+    submit() returns a job id straight away; the grid points are scored on a
+    shared process pool while status()/progress can be polled. Finished
+    results are cached (in memory and as JSON under `cache_dir`) by a hash of
+    the dataset plus the grid, so resubmitting against unchanged data returns
+    a finished job immediately.
+    """
+
+    def __init__(self, dataset, folds=5, workers=None, cache_dir=None, on_done=None, max_jobs=100):
+        self.dataset = dataset  # callable -> (X, labels)
+        self.folds = folds
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_dir = cache_dir
+        self.on_done = on_done
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._cache = {}
+        self._executor = None
+        self._executor_pid = None
+
+    # --- Cache ---
+
+    def _cache_key(self, digest, grid):
+        return hashlib.sha256((digest + json.dumps(grid, sort_keys=True)).encode("utf-8")).hexdigest()
+
+    def _cached(self, key):
+        result = self._cache.get(key)
+        if result is None and self.cache_dir:
+            path = os.path.join(self.cache_dir, f"{key}.json")
+            try:
+                with open(path, encoding="utf-8") as f:
+                    result = self._cache[key] = json.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging.warning(f"Ignoring unreadable tuning cache entry {path}: {e}")
+        return result
+
+    def _store(self, key, result):
+        self._cache[key] = result
+        if self.cache_dir:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp = os.path.join(self.cache_dir, f".{key}.tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(result, f)
+                os.replace(tmp, os.path.join(self.cache_dir, f"{key}.json"))
+            except Exception as e:
+                logging.error(f"Could not persist tuning result {key}: {e}")
+
+    # --- Jobs ---
+
+    def submit(self, grid=None):
+        """Start (or reuse) a tuning run; returns the job's public status dict."""
+        grid = validate_grid(grid)
+        X, labels = self.dataset()
+        key = self._cache_key(dataset_digest(X, labels), grid)
+        points = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "status": "queued",
+            "grid": grid,
+            "cache_key": key,
+            "progress": {"done": 0, "total": len(points)},
+            "submitted": time.time(),
+            "finished": None,
+            "cached": False,
+            "result": None,
+            "error": None,
+        }
+        with self._lock:
+            result = self._cached(key)
+            if result is None:
+                # Attach to an identical run that is still in flight instead of starting another
+                for other in self._jobs.values():
+                    if other["cache_key"] == key and other["status"] in ("queued", "running"):
+                        return self._public(other)
+            self._prune()
+            self._jobs[job["job_id"]] = job
+            if result is not None:
+                job.update(status="done", result=result, cached=True, finished=time.time())
+                job["progress"]["done"] = job["progress"]["total"]
+                return self._public(job)
+
+        threading.Thread(target=self._run, args=(job, X, labels, points),
+                         name=f"tuning-{job['job_id'][:8]}", daemon=True).start()
+        return self._public(job)
+
+    def _run(self, job, X, labels, points):
+        job["status"] = "running"
+        try:
+            with self._lock:
+                if self._executor is None or self._executor_pid != os.getpid():
+                    # A forked worker cannot use the pool it inherited from its parent
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    self._executor_pid = os.getpid()
+                executor = self._executor
+            X = np.ascontiguousarray(X)
+            futures = [executor.submit(_evaluate, X, labels, p, self.folds) for p in points]
+            scores = []
+            for future in as_completed(futures):
+                scores.append(future.result())
+                job["progress"]["done"] += 1
+            scores.sort(key=lambda ps: (-(ps[1] or 0), ps[0]["n_neighbors"], ps[0]["metric"], ps[0]["weights"]))
+            best_params, best_score = scores[0]
+            result = {
+                "best_score": best_score,
+                "best_params": best_params,
+                "best_estimator": _estimator_repr(best_params),
+                "samples": len(labels),
+                "scores": [{"params": p, "score": s} for p, s in scores],
+            }
+            with self._lock:
+                self._store(job["cache_key"], result)
+            job.update(result=result, status="done", finished=time.time())
+            logging.info(f"Tuning job {job['job_id']} done: {best_score} with {best_params}")
+        except Exception as e:
+            logging.exception(f"Tuning job {job['job_id']} failed")
+            job.update(status="failed", error=str(e), finished=time.time())
+            return
+        if self.on_done is not None:
+            try:
+                self.on_done(result)
+            except Exception:
+                logging.exception("Tuning completion callback failed")
+
+    def _prune(self):
+        """Forget the oldest finished jobs beyond max_jobs. Lock must be held."""
+        finished = [j for j in self._jobs.values() if j["status"] in ("done", "failed")]
+        for job in sorted(finished, key=lambda j: j["submitted"])[:max(0, len(self._jobs) - self.max_jobs + 1)]:
+            del self._jobs[job["job_id"]]
+
+    @staticmethod
+    def _public(job):
+        data = {k: job[k] for k in ("job_id", "status", "cached", "grid", "error")}
+        data["progress"] = dict(job["progress"])
+        if job["status"] == "done":
+            data["result"] = job["result"]
+        return data
+
+    def status(self, job_id):
+        """Public status dict of a job, or None if it is unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._public(job) if job is not None else None
@@ -0,0 +1,324 @@
+import os
+import csv
+import io
+import json
+import base64
+import threading
+import logging
+
+from metrics import ROWS_READ
+
+
+class CursorError(ValueError):
+    """A history cursor that is malformed or belongs to another participant/session (400)."""
+
+
+class StaleCursor(CursorError):
+    """The rows were compacted or re-indexed since the cursor was issued (410): start over."""
+
+
+def _encode_cursor(participant, session, layout, offset):
+    raw = json.dumps([participant, str(session), layout, offset], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor, participant, session, layout):
+    """Number of the session's rows returned before `cursor`."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_participant, cursor_session, cursor_layout, offset = json.loads(raw)
+    except (ValueError, TypeError):
+        raise CursorError("Invalid cursor") from None
+    if type(offset) is not int or offset < 0:
+        raise CursorError("Invalid cursor")
+    if (cursor_participant, cursor_session) != (participant, str(session)):
+        raise CursorError("Cursor belongs to another participant/session")
+    if cursor_layout != layout:
+        raise StaleCursor("History was compacted or re-indexed since this cursor was issued; start again without 'after'")
+    return offset
+
+
+class TypingIndex:
+    """
+    Resident index over the typing CSVs (base file + extended append file).
+
+    Rows are parsed once and kept in memory in file order, together with a
+    participant -> session -> [(start, stop), ...] map of row ranges. The base
+    CSV is treated as static; the extended CSV is followed by remembering the
+    byte offset already consumed and parsing only what was appended since.
+    When the base CSV is replaced (compaction.py merges the extended rows into
+    it) the whole index is rebuilt. base_csv may be None to follow a single
+    appended file (a shard_store.py segment).
+    """
+
+    REQUIRED_KEYS = ("participant", "session")
+
+    def __init__(self, base_csv, ext_csv):
+        self.base_csv = base_csv
+        self.ext_csv = ext_csv
+        self._lock = threading.Lock()
+        self._rows = []
+        self._ranges = {}          # participant -> {session: [(start, stop), ...]}
+        self._sorted_sessions = {} # participant -> cached sorted session list
+        self._participants = None  # cached sorted participant list
+        self._ext_header = None
+        self._ext_offset = 0
+        self._ext_inode = None
+        self._ext_start = None     # position of the first extended-CSV row in _rows
+        self._base_stat = None     # (size, mtime, inode) of the base CSV when it was loaded
+        self._ext_mtime = None     # mtime of the extended CSV when last tailed
+        self.generation = 0        # Bumped whenever the indexed rows change
+
+    # --- Loading ---
+
+    def load(self):
+        """(Re)build the whole index from both CSV files."""
+        with self._lock:
+            self._rows = []
+            self._ranges = {}
+            self._sorted_sessions = {}
+            self._participants = None
+            self._ext_header = None
+            self._ext_offset = 0
+            self._ext_inode = None
+            self._ext_start = None
+            self._base_stat = None
+            self._ext_mtime = None
+            self.generation += 1
+
+            if self.base_csv is None:
+                pass
+            elif os.path.isfile(self.base_csv):
+                try:
+                    st = os.stat(self.base_csv)
+                    self._base_stat = (st.st_size, st.st_mtime, st.st_ino)
+                    with open(self.base_csv, "rb") as f:
+                        data = f.read()
+                    header, records = self._parse(data, None)
+                    self._add_records(header, records, self.base_csv)
+                except Exception as e:
+                    logging.error(f"Error indexing CSV file {self.base_csv}: {e}")
+            else:
+                logging.debug(f"CSV file not found, skipping: {self.base_csv}")
+
+            self._tail_ext()
+            logging.info(f"Typing index built: {len(self._rows)} rows, "
+                         f"{len(self._ranges)} participants")
+
+    def refresh(self, participant=None):
+        """Index rows appended to the extended CSV since the last call (for everyone: `participant` is ignored)."""
+        try:
+            st = os.stat(self.base_csv) if self.base_csv is not None else None
+            base_stat = (st.st_size, st.st_mtime, st.st_ino) if st else None
+        except FileNotFoundError:
+            base_stat = None
+        if base_stat != self._base_stat:
+            # Replaced by a compaction: its rows are now (partly) in the base
+            logging.info(f"{self.base_csv} changed, rebuilding the typing index")
+            before = len(self._rows)
+            self.load()
+            return max(0, len(self._rows) - before)
+        try:
+            st = os.stat(self.ext_csv)
+        except FileNotFoundError:
+            return 0
+        if st.st_size == self._ext_offset and st.st_ino == self._ext_inode:
+            return 0  # Nothing new, no need to take the lock
+        with self._lock:
+            return self._tail_ext()
+
+    def _tail_ext(self):
+        """Parse complete lines appended to EXT_CSV after the stored offset. Lock must be held."""
+        try:
+            st = os.stat(self.ext_csv)
+        except FileNotFoundError:
+            logging.debug(f"CSV file not found, skipping: {self.ext_csv}")
+            return 0
+
+        if self._ext_inode is not None and (st.st_ino != self._ext_inode or st.st_size < self._ext_offset):
+            # File was replaced or truncated: drop its rows and start over from byte 0
+            logging.warning(f"{self.ext_csv} was replaced or truncated, re-indexing it")
+            self._drop_ext_rows()
+
+        try:
+            with open(self.ext_csv, "rb") as f:
+                f.seek(self._ext_offset)
+                chunk = f.read()
+        except Exception as e:
+            logging.error(f"Error tailing CSV file {self.ext_csv}: {e}")
+            return 0
+
+        self._ext_inode = st.st_ino
+        # Only consume whole lines; a partially written last line is picked up next time
+        end = chunk.rfind(b"\n")
+        if end < 0:
+            return 0
+        chunk = chunk[:end + 1]
+        self._ext_offset += len(chunk)
+        self._ext_mtime = st.st_mtime
+
+        try:
+            header, records = self._parse(chunk, self._ext_header)
+        except Exception as e:
+            logging.error(f"Error parsing appended data in {self.ext_csv}: {e}")
+            return 0
+        self._ext_header = header
+        if self._ext_start is None:
+            self._ext_start = len(self._rows)
+        return self._add_records(header, records, self.ext_csv)
+
+    def _drop_ext_rows(self):
+        start = self._ext_start if self._ext_start is not None else len(self._rows)
+        base_rows = self._rows[:start]
+        self._rows = []
+        self._ranges = {}
+        self._sorted_sessions = {}
+        self._participants = None
+        self._ext_header = None
+        self._ext_offset = 0
+        self._ext_start = None
+        self._ext_mtime = None
+        self.generation += 1
+        for i, row in enumerate(base_rows):
+            self._rows.append(row)
+            self._index_row(i, row)
+
+    @staticmethod
+    def _parse(data, header):
+        """Decode CSV bytes; the first record is the header unless one is given."""
+        reader = csv.reader(io.StringIO(data.decode("utf-8")), skipinitialspace=True)
+        if header is None:
+            for first in reader:
+                if first:
+                    header = [h.strip() if h else "" for h in first]
+                    break
+        return header, reader
+
+    def _add_records(self, header, records, path):
+        if not header:
+            logging.warning(f"CSV file has no header: {path}")
+            return 0
+        added = 0
+        for rec in records:
+            if not rec:
+                continue
+            # Clean keys (strip whitespace) and drop keys that are empty
+            row = {k: v for k, v in zip(header, rec) if k}
+            if all(row.get(key) for key in self.REQUIRED_KEYS):
+                pos = len(self._rows)
+                self._rows.append(row)
+                self._index_row(pos, row)
+                added += 1
+            else:
+                logging.debug(f"Skipping incomplete row in {path}: {rec}")
+        ROWS_READ.inc(added, source=os.path.basename(path))
+        if added:
+            self.generation += 1
+        return added
+
+    def _index_row(self, pos, row):
+        participant = row["participant"]
+        session = row["session"]
+        sessions = self._ranges.get(participant)
+        if sessions is None:
+            sessions = self._ranges[participant] = {}
+            self._participants = None
+        spans = sessions.get(session)
+        if spans is None:
+            spans = sessions[session] = []
+            self._sorted_sessions.pop(participant, None)
+        if spans and spans[-1][1] == pos:
+            # Appends arrive in per-request blocks, so extend the current range
+            spans[-1] = (spans[-1][0], pos + 1)
+        else:
+            spans.append((pos, pos + 1))
+
+    # --- Versioning ---
+
+    def version(self):
+        """
+        (generation, tag, last_modified) of the indexed data. `generation`
+        counts changes in this process; `tag` names the same data in every
+        worker (it is built from the files and the bytes consumed, not from
+        the counter) and `last_modified` is the newest file mtime indexed.
+        """
+        with self._lock:
+            tag = f"{self._layout()}.{self._ext_offset}"
+            mtimes = [t for t in ((self._base_stat or (0, None))[1], self._ext_mtime) if t is not None]
+            return self.generation, tag, max(mtimes) if mtimes else None
+
+    def _layout(self):
+        """
+        Names the files the row positions come from; appends keep it, a
+        compaction (new base file) or a replaced extended CSV changes it. Lock must be held.
+        """
+        base = "%d-%d" % (self._base_stat[0], int(self._base_stat[1] * 1e6)) if self._base_stat else "0"
+        return f"{base}.{self._ext_inode or 0}"
+
+    def scope(self, participant):
+        """Object whose version() covers `participant`'s rows: the whole index here."""
+        return self
+
+    # --- Queries ---
+
+    def participants(self):
+        """Sorted list of participant IDs."""
+        with self._lock:
+            if self._participants is None:
+                self._participants = sorted(self._ranges)
+            return self._participants
+
+    def sessions(self, participant):
+        """Session IDs (as stored in the CSV) for a participant, in a stable order."""
+        with self._lock:
+            cached = self._sorted_sessions.get(participant)
+            if cached is None:
+                cached = sorted(self._ranges.get(participant, {}))
+                self._sorted_sessions[participant] = cached
+            return cached
+
+    def history(self, participant, session):
+        """Rows of one participant/session in file order."""
+        with self._lock:
+            spans = self._ranges.get(participant, {}).get(session, ())
+            rows = []
+            for start, stop in spans:
+                rows.extend(self._rows[start:stop])
+            return rows
+
+    def history_page(self, participant, session, after=None, limit=None):
+        """
+        Lazy page of one participant/session: (iterator over rows, cursor).
+        Rows come after `after` (the opaque cursor of a previous page), at
+        most `limit` of them; the cursor is None on the last page. A cursor
+        counts rows within the session and is bound to the file layout:
+        appends keep it valid, after a compaction or re-index it raises
+        StaleCursor. Rows are read from the index as the iterator is
+        consumed, outside the lock (the row list is only ever appended to or
+        replaced, never edited).
+        """
+        with self._lock:
+            rows = self._rows
+            spans = list(self._ranges.get(participant, {}).get(session, ()))
+            layout = self._layout()
+        offset = _decode_cursor(after, participant, session, layout) if after is not None else 0
+        selected = []
+        skip, remaining = offset, limit
+        for start, stop in spans:
+            if skip >= stop - start:
+                skip -= stop - start
+                continue
+            start, skip = start + skip, 0
+            if remaining is not None:
+                stop = min(stop, start + remaining)
+                remaining -= stop - start
+            selected.append((start, stop))
+            if remaining == 0:
+                break
+        consumed = offset + sum(stop - start for start, stop in selected)
+        more = consumed < sum(stop - start for start, stop in spans)
+        cursor = _encode_cursor(participant, session, layout, consumed) if more and limit is not None else None
+        return (rows[i] for start, stop in selected for i in range(start, stop)), cursor
+
+    def __len__(self):
+        return len(self._rows)
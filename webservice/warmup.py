@@ -0,0 +1,118 @@
+import os
+import time
+import functools
+import threading
+import logging
+
+from metrics import stage
+
+# background: import the ML stack and load models in a thread after the app is
+# importable (routes that need them wait, see Warmup.required); eager: do it
+# during import, as before
+WARMUP = os.environ.get("WARMUP", "background")
+# How long a request that needs the warm-up waits for it before getting a 503
+WARMUP_WAIT_S = float(os.environ.get("WARMUP_WAIT_S", "30"))
+
+
+class Warmup:
+    """
+    Start-up steps (ML imports, model and data loading) run in registration
+    order, off the import path. `ready` is set once every step has run; a
+    step that raises leaves the app unready, so steps whose failure is
+    tolerable (e.g. no model yet) should catch and log it themselves.
+    """
+
+    def __init__(self, wait=WARMUP_WAIT_S):
+        self.wait_seconds = wait
+        self.ready = threading.Event()
+        self.steps = []        # (name, fn)
+        self.timings = {}      # step -> seconds
+        self.errors = {}       # step -> message
+        self.started = None
+        self.finished = None
+        self._thread = None
+
+    def step(self, name):
+        """Decorator registering `fn` as the next step."""
+        def register(fn):
+            self.steps.append((name, fn))
+            return fn
+        return register
+
+    def start(self, background=None):
+        """Run the steps, in a daemon thread unless WARMUP=eager (or background=False)."""
+        if background is None:
+            background = WARMUP != "eager"
+        self.started = time.perf_counter()
+        if background:
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+        else:
+            self._run()
+        return self
+
+    def _run(self):
+        for name, fn in self.steps:
+            start = time.perf_counter()
+            try:
+                with stage(name, endpoint="warmup"):
+                    fn()
+            except Exception as e:
+                logging.error(f"Warm-up step '{name}' failed: {e}")
+                self.errors[name] = f"{type(e).__name__}: {e}"
+            self.timings[name] = time.perf_counter() - start
+        self.finished = time.perf_counter()
+        if self.errors:
+            logging.error(f"Warm-up finished with errors in {self.finished - self.started:.3f}s: {self.errors}")
+            return
+        logging.info(f"Warm-up finished in {self.finished - self.started:.3f}s: "
+                     + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.timings.items()))
+        self.ready.set()
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    def wait(self, timeout=None):
+        """Block until the steps have run (or `timeout`); True if the app is ready."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.ready.is_set()
+
+    def status(self):
+        return {
+            "ready": self.ready.is_set(),
+            "done": self.done,
+            "seconds": (self.finished or time.perf_counter()) - self.started if self.started else None,
+            "steps": dict(self.timings),
+            "errors": dict(self.errors),
+            "pending": [name for name, _ in self.steps if name not in self.timings],
+        }
+
+    def required(self, view):
+        """Route decorator: wait (up to `wait_seconds`) for the warm-up, else 503 + Retry-After."""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self.ready.is_set():
+                with stage("warmup_wait"):
+                    ready = self.ready.wait(self.wait_seconds if not self.done else 0)
+                if not ready:
+                    from flask import jsonify
+                    response = jsonify(error="Service is warming up" if not self.done else "Warm-up failed",
+                                       warmup=self.status())
+                    response.status_code = 503
+                    response.headers["Retry-After"] = "1" if not self.done else "30"
+                    return response
+            return view(*args, **kwargs)
+        return wrapper
+
+    def register(self, app):
+        """Add GET /ready: 200 once warmed up, 503 (with step timings) until then."""
+        from flask import jsonify
+
+        @app.route("/ready", methods=["GET"])
+        def ready_endpoint():
+            status = self.status()
+            return jsonify(status), 200 if status["ready"] else 503
+
+        return app